@@ -0,0 +1,323 @@
+# 行動 App 用的 JSON API（/api/v1），操作與 HTML 路由相同，但不轉址：
+# 寫入操作在同一個回應裡回傳更新後的訂單，一次來回就完成。
+#
+#   POST   /api/v1/session                     登入 {"username", "password"}；DELETE 登出
+#   GET    /api/v1/menu?merchant_id=           菜單
+#   GET    /api/v1/orders                      自己的訂單（顧客／商家／外送員）；外送員加 ?scope=board 看待配送
+#   GET    /api/v1/orders/<id>                 訂單狀態
+#   POST   /api/v1/orders                      下單 {"item_id"}
+#   POST   /api/v1/orders/confirm              確認下單 {"order_ids": [...]}
+#   POST   /api/v1/orders/<id>/claim|pickup|deliver   外送員接單、取貨、送達
+#   GET    /api/v1/reports?range=|start=&end=  結算報告
+#
+# 列表以 ?fields=id,state,price 選欄位（列表一定包含分頁用的 id），回傳 {"fields": [...], "rows": [[...], ...]}：
+# 欄位名稱只送一次，每一列直接由 sqlite3.Row 轉成陣列。分頁沿用 ?cursor=&limit=，下一頁的 cursor 在 next_cursor。
+# 錯誤一律回傳 {"error": "..."} 與對應的狀態碼。
+import functools
+import json
+import sqlite3
+
+from flask import Blueprint, current_app, request, session
+from werkzeug.security import check_password_hash
+
+import db
+import events
+import logs
+import notifications
+import order_state
+import settlements
+import versions
+from pagination import fetch_page, page_args, slice_page
+
+log = logs.get_logger('api')
+
+bp = Blueprint('api', __name__, url_prefix='/api/v1')
+
+MENU_FIELDS = ('id', 'item_name', 'description', 'price', 'merchant_id')
+MENU_DEFAULT_FIELDS = ('id', 'item_name', 'price', 'merchant_id')
+ORDER_FIELDS = ('id', 'customer_id', 'merchant_id', 'delivery_person_id', 'item_id', 'item_name', 'price',
+                'state', 'status', 'acceptance_status', 'delivery_status', 'state_changed_at')
+ORDER_DEFAULT_FIELDS = ('id', 'item_name', 'price', 'state')
+REPORT_FIELDS = ('username', 'total_orders', 'total_received', 'total_due')
+REPORT_TYPES = {'merchant': settlements.MERCHANT, 'courier': settlements.COURIER, 'customer': settlements.CUSTOMER}
+
+# 各角色看得到的訂單：WHERE 欄位
+ROLE_COLUMNS = {'customer': 'customer_id', 'merchant': 'merchant_id', 'delivery_person': 'delivery_person_id'}
+
+# 每批最多幾個訂單 id（SQLite 舊版預設參數上限為 999）
+CHUNK_SIZE = 500
+
+
+class ApiError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def respond(payload, status=200):
+    # 不跳脫中文、不加空白，回應比 jsonify 預設的小
+    return current_app.response_class(json.dumps(payload, ensure_ascii=False, separators=(',', ':')),
+                                      status=status, mimetype='application/json')
+
+
+@bp.errorhandler(ApiError)
+def _api_error(e):
+    return respond({'error': str(e)}, e.status)
+
+
+@bp.errorhandler(sqlite3.Error)
+def _db_error(e):
+    log.exception('API 資料庫錯誤')
+    return respond({'error': f'SQLite Error: {e}'}, 500)
+
+
+def require(*roles):
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if 'user_id' not in session:
+                raise ApiError('login required', 401)
+            if roles and session['role'] not in roles:
+                raise ApiError('forbidden', 403)
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _services():
+    return current_app.extensions['api']
+
+
+def _body():
+    # JSON 必須是物件；陣列、數字或無法解析的 JSON 回 400。非 JSON 請求讀表單
+    if not request.is_json:
+        return request.form
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        raise ApiError('request body must be a JSON object')
+    return body
+
+
+def requested_fields(allowed, default, required=()):
+    # ?fields=a,b,c；不認得的欄位回 400。required 的欄位（例如分頁用的 id）一定放在最前面
+    raw = request.args.get('fields')
+    fields = tuple(dict.fromkeys(f.strip() for f in raw.split(',') if f.strip())) if raw else default
+    unknown = [f for f in fields if f not in allowed]
+    if unknown:
+        raise ApiError(f"unknown fields: {', '.join(unknown)}")
+    return (*required, *(f for f in fields if f not in required))
+
+
+def rows_payload(fields, rows, page=None):
+    # SELECT 的欄位順序與 fields 相同時，sqlite3.Row 直接轉 tuple 即可
+    payload = {'fields': fields, 'rows': [tuple(row) for row in rows]}
+    if page is not None:
+        payload['next_cursor'] = page.next_cursor
+    return payload
+
+
+def project(fields, rows):
+    # 快取裡的是 SELECT * 的列，只取需要的欄位
+    return [tuple(row[f] for f in fields) for row in rows]
+
+
+def select_orders(conn, fields, order_ids, customer_id=None):
+    condition, params = ('AND customer_id = ?', (customer_id,)) if customer_id is not None else ('', ())
+    rows = []
+    for start in range(0, len(order_ids), CHUNK_SIZE):
+        chunk = order_ids[start:start + CHUNK_SIZE]
+        rows += conn.execute(f'''
+            SELECT {', '.join(fields)} FROM order_history
+            WHERE id IN ({','.join('?' * len(chunk))}) {condition}
+            ORDER BY id
+        ''', (*chunk, *params)).fetchall()
+    return rows
+
+
+def order_response(conn, order_ids, status=200, customer_id=None):
+    fields = requested_fields(ORDER_FIELDS, ORDER_DEFAULT_FIELDS)
+    return respond(rows_payload(fields, select_orders(conn, fields, order_ids, customer_id)), status)
+
+
+def own_orders():
+    # 目前使用者看得到的訂單條件
+    where, params = f"{ROLE_COLUMNS[session['role']]} = ?", (session['user_id'],)
+    if session['role'] == 'merchant':
+        # 與 merchant_orders view 相同，顧客還沒確認的訂單商家看不到
+        where += ' AND state <> ?'
+        params += (order_state.PLACED,)
+    return where, params
+
+
+def _dispatch_pending(conn):
+    # 與 HTML 路由相同：派單失敗不影響觸發它的操作
+    dispatcher = _services()['dispatcher']
+    try:
+        dispatcher.dispatch(conn)
+    except Exception:
+        log.exception('自動派單失敗')
+
+
+@bp.route('/session', methods=['POST'])
+def login():
+    body = _body()
+    username = (body.get('username') or '').strip()
+    user = db.get_db().execute('SELECT id, username, role, password_hash FROM users WHERE username = ?',
+                               (username,)).fetchone()
+    if user is None or not check_password_hash(user['password_hash'], body.get('password') or ''):
+        raise ApiError('用戶名或密碼錯誤', 401)
+
+    session['user_id'] = user['id']
+    session['username'] = user['username']
+    session['role'] = user['role']
+    return respond({'id': user['id'], 'username': user['username'], 'role': user['role']})
+
+
+@bp.route('/session', methods=['DELETE'])
+def logout():
+    if session.get('role') == 'delivery_person':
+        _services()['dispatcher'].set_available(session['user_id'], False)
+    session.clear()
+    return respond({})
+
+
+@bp.route('/menu', methods=['GET'])
+def menu():
+    fields = requested_fields(MENU_FIELDS, MENU_DEFAULT_FIELDS, required=('id',))
+    catalog = _services()['catalog']
+    merchant_id = request.args.get('merchant_id', type=int)
+    if merchant_id is None:
+        items = catalog.all_items(lambda: db.get_db().execute('SELECT * FROM menu ORDER BY id').fetchall())
+    else:
+        items = catalog.merchant_items(merchant_id, lambda: db.get_db().execute(
+            'SELECT * FROM menu WHERE merchant_id = ? ORDER BY id', (merchant_id,)).fetchall())
+    page = slice_page(items, *page_args())
+    return respond({'fields': fields, 'rows': project(fields, page.items), 'next_cursor': page.next_cursor})
+
+
+@bp.route('/orders', methods=['GET'])
+@require('customer', 'merchant', 'delivery_person')
+def list_orders():
+    fields = requested_fields(ORDER_FIELDS, ORDER_DEFAULT_FIELDS, required=('id',))
+    role = session['role']
+    if role == 'delivery_person' and request.args.get('scope') == 'board':
+        # 外送員看板：還沒有外送員的待配送訂單，只查熱表（走 idx_orders_state）
+        table, (where, params) = 'orders', ('state = ?', (order_state.READY,))
+    else:
+        # 自己的訂單包含已封存的歷史訂單
+        table, (where, params) = 'order_history', own_orders()
+
+    cursor, size = page_args()
+    page = fetch_page(db.get_db(), f"SELECT {', '.join(fields)} FROM {table} WHERE {where}", params, cursor, size)
+    return respond(rows_payload(fields, page.items, page))
+
+
+@bp.route('/orders/<int:order_id>', methods=['GET'])
+@require('customer', 'merchant', 'delivery_person')
+def get_order(order_id):
+    fields = requested_fields(ORDER_FIELDS, ORDER_DEFAULT_FIELDS)
+    where, params = own_orders()
+    row = db.get_db().execute(f"SELECT {', '.join(fields)} FROM order_history WHERE id = ? AND {where}",
+                              (order_id, *params)).fetchone()
+    if row is None:
+        raise ApiError('訂單未找到', 404)
+    return respond(rows_payload(fields, [row]))
+
+
+@bp.route('/orders', methods=['POST'])
+@require('customer')
+def place_order():
+    item_id = _body().get('item_id')
+    conn = db.get_db()
+    item = conn.execute('SELECT id, item_name, price, merchant_id FROM menu WHERE id = ?', (item_id,)).fetchone()
+    if item is None:
+        raise ApiError('菜品不存在！', 404)
+
+    order_id = conn.execute('''
+        INSERT INTO orders (customer_id, merchant_id, item_id, item_name, price, status, state)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', (session['user_id'], item['merchant_id'], item['id'], item['item_name'], item['price'],
+          '待处理', order_state.PLACED)).lastrowid
+    conn.commit()
+    versions.registry.bump('orders', session['user_id'])
+    return order_response(conn, [order_id], 201)
+
+
+@bp.route('/orders/confirm', methods=['POST'])
+@require('customer')
+def confirm_orders():
+    body = _body()
+    raw_ids = body.get('order_ids') if request.is_json else body.getlist('order_ids')
+    order_ids = list(dict.fromkeys(int(i) for i in raw_ids or () if str(i).isdigit()))
+    if not order_ids:
+        raise ApiError('請選擇至少一個訂單來確認下單！')
+
+    conn = db.get_db()
+    try:
+        for start in range(0, len(order_ids), CHUNK_SIZE):
+            order_state.transition(conn, 'confirm', order_ids[start:start + CHUNK_SIZE],
+                                   where={'customer_id': session['user_id']})
+        conn.commit()
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+    events.publish_orders(conn, order_ids)
+
+    # 只回傳自己的訂單；已確認過的也照樣回傳目前狀態
+    return order_response(conn, order_ids, customer_id=session['user_id'])
+
+
+@bp.route('/orders/<int:order_id>/claim', methods=['POST'])
+@require('delivery_person')
+def claim_order(order_id):
+    conn = db.get_db()
+    # 與 /deliver_order 相同：compare-and-set，寫鎖競爭時整個交易退避重試
+    claimed = db.write_transaction(conn, lambda c: order_state.transition(
+        c, 'claim', order_id, assign={'delivery_person_id': session['user_id']}))
+    log.info('外送員搶單', extra={'order_id': order_id, 'claimed': bool(claimed)})
+    if not claimed:
+        raise ApiError('訂單已被接走或狀態已變更。', 409)
+    _services()['dispatcher'].discard(order_id)
+    events.publish_orders(conn, order_id)
+    return order_response(conn, [order_id])
+
+
+@bp.route('/orders/<int:order_id>/<any(pickup, deliver):action>', methods=['POST'])
+@require('delivery_person')
+def courier_action(order_id, action):
+    conn = db.get_db()
+    try:
+        if not order_state.transition(conn, action, order_id, where={'delivery_person_id': session['user_id']}):
+            conn.rollback()
+            raise ApiError('訂單狀態已變更。', 409)
+        notifications.notify_customer(conn, action, order_id)
+        conn.commit()
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+    events.publish_orders(conn, order_id)
+    notifications.publish_customer_unread(conn, order_id)
+    if action == 'deliver':
+        # 外送員空出手，可以再派下一張
+        _dispatch_pending(conn)
+    return order_response(conn, [order_id])
+
+
+@bp.route('/reports', methods=['GET'])
+@require()
+def reports():
+    fields = requested_fields(REPORT_FIELDS, REPORT_FIELDS)
+    start, end = settlements.parse_range(request.args)
+    totals = settlements.totals(db.get_db(), start, end)
+    return respond({
+        'fields': fields,
+        'start': start.isoformat() if start else None,
+        'end': end.isoformat() if end else None,
+        **{name: project(fields, totals[report_type]) for name, report_type in REPORT_TYPES.items()},
+    })
+
+
+def init_app(app, catalog, dispatcher):
+    # 共用 app.py 的菜單快取與派單器；由 app.py 傳入，避免 import app 造成循環
+    app.extensions['api'] = {'catalog': catalog, 'dispatcher': dispatcher}
+    app.register_blueprint(bp)
@@ -1,6 +1,32 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash
+from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, abort
 from werkzeug.security import generate_password_hash, check_password_hash
+import functools
+import logging
+import os
 import sqlite3
+import threading
+
+import click
+
+import api
+import archive
+import assets
+import cart
+import db
+import dispatch
+import events
+import exports
+import logs
+import metrics
+import migrations
+import notifications
+import order_state
+import ratings
+import search
+import settlements
+import versions
+from cache import CatalogCache
+from pagination import fetch_page, page_args, slice_page
 
 app = Flask(__name__, static_folder='static', static_url_path='/')
 app.secret_key = '123TyU%^&'
@@ -8,137 +34,272 @@ app.secret_key = '123TyU%^&'
 # 数据库名称
 DB_NAME = 'new_delivery.db'
 
-# 数据库连接
+app.config['DATABASE'] = os.environ.get('DELIVERY_DB', DB_NAME)
+# 連線池設定：WAL 模式讓讀取不擋寫入，busy_timeout 單位為毫秒
+app.config['DB_POOL_SIZE'] = int(os.environ.get('DELIVERY_DB_POOL_SIZE', 8))
+app.config['DB_BUSY_TIMEOUT'] = int(os.environ.get('DELIVERY_DB_BUSY_TIMEOUT', 5000))
+app.config['DB_SYNCHRONOUS'] = os.environ.get('DELIVERY_DB_SYNCHRONOUS', 'NORMAL')
+# busy_timeout 等完仍拿不到寫鎖時，寫入交易重試的次數與第一次退避的毫秒數
+app.config['DB_BUSY_RETRIES'] = int(os.environ.get('DELIVERY_DB_BUSY_RETRIES', 3))
+app.config['DB_BUSY_BACKOFF_MS'] = float(os.environ.get('DELIVERY_DB_BUSY_BACKOFF_MS', 10))
+# 慢查詢門檻（毫秒），超過的語句正規化後寫入 delivery.sql 日誌；0 表示關閉
+app.config['SLOW_QUERY_MS'] = float(os.environ.get('DELIVERY_SLOW_QUERY_MS', 100)) or None
+metrics.init_app(app)
+db.init_app(app)
+# 靜態檔案：flask build-assets 產生的雜湊檔名與預先壓縮檔放在 DELIVERY_ASSETS_DIR（預設 build/assets）
+app.config['ASSETS_DIR'] = os.environ.get('DELIVERY_ASSETS_DIR', os.path.join(app.root_path, 'build', 'assets'))
+# 有 manifest 時模板使用雜湊網址；開發中直接修改 static/ 時設 DELIVERY_ASSETS_USE_MANIFEST=0
+app.config['ASSETS_USE_MANIFEST'] = os.environ.get('DELIVERY_ASSETS_USE_MANIFEST', '1') == '1'
+assets.init_app(app)
+
+# 日誌：JSON 格式、背景執行緒寫出；DELIVERY_LOG_SAMPLING 可依 endpoint 抽樣 DEBUG / INFO
+app.config['LOG_LEVEL'] = os.environ.get('DELIVERY_LOG_LEVEL', 'INFO').upper()
+app.config['LOG_FILE'] = os.environ.get('DELIVERY_LOG_FILE')
+app.config['LOG_SAMPLING'] = os.environ.get('DELIVERY_LOG_SAMPLING')
+logs.init_app(app)
+log = logs.get_logger('app')
+
+# 列表分頁大小
+app.config['PAGE_SIZE'] = int(os.environ.get('DELIVERY_PAGE_SIZE', 20))
+app.config['MAX_PAGE_SIZE'] = 100
+
+# 菜單快取：TTL 為秒數，0 表示只靠寫入時失效
+app.config['CATALOG_CACHE_TTL'] = float(os.environ.get('DELIVERY_CATALOG_CACHE_TTL', 0)) or None
+app.config['CATALOG_CACHE_MAX_MERCHANTS'] = int(os.environ.get('DELIVERY_CATALOG_CACHE_MAX_MERCHANTS', 256))
+catalog = CatalogCache(max_merchants=app.config['CATALOG_CACHE_MAX_MERCHANTS'],
+                       ttl=app.config['CATALOG_CACHE_TTL'])
+
+# 自動派單：策略、每批最多指派幾張、每位外送員同時最多幾張進行中的配送
+app.config['DISPATCH_POLICY'] = os.environ.get('DELIVERY_DISPATCH_POLICY', 'least_loaded')
+app.config['DISPATCH_BATCH_SIZE'] = int(os.environ.get('DELIVERY_DISPATCH_BATCH_SIZE', 50))
+app.config['DISPATCH_MAX_ACTIVE'] = int(os.environ.get('DELIVERY_DISPATCH_MAX_ACTIVE', 2))
+# 結算 outbox：背景工作多久檢查一次（秒）、每批處理幾筆；DELIVERY_SETTLEMENT_WORKER=0 時只由 flask drain-settlements 處理
+app.config['SETTLEMENT_WORKER'] = os.environ.get('DELIVERY_SETTLEMENT_WORKER', '1') == '1'
+app.config['SETTLEMENT_INTERVAL'] = float(os.environ.get('DELIVERY_SETTLEMENT_INTERVAL', 1.0))
+app.config['SETTLEMENT_BATCH_SIZE'] = int(os.environ.get('DELIVERY_SETTLEMENT_BATCH_SIZE', 500))
+settlement_worker = settlements.SettlementWorker(app, interval=app.config['SETTLEMENT_INTERVAL'],
+                                                 batch_size=app.config['SETTLEMENT_BATCH_SIZE'])
+
+# 條件式 GET：列表頁帶 ETag，版本沒變時回 304。版本號在行程內，與事件匯流排一樣需要單一行程；
+# 多個 worker 行程時設 DELIVERY_CONDITIONAL_GET=0
+app.config['CONDITIONAL_GET'] = os.environ.get('DELIVERY_CONDITIONAL_GET', '1') == '1'
+versions.registry.source('catalog', catalog.token)
+
+# 統計與監控端點（/db_stats、/metrics 等）只給本機（Prometheus、維運腳本）或登入的結算管理員；
+# 逗號分隔的來源位址，設為空字串則只允許結算管理員。放在反向代理後面時代理的位址也算本機，需要自行限制
+STATS_ALLOWED_ADDRS = os.environ.get('DELIVERY_STATS_ALLOWED_ADDRS', '127.0.0.1,::1')
+app.config['STATS_ALLOWED_ADDRS'] = frozenset(addr.strip() for addr in STATS_ALLOWED_ADDRS.split(',') if addr.strip())
+
+dispatcher = dispatch.Dispatcher(policy=app.config['DISPATCH_POLICY'],
+                                 batch_size=app.config['DISPATCH_BATCH_SIZE'],
+                                 max_active=app.config['DISPATCH_MAX_ACTIVE'])
+
+# 行動 App 用的 JSON API（/api/v1）
+api.init_app(app, catalog, dispatcher)
+
+# 数据库连接（请求范围内共用同一条连线，请求结束时自动归还连线池）
 def get_db_connection():
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
-    return conn
-
-def init_db():
-    conn = get_db_connection()
-
-    # 創建用戶表
-    conn.execute('''CREATE TABLE IF NOT EXISTS users (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    username TEXT UNIQUE NOT NULL,
-                    password_hash TEXT NOT NULL,
-                    role TEXT NOT NULL)''')
-
-    # 創建菜單表
-    conn.execute('''CREATE TABLE IF NOT EXISTS menu (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    item_name TEXT NOT NULL,
-                    description TEXT NOT NULL,
-                    price REAL NOT NULL,
-                    merchant_id INTEGER NOT NULL,
-                    FOREIGN KEY (merchant_id) REFERENCES users (id))''')
-
-    # 創建訂單表
-    conn.execute('''CREATE TABLE IF NOT EXISTS orders (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    customer_id INTEGER NOT NULL,
-                    merchant_id INTEGER NOT NULL,
-                    delivery_person_id INTEGER,
-                    delivery_status TEXT  DEFAULT '待確認',
-                    item_id INTEGER NOT NULL,
-                    status TEXT NOT NULL,
-                    price REAL NOT NULL,
-                    item_name TEXT NOT NULL,
-                    acceptance_status TEXT DEFAULT '待確認',
-                    FOREIGN KEY (customer_id) REFERENCES users (id),
-                    FOREIGN KEY (merchant_id) REFERENCES users (id),
-                    FOREIGN KEY (delivery_person_id) REFERENCES users (id),
-                    FOREIGN KEY (item_id) REFERENCES menu (id))''')
-
-    # 創建店家的訂單表
-    conn.execute('''CREATE TABLE IF NOT EXISTS merchant_orders (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        order_id INTEGER,
-                        customer_id INTEGER NOT NULL,
-                        merchant_id INTEGER NOT NULL,
-                        item_id INTEGER NOT NULL,
-                        status TEXT NOT NULL,
-                        delivery_person_id INTEGER,
-                        delivery_status TEXT DEFAULT '未接單',
-                        acceptance_status TEXT DEFAULT '未處理',
-                        price REAL NOT NULL,
-                        item_name TEXT NOT NULL,
-                        FOREIGN KEY (customer_id) REFERENCES users (id),
-                        FOREIGN KEY (merchant_id) REFERENCES users (id),
-                        FOREIGN KEY (item_id) REFERENCES menu (id),
-                        FOREIGN KEY (order_id) REFERENCES orders (id))''')
-
-    # 創建外送訂單表
-    conn.execute('''CREATE TABLE IF NOT EXISTS delivery_orders (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    customer_id INTEGER NOT NULL,
-                    merchant_id INTEGER NOT NULL,
-                    merchant_order_id INTEGER,
-                    delivery_person_id INTEGER,
-                    item_id INTEGER NOT NULL,
-                    status TEXT NOT NULL,
-                    price REAL NOT NULL,
-                    item_name TEXT NOT NULL,
-                    FOREIGN KEY (customer_id) REFERENCES users (id),
-                    FOREIGN KEY (merchant_id) REFERENCES users (id),
-                    FOREIGN KEY (delivery_person_id) REFERENCES users (id),
-                    FOREIGN KEY (item_id) REFERENCES menu (id))''')
-    
-    conn.execute('''CREATE TABLE IF NOT EXISTS notifications(
-                    notification_id INTEGER PRIMARY  KEY AUTOINCREMENT,
-                    user_id INTEGRT,
-                    message TEXT,
-                    is_read BOOLEAN DEFAULT 0)''')
-
-    conn.execute('''CREATE TABLE IF NOT EXISTS transactions (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER NOT NULL,
-                    amount REAL NOT NULL,
-                    transaction_type TEXT NOT NULL,
-                    FOREIGN KEY (user_id) REFERENCES users (id))''')
-     
-    # 創建報告表 
-    conn.execute('''CREATE TABLE IF NOT EXISTS reports (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER NOT NULL,
-                    report_type TEXT NOT NULL,
-                    total_received REAL DEFAULT 0,
-                    total_orders INTEGER DEFAULT 0,
-                    total_due REAL DEFAULT 0,
-                    UNIQUE(user_id, report_type),
-                    FOREIGN KEY (user_id) REFERENCES users(id))''')
-    
-    conn.execute('''CREATE TABLE IF NOT EXISTS reviews (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        user_id INTEGER NOT NULL,
-                        reviewed_user_id INTEGER NOT NULL,
-                        order_id INTEGER NOT NULL,
-                        rating INTEGER NOT NULL,
-                        comment TEXT,
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        FOREIGN KEY (user_id) REFERENCES users (id),
-                        FOREIGN KEY (reviewed_user_id) REFERENCES users (id),
-                        FOREIGN KEY (order_id) REFERENCES orders (id))''')
-
+    return db.get_db()
+
+
+def conditional(*names):
+    # 列表頁的條件式 GET。names 是頁面用到的資源版本：catalog、ratings、delivery_board 是全域的，
+    # orders、cart、notifications 是目前使用者自己的。If-None-Match 相符時在查資料庫、渲染模板之前就回 304。
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method != 'GET' or not app.config['CONDITIONAL_GET']:
+                return view(*args, **kwargs)
+
+            user_id = session.get('user_id')
+            etag = versions.registry.etag(
+                request.endpoint, user_id, session.get('role'), request.query_string,
+                *(versions.registry.get(name, user_id) for name in names))
+            if request.if_none_match.contains_weak(etag):
+                metrics.registry.record_conditional(request.endpoint, True)
+                response = app.response_class(status=304)
+                response.set_etag(etag, weak=True)
+                response.headers['Cache-Control'] = 'private, no-cache'
+                return response
+
+            response = app.make_response(view(*args, **kwargs))
+            metrics.registry.record_conditional(request.endpoint, False)
+            # 只有正常渲染的頁面帶 ETag；轉址（未登入）或錯誤頁不帶
+            if response.status_code == 200:
+                response.set_etag(etag, weak=True)
+                response.headers['Cache-Control'] = 'private, no-cache'
+            return response
+        return wrapper
+    return decorator
+
+
+def internal_only(view):
+    # 統計資料含資料庫路徑與內部數字，不對外公開；其他來源一律 404
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if request.remote_addr not in app.config['STATS_ALLOWED_ADDRS'] and session.get('role') != 'settle':
+            abort(404)
+        return view(*args, **kwargs)
+    return wrapper
+
+
+# 測試帳號；密碼雜湊刻意很慢，只在帳號不存在時才計算
+SEED_USERS = [
+    ('merchant', 'merchant123', 'merchant'),
+    ('customer', 'customer123', 'customer'),
+    ('delivery', 'delivery123', 'delivery_person'),
+    ('settle', 'settle123', 'settle'),
+]
+
+
+def init_db(seed=True):
+    with db.get_pool(app).connection() as conn:
+        if migrations.pending(conn):
+            migrations.migrate(conn)
+        if seed and not _is_seeded(conn):
+            _seed_users(conn)
+
+
+def _is_seeded(conn):
+    row = conn.execute("SELECT value FROM app_meta WHERE key = 'seeded_at'").fetchone()
+    return row is not None
+
+
+def _seed_users(conn):
     # 添加测试用户
-    users = [
-        ('merchant', generate_password_hash('merchant123'), 'merchant'),
-        ('customer', generate_password_hash('customer123'), 'customer'),
-        ('delivery', generate_password_hash('delivery123'), 'delivery_person'),
-        ('settle', generate_password_hash('settle123'), 'settle')
-    ]
-
-    for user in users:
+    usernames = [username for username, _, _ in SEED_USERS]
+    placeholders = ','.join('?' * len(usernames))
+    existing = {row['username'] for row in conn.execute(
+        f'SELECT username FROM users WHERE username IN ({placeholders})', usernames)}
+
+    created = 0
+    for username, password, role in SEED_USERS:
+        if username in existing:
+            continue
         try:
-            conn.execute('INSERT INTO users (username, password_hash, role) VALUES (?, ?, ?)', user)
+            conn.execute('INSERT INTO users (username, password_hash, role) VALUES (?, ?, ?)',
+                         (username, generate_password_hash(password), role))
+            created += 1
         except sqlite3.IntegrityError:
             pass
 
+    conn.execute("INSERT OR REPLACE INTO app_meta (key, value) VALUES ('seeded_at', datetime('now'))")
     conn.commit()
-    conn.close()
-
-# 初始化数据库
-init_db()
+    return created
+
+
+# 延遲初始化：import 時不碰資料庫，第一個請求才檢查一次。
+# 正式環境部署時先執行 flask init-db，並把 AUTO_INIT_DB 設為 0。
+app.config['AUTO_INIT_DB'] = os.environ.get('DELIVERY_AUTO_INIT_DB', '1') == '1'
+_init_lock = threading.Lock()
+_initialized = False
+
+
+@app.before_request
+def ensure_initialized():
+    global _initialized
+    if _initialized:
+        return
+    with _init_lock:
+        if not _initialized:
+            if app.config['AUTO_INIT_DB']:
+                init_db()
+            if app.config['SETTLEMENT_WORKER']:
+                settlement_worker.start()
+            _initialized = True
+
+
+# 套用資料庫 migration（離線執行，不在啟動時改結構）
+@app.cli.command('migrate')
+@click.option('--to', 'target', type=int, default=None, help='只套用到指定版本')
+@click.option('--status', is_flag=True, help='只顯示目前版本與待套用的 migration')
+def migrate_command(target, status):
+    with db.get_pool(app).connection() as conn:
+        if status:
+            click.echo(f'目前版本：{migrations.current_version(conn)}，最新版本：{migrations.latest_version()}')
+            for version, name, _ in migrations.pending(conn):
+                click.echo(f'  待套用 {version}: {name}')
+            return
+        applied = migrations.migrate(conn, target)
+
+    for version, name in applied:
+        click.echo(f'已套用 {version}: {name}')
+    if not applied:
+        click.echo('資料庫已是最新版本')
+
+
+# 定期清理舊通知（預設只刪已讀的）
+@app.cli.command('prune-notifications')
+@click.option('--days', type=int, default=30, help='保留最近幾天的通知')
+@click.option('--batch-size', type=int, default=1000)
+@click.option('--include-unread', is_flag=True, help='連未讀的舊通知一起刪除')
+def prune_notifications_command(days, batch_size, include_unread):
+    with db.get_pool(app).connection() as conn:
+        deleted = notifications.prune(conn, days, batch_size, include_unread)
+    click.echo(f'已刪除 {deleted} 則通知')
+
+
+# 把完成超過 N 天的訂單搬到 orders_archive（分批交易），歷史頁面照常看得到
+@app.cli.command('archive-orders')
+@click.option('--days', type=int, default=30, help='完成超過幾天的訂單才封存')
+@click.option('--batch-size', type=int, default=500)
+@click.option('--status', is_flag=True, help='只顯示熱表、封存表與可封存的筆數')
+def archive_orders_command(days, batch_size, status):
+    with db.get_pool(app).connection() as conn:
+        if not status:
+            moved = archive.archive_completed(conn, days, batch_size)
+            click.echo(f'已封存 {moved} 筆訂單')
+        counts = archive.status(conn, days)
+    click.echo(f"orders：{counts['hot']} 筆，orders_archive：{counts['archived']} 筆，可封存：{counts['eligible']} 筆")
+
+
+# 手動清空結算 outbox（停用背景結算工作時，或部署前確認沒有積壓）
+@app.cli.command('drain-settlements')
+def drain_settlements_command():
+    with db.get_pool(app).connection() as conn:
+        before = settlements.outbox_status(conn)
+    drained = settlement_worker.drain_once()
+    click.echo(f"已處理 {drained} 筆待結算訂單（處理前積壓 {before['pending']} 筆，延遲 {before['lag_seconds']:.1f} 秒）")
+
+
+# 部署前建置靜態檔案（內容雜湊檔名 + gzip / brotli），服務重新啟動後改用新的 manifest
+@app.cli.command('build-assets')
+def build_assets_command():
+    previous = assets.load_manifest(app)
+    manifest = assets.build(app.static_folder, app.config['ASSETS_DIR'])
+    assets.load_manifest(app)
+    compressed = ', '.join(sorted({e for encodings in manifest['encodings'].values() for e in encodings})) or '無'
+    click.echo(f"已建置 {len(manifest['files'])} 個檔案到 {app.config['ASSETS_DIR']}（預先壓縮：{compressed}）")
+    if assets.brotli is None:
+        click.echo('未安裝 brotli，只產生 gzip（pip install brotli）')
+
+    # 上一版的網址必須仍然取得到，舊行程與瀏覽器快取的頁面才不會缺 CSS / JS
+    if previous is not None:
+        old_files = list(previous['files'].values())
+        missing = [name for name in old_files if not assets.reachable(app, name)]
+        if missing:
+            raise click.ClickException(f"上一版的靜態檔案無法取得：{', '.join(missing)}")
+        click.echo(f'上一版的 {len(old_files)} 個網址仍可取得')
+
+
+# 部署時執行一次：套用 migration 並建立測試帳號
+@app.cli.command('init-db')
+def init_db_command():
+    init_db()
+    click.echo('資料庫初始化完成')
+
+
+@app.cli.command('seed')
+@click.option('--force', is_flag=True, help='忽略已建立的紀錄，重新檢查測試帳號')
+def seed_command(force):
+    with db.get_pool(app).connection() as conn:
+        if migrations.pending(conn):
+            raise click.ClickException('資料庫結構不是最新版本，請先執行 flask migrate')
+        if _is_seeded(conn) and not force:
+            click.echo('測試帳號已建立')
+            return
+        created = _seed_users(conn)
+    click.echo(f'已建立 {created} 個測試帳號')
 
 
 # 登录功能
@@ -150,7 +311,6 @@ def login():
 
         conn = get_db_connection()
         user = conn.execute('SELECT * FROM users WHERE username = ?', (username,)).fetchone()
-        conn.close()
 
         if user and check_password_hash(user['password_hash'], password):
             session['user_id'] = user['id']
@@ -175,33 +335,38 @@ def login():
 # 登出功能
 @app.route('/logout', methods=['POST'])
 def logout():
+    if session.get('role') == 'delivery_person':
+        dispatcher.set_available(session['user_id'], False)
     session.clear()
     flash('您已成功登出。', 'success')
     return redirect(url_for('index'))
 
 # 首页
 @app.route('/', methods=['GET'])
+@conditional('catalog', 'notifications', 'cart')
 def index():
     logged_in = 'user_id' in session  # 判断是否登录
-    conn = get_db_connection()
-    
-    # 获取菜品列表
-    menu_items = conn.execute('SELECT * FROM menu').fetchall()
-    
-    # 获取用户的订单信息（如果已登录）
-    orders = []
-    if logged_in:
-        orders = conn.execute('''SELECT orders.id, menu.item_name, orders.status 
-                                 FROM orders
-                                 JOIN menu ON orders.item_id = menu.id
-                                 WHERE orders.customer_id = ?''', (session['user_id'],)).fetchall()
-    
-    conn.close()
+    cursor, size = page_args()
+
+    # 获取菜品列表（从快取读取，未登录的访客完全不会碰到数据库）
+    menu_items = catalog.all_items(lambda: get_db_connection().execute('SELECT * FROM menu ORDER BY id').fetchall())
+    page = slice_page(menu_items, cursor, size)
+
+    return render_template('index.html', menu_items=page.items, page=page, logged_in=logged_in)
+
 
-    return render_template('index.html', menu_items=menu_items, logged_in=logged_in, orders=orders)
+# 菜單搜尋：/search?q=牛肉麵&min_price=50&max_price=150，依相關度排序並分頁
+@app.route('/search', methods=['GET'])
+def search_menu():
+    query = search.parse_args(request.args)
+    size = page_args()[1]
+    page = search.search(get_db_connection(), query, request.args.get('cursor'), size)
+    return render_template('index.html', menu_items=page.items, page=page,
+                           logged_in='user_id' in session, query=query)
 
 
 @app.route('/menu', methods=['GET', 'POST'])
+@conditional('catalog', 'orders', 'ratings')
 def menu():
     if 'user_id' not in session or session['role'] != 'merchant':
         return redirect(url_for('login'))
@@ -218,30 +383,23 @@ def menu():
             (item_name, description, price, session['user_id'])
         )
         conn.commit()
+        catalog.invalidate()
         flash('菜品添加成功！', 'success')
         return redirect(url_for('menu'))
 
     # 獲取商家的菜品列表
-    menu_items = conn.execute('SELECT * FROM menu WHERE merchant_id = ?', (session['user_id'],)).fetchall()
+    # 與 /api/v1/menu 共用同一個快取項目，依 id 排序（API 的 keyset 分頁需要）
+    menu_items = catalog.merchant_items(session['user_id'], lambda: conn.execute(
+        'SELECT * FROM menu WHERE merchant_id = ? ORDER BY id', (session['user_id'],)).fetchall())
     
-    # 獲取商家的訂單列表，包含所有可能的訂單狀態
-    merchant_orders = conn.execute('''
-        SELECT mo.*, 
-               CASE 
-                   WHEN do.status = '已接單' THEN '已接單'
-                   WHEN do.status = '已送達' THEN '已送達'
-                   WHEN do.status = '取貨中' THEN '取貨中'
-                   WHEN mo.status = '已完成' THEN '已完成'
-                   ELSE '未接單' 
-               END AS delivery_status
-        FROM merchant_orders mo
-        LEFT JOIN delivery_orders do ON mo.id = do.merchant_order_id
-        WHERE mo.merchant_id = ?
-    ''', (session['user_id'],)).fetchall()
-    
-    conn.close()
+    # 獲取商家的訂單列表，包含所有可能的訂單狀態（新的在前，分頁）
+    cursor, size = page_args()
+    # merchant_orders 是 orders（含已封存訂單）的 view，狀態欄位直接來自 orders，不需要再 JOIN
+    page = fetch_page(conn, 'SELECT * FROM merchant_orders WHERE merchant_id = ?',
+                      (session['user_id'],), cursor, size)
 
-    return render_template('menu.html', menu_items=menu_items, merchant_orders=merchant_orders)
+    return render_template('menu.html', menu_items=menu_items, merchant_orders=page.items, page=page,
+                           rating=ratings.summary(conn, session['user_id']))
 
 
     
@@ -254,7 +412,7 @@ def delete_item(item_id):
     conn = get_db_connection()
     conn.execute('DELETE FROM menu WHERE id = ? AND merchant_id = ?', (item_id, session['user_id']))
     conn.commit()
-    conn.close()
+    catalog.invalidate()
 
     flash('菜品已删除！', 'success')
     return redirect(url_for('menu'))
@@ -275,12 +433,11 @@ def edit_item(item_id):
 
         conn.execute('UPDATE menu SET item_name = ?, description = ?, price = ? WHERE id = ? AND merchant_id = ?',(item_name, description, price, item_id, session['user_id']))
         conn.commit()
-        conn.close()
+        catalog.invalidate()
         flash('菜品更新成功！', 'success')
         return redirect(url_for('menu'))
 
     menu_item = conn.execute('SELECT * FROM menu WHERE id = ? AND merchant_id = ?',(item_id, session['user_id'])).fetchone()
-    conn.close()
 
     return render_template('edit_item.html', item=menu_item)
 
@@ -295,37 +452,23 @@ def confirm_for_delivery(order_id):
     cursor = conn.cursor()
 
     try:
-        # 獲取商家確認的訂單
-        order = cursor.execute('SELECT * FROM merchant_orders WHERE id = ?', (order_id,)).fetchone()
-        
-        if order is None:
-            print(f"No order found with id {order_id}")
+        # 更新訂單為已通知外送員，訂單即出現在外送員看板（delivery_orders view）
+        if not order_state.transition(conn, 'notify_courier', order_id, where={'merchant_id': session['user_id']}):
+            log.info('訂單不是商家已接單狀態，無法通知外送員', extra={'order_id': order_id})
             flash('未找到訂單！', 'danger')
             return redirect(url_for('menu'))
 
-
-        # 將訂單插入到外送訂單列表
-        print("Inserting into delivery_orders")
-        cursor.execute('''
-            INSERT INTO delivery_orders (customer_id, merchant_id, delivery_person_id, item_id, status, price, item_name)
-            VALUES (?, ?, ?, ?, ?, ?,  ?)
-        ''', (order['customer_id'], order['merchant_id'],  None, order['item_id'], '待配送', order['price'], order['item_name']))
-
-        # 確認插入的資料
-        inserted_order = cursor.execute('SELECT * FROM delivery_orders WHERE merchant_order_id = ?', (order_id,)).fetchone()
-        print(f"Inserted order details: {inserted_order}")
-
-        # 更新訂單為已通知外送員
-        cursor.execute('UPDATE merchant_orders SET delivery_status = "已通知" WHERE id = ?', (order_id,))
         conn.commit()
+        events.publish_orders(conn, order_id)
+        dispatcher.enqueue(order_id)
+        _dispatch_pending(conn)
         flash('订单已确认并发送给外送小哥！', 'success')
     except Exception as e:
-        print(f'發生錯誤：{e}')
+        log.exception('通知外送員失敗', extra={'order_id': order_id})
         flash(f'發生錯誤：{e}', 'danger')
         conn.rollback()
     finally:
         cursor.close()
-        conn.close()
 
     return redirect(url_for('menu'))
 
@@ -341,17 +484,18 @@ def merchant_accept_order(order_id):
 
     try:
         # 更新訂單為已接單
-        cursor.execute('UPDATE merchant_orders SET acceptance_status = "已接單" WHERE id = ?', (order_id,))
-        cursor.execute('UPDATE orders SET acceptance_status = "已接單" WHERE id = ?', (order_id,))
-        conn.commit()
-        flash('訂單已接收。', 'success')
+        if order_state.transition(conn, 'accept', order_id, where={'merchant_id': session['user_id']}):
+            conn.commit()
+            events.publish_orders(conn, order_id)
+            flash('訂單已接收。', 'success')
+        else:
+            flash('訂單狀態已變更，無法接單。', 'danger')
     except sqlite3.Error as e:
         flash(f'發生錯誤：{e}', 'danger')
-        print(f'SQLite Error: {e}')  # 打印錯誤信息到控制台
+        log.exception('商家接單失敗', extra={'order_id': order_id})
         conn.rollback()
     finally:
         cursor.close()
-        conn.close()
 
     return redirect(url_for('menu'))
 
@@ -369,24 +513,22 @@ def merchant_reject_order(order_id):
     cursor = conn.cursor()
 
     try:
-        print(f"Updating order {order_id} status to '已拒絕'")
-
-        cursor.execute('UPDATE merchant_orders SET acceptance_status = ? WHERE id = ?', ("已拒絕", order_id))
-        cursor.execute('UPDATE orders SET acceptance_status = ? WHERE id = ?', ("已拒絕", order_id))
+        updated = order_state.transition(conn, 'reject', order_id, where={'merchant_id': session['user_id']})
+        log.debug('商家拒絕訂單', extra={'order_id': order_id, 'updated': updated})
 
-        print("merchant_orders update result:", cursor.rowcount)
-        print("orders update result:", cursor.rowcount)
-
-        conn.commit()
-        flash('訂單已拒絕。', 'success')
+        if updated:
+            conn.commit()
+            events.publish_orders(conn, order_id)
+            flash('訂單已拒絕。', 'success')
+        else:
+            flash('訂單狀態已變更，無法拒絕。', 'danger')
 
     except sqlite3.Error as e:
         flash(f'發生錯誤：{e}', 'danger')
-        print(f'SQLite Error: {e}')
+        log.exception('商家拒絕訂單失敗', extra={'order_id': order_id})
         conn.rollback()
     finally:
         cursor.close()
-        conn.close()
 
     return redirect(url_for('menu'))  # 重定向到訂單頁面
 
@@ -397,25 +539,31 @@ def view_reviews(user_id):
     if 'user_id' not in session or session['role'] != 'merchant':
         return redirect(url_for('login'))
 
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    return _render_reviews('view_reviews.html', user_id)
 
-    reviews = cursor.execute('''
-        SELECT reviews.rating, reviews.comment, users.username, reviews.created_at
+
+# 評論列表：評分彙總直接讀 rating_aggregates，評論本身依 id 分頁（新的在前）
+def _render_reviews(template, user_id):
+    conn = get_db_connection()
+    cursor, size = page_args()
+    page = fetch_page(conn, '''
+        SELECT reviews.id, reviews.rating, reviews.comment, users.username, reviews.created_at,
+               orders.item_name
         FROM reviews
         JOIN users ON reviews.user_id = users.id
+        LEFT JOIN order_history AS orders ON reviews.order_id = orders.id
         WHERE reviews.reviewed_user_id = ?
-    ''', (user_id,)).fetchall()
-
-    cursor.close()
-    conn.close()
+    ''', (user_id,), cursor, size, column='reviews.id')
 
-    return render_template('view_reviews.html', reviews=reviews)
+    rating = ratings.summary(conn, user_id)
+    return render_template(template, reviews=page.items, page=page,
+                           rating=rating, histogram=ratings.histogram(rating))
 
 
 
 
 @app.route('/orders', methods=['GET'])
+@conditional('catalog', 'orders', 'notifications', 'cart')
 def orders():
     if 'user_id' not in session or session['role'] != 'customer':
         return redirect(url_for('login'))
@@ -423,39 +571,44 @@ def orders():
     conn = get_db_connection()
     cursor = conn.cursor()
 
+    cursor_id, size = page_args()
+
     try:
-        print("Executing orders query...")
-        orders = cursor.execute('''
+        page = fetch_page(cursor, '''
             SELECT orders.id AS id,
                    menu.item_name AS item_name,
                    menu.price AS price,
                    orders.status AS status,
+                   orders.state AS state,
                    orders.merchant_id AS merchant_id,
                    orders.delivery_person_id AS delivery_person_id,
                    orders.delivery_status AS delivery_status,
-                   merchant_orders.acceptance_status AS merchant_acceptance_status
-            FROM orders
+                   orders.acceptance_status AS merchant_acceptance_status
+            FROM order_history AS orders
             JOIN menu ON orders.item_id = menu.id
-            LEFT JOIN merchant_orders ON orders.id = merchant_orders.order_id
             WHERE orders.customer_id = ?
-        ''', (session['user_id'],)).fetchall()
+        ''', (session['user_id'],), cursor_id, size, column='orders.id')
+        orders = page.items
 
-        # 調試輸出查詢結果
-        for order in orders:
-            print(order)
+        # 調試輸出查詢結果（只有 DEBUG 等級才組欄位）
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('訂單列表', extra={'order_ids': [order['id'] for order in orders],
+                                       'statuses': [order['status'] for order in orders]})
 
-        # 只計算未確認的訂單金額
-        total_price = sum(order['price'] for order in orders if order['status'] != '已確認')
+        # 只計算未確認的訂單金額；合計所有未確認訂單，不只目前這一頁
+        total_price = cursor.execute('''
+            SELECT COALESCE(SUM(price), 0) FROM orders WHERE customer_id = ? AND status <> '已確認'
+        ''', (session['user_id'],)).fetchone()[0]
 
-        return render_template('orders.html', orders=orders, total_price=total_price)
+        return render_template('orders.html', orders=orders, total_price=total_price, page=page,
+                               placed_state=order_state.PLACED)
     except sqlite3.Error as e:
-        print(f'SQLite Error: {e}')
+        log.exception('查詢訂單列表失敗')
         flash(f'發生錯誤：{e}', 'danger')
     finally:
         cursor.close()
-        conn.close()
 
-    return render_template('orders.html', orders=[], total_price=0)
+    return render_template('orders.html', orders=[], total_price=0, page=None)
 
 
 
@@ -484,19 +637,19 @@ def place_order(item_id):
 
         # 创建订单
         cursor.execute('''
-            INSERT INTO orders (customer_id, merchant_id, item_id, item_name, price, status)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (session['user_id'], item['merchant_id'], item['id'], item_name, price, '待处理'))
+            INSERT INTO orders (customer_id, merchant_id, item_id, item_name, price, status, state)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (session['user_id'], item['merchant_id'], item['id'], item_name, price, '待处理', order_state.PLACED))
 
         conn.commit()
+        versions.registry.bump('orders', session['user_id'])
         flash('訂單已下單！', 'success')
     except sqlite3.Error as e:
         flash(f'SQLite Error: {e}', 'danger')
-        print(f'SQLite Error: {e}')
+        log.exception('下單失敗', extra={'item_id': item_id})
         conn.rollback()
     finally:
         cursor.close()
-        conn.close()
 
     return redirect(url_for('orders'))  # 重定向到订单页面
 
@@ -505,57 +658,135 @@ def place_order(item_id):
 
 
 
+# 購物車：加入、修改、移除都只寫 cart_items，結帳時才一次建立訂單
+@app.route('/cart', methods=['GET'])
+def view_cart():
+    if 'user_id' not in session or session['role'] != 'customer':
+        return redirect(url_for('login'))
+
+    lines = cart.items(get_db_connection(), session['user_id'])
+    total_price = sum(line['price'] * line['quantity'] for line in lines)
+    return render_template('cart.html', lines=lines, total_price=total_price)
+
+
+@app.route('/cart/add/<int:item_id>', methods=['POST'])
+def cart_add(item_id):
+    if 'user_id' not in session or session['role'] != 'customer':
+        return redirect(url_for('login'))
+
+    conn = get_db_connection()
+    quantity = max(1, request.form.get('quantity', 1, type=int) or 1)
+    added = cart.add(conn, session['user_id'], item_id, quantity)
+    conn.commit()
+    versions.registry.bump('cart', session['user_id'])
+
+    # static/cart.js 以 fetch 送出時只回傳數量，不必整頁重新載入
+    if request.accept_mimetypes.best == 'application/json':
+        if not added:
+            return jsonify({'error': '菜品不存在！'}), 404
+        return jsonify({'count': cart.count(conn, session['user_id'])})
+
+    flash('已加入購物車' if added else '菜品不存在！', 'success' if added else 'danger')
+    return redirect(request.referrer or url_for('index'))
+
+
+@app.route('/cart/update/<int:item_id>', methods=['POST'])
+def cart_update(item_id):
+    if 'user_id' not in session or session['role'] != 'customer':
+        return redirect(url_for('login'))
+
+    conn = get_db_connection()
+    quantity = request.form.get('quantity', 0, type=int) or 0
+    cart.update(conn, session['user_id'], item_id, quantity)
+    conn.commit()
+    versions.registry.bump('cart', session['user_id'])
+    return redirect(url_for('view_cart'))
+
+
+@app.route('/cart/remove/<int:item_id>', methods=['POST'])
+def cart_remove(item_id):
+    if 'user_id' not in session or session['role'] != 'customer':
+        return redirect(url_for('login'))
+
+    conn = get_db_connection()
+    cart.remove(conn, session['user_id'], item_id)
+    conn.commit()
+    versions.registry.bump('cart', session['user_id'])
+    return redirect(url_for('view_cart'))
+
+
+@app.route('/cart/checkout', methods=['POST'])
+def cart_checkout():
+    if 'user_id' not in session or session['role'] != 'customer':
+        return redirect(url_for('login'))
+
+    conn = get_db_connection()
+    try:
+        # 所有菜品一個交易、一次 executemany，訂單直接成為已確認，商家立即看得到
+        order_ids = db.write_transaction(conn, lambda c: cart.checkout(c, session['user_id']))
+    except sqlite3.Error as e:
+        log.exception('結帳失敗')
+        flash(f'SQLite Error: {e}', 'danger')
+        return redirect(url_for('view_cart'))
+
+    if not order_ids:
+        flash('購物車是空的！', 'warning')
+        return redirect(url_for('view_cart'))
+
+    log.info('購物車結帳', extra={'order_count': len(order_ids)})
+    versions.registry.bump('cart', session['user_id'])
+    events.publish_orders(conn, order_ids)
+    flash(f'已送出 {len(order_ids)} 筆訂單並通知商家！', 'success')
+    return redirect(url_for('orders'))
+
+
 @app.route('/delete_order/<int:order_id>', methods=['POST'])
 def delete_order(order_id):
     if 'user_id' not in session or session['role'] != 'customer':
-        print("User not authenticated or not a customer")
+        log.debug('未登入或不是顧客，無法刪除訂單', extra={'order_id': order_id})
         return redirect(url_for('login'))
 
     conn = get_db_connection()
-    print(f"Executing orders query for order ID: {order_id}")
 
     # 確認該訂單是否屬於當前用戶
     order = conn.execute(
-        'SELECT id, status FROM orders WHERE id = ? AND customer_id = ?',
+        'SELECT id, status, state, merchant_id, delivery_person_id FROM orders WHERE id = ? AND customer_id = ?',
         (order_id, session['user_id'])
     ).fetchone()
 
-    print(f"Order query result: {order}")
+    log.debug('刪除訂單查詢結果', extra={'order_id': order_id, 'order': dict(order) if order else None})
 
     if order:
-        print(f"Order found: {order}")
-
-        # 查詢第一筆訂單
-        first_order = conn.execute(
-            'SELECT id FROM orders WHERE customer_id = ? ORDER BY id ASC LIMIT 1',
-            (session['user_id'],)
-        ).fetchone()
-
-        if first_order:
-            print(f"First order for user ID {session['user_id']}: {dict(first_order)}")
-
-        # 嚴格比較第一筆訂單的 ID 和傳入的 order_id
-        if first_order and first_order['id'] == order_id:
-            conn.execute('DELETE FROM orders WHERE id = ? AND customer_id = ?', (order_id, session['user_id']))
-            conn.commit()
-            flash('第一筆訂單已刪除', 'success')
-
-        elif order['status'] == '已確認':
-            print(f"Order with ID {order_id} is confirmed and cannot be deleted")
-            flash('已確認的訂單無法刪除', 'danger')
-        else:
-            conn.execute('DELETE FROM orders WHERE id = ? AND customer_id = ?', (order_id, session['user_id']))
-            conn.commit()
+        # 商家、外送員的訂單列表與結算匯出都是 orders 的 view，只有顧客還沒確認的訂單可以刪除；
+        # 條件式 DELETE 比對狀態，查詢之後才被確認的訂單不會被刪掉
+        deleted = conn.execute('DELETE FROM orders WHERE id = ? AND customer_id = ? AND state = ?',
+                               (order_id, session['user_id'], order_state.PLACED)).rowcount
+        conn.commit()
+        if deleted:
+            _order_deleted(order)
             flash('訂單已刪除', 'success')
+        else:
+            log.info('已確認的訂單無法刪除', extra={'order_id': order_id, 'state': order['state']})
+            flash('已確認的訂單無法刪除', 'danger')
 
     else:
-        print(f"Order with ID {order_id} not found for user ID {session['user_id']}")
+        log.info('找不到要刪除的訂單', extra={'order_id': order_id})
         flash('訂單未找到', 'danger')
 
-    conn.close()
     return redirect(url_for('orders'))
 
 
+def _order_deleted(order):
+    # 刪除不會發布訂單事件，條件式 GET 的版本在這裡更新
+    versions.registry.bump('orders', session['user_id'], order['merchant_id'], order['delivery_person_id'])
+    if order['state'] in (order_state.READY, order_state.CLAIMED):
+        versions.registry.bump('delivery_board')
+
+
+
+# 每批最多幾個訂單 id（SQLite 舊版預設參數上限為 999）
+CONFIRM_CHUNK_SIZE = 500
+
 
 @app.route('/confirm_order', methods=['POST'])
 def confirm_order():
@@ -571,41 +802,24 @@ def confirm_order():
         flash('請選擇至少一個訂單來確認下單！', 'warning')
         return redirect(url_for('orders'))
 
+    # 去掉重複與非數字的 id，分批處理以避開 SQLite 的參數數量上限
+    order_ids = list(dict.fromkeys(int(order_id) for order_id in order_ids if order_id.isdigit()))
+
     try:
-        for order_id in order_ids:
-            # 獲取訂單信息
-            order = cursor.execute('''
-                SELECT orders.id AS id,
-                       orders.customer_id AS customer_id,
-                       orders.merchant_id AS merchant_id,
-                       orders.item_id AS item_id,
-                       menu.item_name AS item_name,
-                       menu.price AS price,
-                       orders.status AS status
-                FROM orders
-                JOIN menu ON orders.item_id = menu.id
-                WHERE orders.id = ? AND orders.customer_id = ?
-            ''', (order_id, session['user_id'])).fetchone()
-
-            if order:
-                # 插入訂單到 merchant_orders 表，使用相同的訂單 ID
-                cursor.execute('''
-                    INSERT INTO merchant_orders (order_id, customer_id, merchant_id, item_id, item_name, price, status, acceptance_status)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                ''', (order['id'], order['customer_id'], order['merchant_id'], order['item_id'], order['item_name'], order['price'], '已確認', '待處理'))
-                
-                # 更新 orders 表中訂單的狀態
-                cursor.execute('UPDATE orders SET status = "已確認" WHERE id = ?', (order['id'],))
+        for start in range(0, len(order_ids), CONFIRM_CHUNK_SIZE):
+            chunk = order_ids[start:start + CONFIRM_CHUNK_SIZE]
+            # 整批訂單一個 UPDATE 轉為已確認，商家即可在 merchant_orders view 看到；已確認過的不受影響
+            order_state.transition(conn, 'confirm', chunk, where={'customer_id': session['user_id']})
 
         conn.commit()
+        events.publish_orders(conn, order_ids)
         flash('訂單已確認並通知商家！', 'success')
     except sqlite3.Error as e:
         flash(f'SQLite Error: {e}', 'danger')
-        print(f'SQLite Error: {e}')
+        log.exception('確認訂單失敗', extra={'order_count': len(order_ids)})
         conn.rollback()
     finally:
         cursor.close()
-        conn.close()
 
     return redirect(url_for('orders'))
 
@@ -617,33 +831,37 @@ def add_review(order_id):
     if 'user_id' not in session or session['role'] != 'customer':
         return redirect(url_for('login'))
 
-    rating = request.form['rating']
+    # 評分彙總只統計 1～5 星
+    rating = ratings.valid_rating(request.form['rating'])
     comment = request.form['comment']
     reviewed_user_id = request.form['reviewed_user_id']
 
     if not reviewed_user_id:
         flash('請選擇一個評論對象', 'danger')
         return redirect(url_for('orders'))
+    if rating is None:
+        flash('評分必須是 1 到 5 的整數', 'danger')
+        return redirect(url_for('orders'))
 
     conn = get_db_connection()
     cursor = conn.cursor()
 
     try:
-        # 插入評論
+        # 插入評論；被評論者的評分彙總由觸發器同步累加
         cursor.execute('''
             INSERT INTO reviews (user_id, reviewed_user_id, order_id, rating, comment)
             VALUES (?, ?, ?, ?, ?)
         ''', (session['user_id'], reviewed_user_id, order_id, rating, comment))
 
         conn.commit()
+        versions.registry.bump('ratings')
         flash('評論已提交。', 'success')
     except sqlite3.Error as e:
         flash(f'發生錯誤：{e}', 'danger')
-        print(f'SQLite Error: {e}')  # 打印錯誤信息到控制台
+        log.exception('新增評論失敗', extra={'order_id': order_id})
         conn.rollback()
     finally:
         cursor.close()
-        conn.close()
 
     return redirect(url_for('orders'))
 
@@ -655,73 +873,25 @@ def confirm_receipt(order_id):
         return redirect(url_for('login'))
 
     conn = get_db_connection()
-    cursor = conn.cursor()
 
     try:
-        # 更新訂單狀態為已完成
-        cursor.execute('UPDATE orders SET status = "已完成" WHERE id = ?', (order_id,))
-        
-        # 確認外送訂單存在並更新狀態為已送達
-        order = cursor.execute('SELECT * FROM orders WHERE id = ?', (order_id,)).fetchone()
-        delivery_order_id = order['delivery_person_id']  # 假設此欄位包含 delivery_order_id
-        delivery_order = cursor.execute('SELECT * FROM delivery_orders WHERE id = ?', (delivery_order_id,)).fetchone()
-        if delivery_order:
-            print(f"Delivery order found: {delivery_order}")
-            cursor.execute('UPDATE delivery_orders SET status = "已完成" WHERE id = ?', (order_id,))
-        else:
-            print(f"No delivery order found with id {delivery_order_id}")
-            flash('未找到外送訂單。', 'danger')
-
-        # 更新商家訂單狀態為已完成
-        cursor.execute('UPDATE merchant_orders SET status = "已完成" WHERE order_id = ?', (order_id,))
+        # 更新訂單狀態為已完成（只有已送達的訂單可以確認收貨），商家與外送員的 view 同步反映
+        if not order_state.transition(conn, 'complete', order_id, where={'customer_id': session['user_id']}):
+            flash('訂單尚未送達，無法確認收貨。', 'danger')
+            return redirect(url_for('orders'))
 
-        # 更新報告資料
-        merchant_income = order['price'] * 0.8
-        delivery_person_income = order['price'] * 0.2
-
-        # 將訂單完成的紀錄插入到交易表中
-        cursor.execute('''
-            INSERT INTO transactions (user_id, amount, transaction_type)
-            SELECT customer_id, price, 'order_completed'
-            FROM orders WHERE id = ?
-        ''', (order_id,))
-
-        # 更新商家報告
-        cursor.execute('''
-            INSERT INTO reports (user_id, report_type, total_received)
-            VALUES (?, '商家', ?)
-            ON CONFLICT(user_id, report_type) DO UPDATE SET
-            total_received = total_received + excluded.total_received
-        ''', (order['merchant_id'], merchant_income))
-
-        # 更新外送員報告
-        if order['delivery_person_id']:
-            cursor.execute('''
-                INSERT INTO reports (user_id, report_type, total_orders, total_received)
-                VALUES (?, '外送員', 1, ?)
-                ON CONFLICT(user_id, report_type) DO UPDATE SET
-                total_orders = total_orders + 1,
-                total_received = total_received + excluded.total_received
-            ''', (order['delivery_person_id'], delivery_person_income))
-
-        # 更新客戶報告
-        cursor.execute('''
-            INSERT INTO reports (user_id, report_type, total_due)
-            VALUES (?, '客戶', ?)
-            ON CONFLICT(user_id, report_type) DO UPDATE SET
-            total_due = total_due + excluded.total_due
-        ''', (order['customer_id'], order['price']))
+        # 交易紀錄、帳本與報告交給背景結算工作，這個交易只多寫一列 outbox
+        settlements.enqueue(conn, order_id)
 
         conn.commit()
+        settlement_worker.wake()
+        events.publish_orders(conn, order_id)
         flash('訂單已完成，感謝您的確認。', 'success')
 
     except Exception as e:
         flash(f'發生錯誤：{e}', 'danger')
-        print(f'發生錯誤：{e}')  # 調試用的詳細錯誤訊息
+        log.exception('確認收貨失敗', extra={'order_id': order_id})
         conn.rollback()
-    finally:
-        cursor.close()
-        conn.close()
 
     return redirect(url_for('orders'))
 
@@ -734,52 +904,98 @@ def confirm_receipt(order_id):
 
 
 @app.route('/delivery_orders', methods=['GET'])
+@conditional('delivery_board', 'ratings')
 def delivery_orders():
     if 'user_id' not in session or session['role'] != 'delivery_person':
         return redirect(url_for('login'))
 
+    # 只列出還沒有外送員的訂單（走 idx_orders_state）；自己接的訂單在 /my_deliveries
     conn = get_db_connection()
-    orders = conn.execute('''
+    cursor, size = page_args()
+    page = fetch_page(conn, '''
         SELECT delivery_orders.id AS id,
                delivery_orders.customer_id AS customer_id,
                users.username AS customer_name,
+               delivery_orders.merchant_id AS merchant_id,
+               merchants.username AS merchant_name,
                delivery_orders.item_name AS item_name,
                delivery_orders.price AS price,
                delivery_orders.status AS status
         FROM delivery_orders
         JOIN users ON delivery_orders.customer_id = users.id
-        WHERE delivery_orders.status IN ('待配送', '已接單', '取貨中', '已送達', '已完成')
-    ''').fetchall()
-    conn.close()
+        JOIN users AS merchants ON delivery_orders.merchant_id = merchants.id
+        WHERE delivery_orders.status = ?
+    ''', (order_state.READY,), cursor, size, column='delivery_orders.id')
 
-    return render_template('delivery_orders.html', delivery_orders=orders)
+    # 商家評分徽章：整頁一次主鍵查詢
+    merchant_ratings = ratings.for_users(conn, [order['merchant_id'] for order in page.items])
+    return render_template('delivery_orders.html', delivery_orders=page.items, page=page,
+                           merchant_ratings=merchant_ratings,
+                           rating=ratings.summary(conn, session['user_id']))
 
 
-@app.route('/deliver_order/<int:order_id>', methods=['POST'])
-def deliver_order(order_id):
+# 外送員自己進行中的配送，以及自動派單的上線狀態
+@app.route('/my_deliveries', methods=['GET'])
+def my_deliveries():
     if 'user_id' not in session or session['role'] != 'delivery_person':
         return redirect(url_for('login'))
 
     conn = get_db_connection()
+    deliveries = dispatch.active_deliveries(conn, session['user_id'])
+    merchant_ratings = ratings.for_users(conn, [order['merchant_id'] for order in deliveries])
+    return render_template('my_deliveries.html', deliveries=deliveries, merchant_ratings=merchant_ratings,
+                           available=dispatcher.is_available(session['user_id']),
+                           max_active=dispatcher.max_active)
+
+
+@app.route('/my_deliveries/availability', methods=['POST'])
+def delivery_availability():
+    if 'user_id' not in session or session['role'] != 'delivery_person':
+        return redirect(url_for('login'))
+
+    available = request.form.get('available') == '1'
+    dispatcher.set_available(session['user_id'], available)
+    log.info('外送員切換派單狀態', extra={'available': available})
+    if available:
+        _dispatch_pending(get_db_connection())
+        flash('已上線，系統會自動派單給您', 'success')
+    else:
+        flash('已下線，不會再收到自動派單', 'success')
+    return redirect(url_for('my_deliveries'))
+
+
+def _dispatch_pending(conn):
+    # 派單失敗不影響觸發它的操作，訂單留在佇列等下一次
     try:
-        print(f"Updating order id: {order_id} with delivery_person_id: {session['user_id']}")
+        assigned = dispatcher.dispatch(conn)
+    except Exception:
+        log.exception('自動派單失敗')
+        return
+    if assigned:
+        log.info('自動派單', extra={'assigned': len(assigned), 'policy': dispatcher.policy})
 
-        # 更新訂單狀態為已接單
-        conn.execute('UPDATE orders SET delivery_status = "已接單", delivery_person_id = ? WHERE id = ?', (session['user_id'], order_id))
-        print("Updated orders table")
 
-        conn.execute('UPDATE delivery_orders SET status = "已接單", delivery_person_id = ? WHERE id = ?', (session['user_id'], order_id))
-        conn.execute('UPDATE merchant_orders SET delivery_status = "已接單" , delivery_person_id=? WHERE id = ?', (session['user_id'],order_id,))
-        print("Updated delivery_orders table")
-        
-        conn.commit()
-        flash('訂單已接單，請前往取貨', 'success')
+@app.route('/deliver_order/<int:order_id>', methods=['POST'])
+def deliver_order(order_id):
+    if 'user_id' not in session or session['role'] != 'delivery_person':
+        return redirect(url_for('login'))
+
+    conn = get_db_connection()
+    try:
+        # 搶單：只有仍是待配送的訂單會被更新（compare-and-set），多位外送員同時按下只有一位成功；
+        # 寫鎖競爭時整個交易退避重試
+        claimed = db.write_transaction(conn, lambda c: order_state.transition(
+            c, 'claim', order_id, assign={'delivery_person_id': session['user_id']}))
+        log.info('外送員搶單', extra={'order_id': order_id, 'claimed': bool(claimed)})
+        if claimed:
+            dispatcher.discard(order_id)
+            events.publish_orders(conn, order_id)
+            flash('訂單已接單，請前往取貨', 'success')
+            return redirect(url_for('my_deliveries'))
+        flash('訂單已被接走或狀態已變更。', 'danger')
     except Exception as e:
         flash(f'發生錯誤：{e}', 'danger')
-        print(f'Error occurred: {e}')
-        conn.rollback()
-    finally:
-        conn.close()
+        log.exception('外送員接單失敗', extra={'order_id': order_id})
 
     return redirect(url_for('delivery_orders'))
 
@@ -792,30 +1008,22 @@ def pickup_order(order_id):
 
     conn = get_db_connection()
     try:
-        # 更新 orders 表中的 delivery_status
-        conn.execute('UPDATE orders SET delivery_status = "取貨中" WHERE id = ?', (order_id,))
-        
-        # 更新 delivery_orders 表中的狀態
-        conn.execute('UPDATE delivery_orders SET status = "取貨中" WHERE id = ?', (order_id,))
-        conn.execute('UPDATE merchant_orders SET delivery_status = "取貨中" WHERE id = ?', (order_id,))
-        
-        conn.commit()
-        flash('訂單取貨中，請前往送達', 'success')
+        # 更新訂單狀態為取貨中（只限自己接的訂單）
+        if not order_state.transition(conn, 'pickup', order_id, where={'delivery_person_id': session['user_id']}):
+            flash('訂單狀態已變更，無法取貨。', 'danger')
+            return redirect(url_for('my_deliveries'))
 
-        # 通知顧客訂單正在取貨
-        customer_id = conn.execute('SELECT customer_id FROM delivery_orders WHERE id = ?', (order_id,)).fetchone()['customer_id']
-        conn.execute('''
-            INSERT INTO notifications (user_id, message)
-            VALUES (?, ?)
-        ''', (customer_id, f'您的訂單正在取貨中，即將送達。訂單編號：{order_id}'))
+        # 通知顧客訂單正在取貨，與狀態變更同一個交易
+        notifications.notify_customer(conn, 'pickup', order_id)
         conn.commit()
+        events.publish_orders(conn, order_id)
+        notifications.publish_customer_unread(conn, order_id)
+        flash('訂單取貨中，請前往送達', 'success')
     except Exception as e:
         flash(f'發生錯誤：{e}', 'danger')
         conn.rollback()
-    finally:
-        conn.close()
 
-    return redirect(url_for('delivery_orders'))
+    return redirect(url_for('my_deliveries'))
 
 
 @app.route('/complete_delivery/<int:order_id>', methods=['POST'])
@@ -825,27 +1033,24 @@ def complete_delivery(order_id):
 
     conn = get_db_connection()
     try:
-        # 更新訂單狀態為已送達
-        conn.execute('UPDATE orders SET delivery_status = "已送達" WHERE id = ?', (order_id,))
-        conn.execute('UPDATE delivery_orders SET status = "已送達" WHERE id = ?', (order_id,))
-        conn.execute('UPDATE merchant_orders SET delivery_status = "已送達" WHERE id = ?', (order_id,))
-        conn.commit()
-        flash('訂單已送達，感謝您的辛勤工作', 'success')
+        # 更新訂單狀態為已送達（只限自己接的訂單）
+        if not order_state.transition(conn, 'deliver', order_id, where={'delivery_person_id': session['user_id']}):
+            flash('訂單狀態已變更，無法完成送達。', 'danger')
+            return redirect(url_for('my_deliveries'))
 
         # 通知顧客訂單已送達
-        customer_id = conn.execute('SELECT customer_id FROM delivery_orders WHERE id = ?', (order_id,)).fetchone()['customer_id']
-        conn.execute('''
-            INSERT INTO notifications (user_id, message)
-            VALUES (?, ?)
-        ''', (customer_id, f'您的訂單已送達，請確認收貨並進行評價。訂單編號：{order_id}'))
+        notifications.notify_customer(conn, 'deliver', order_id)
         conn.commit()
+        events.publish_orders(conn, order_id)
+        notifications.publish_customer_unread(conn, order_id)
+        # 外送員空出手，可以再派下一張
+        _dispatch_pending(conn)
+        flash('訂單已送達，感謝您的辛勤工作', 'success')
     except Exception as e:
         flash(f'發生錯誤：{e}', 'danger')
         conn.rollback()
-    finally:
-        conn.close()
 
-    return redirect(url_for('delivery_orders'))
+    return redirect(url_for('my_deliveries'))
 
 
 
@@ -854,61 +1059,205 @@ def view_delivery_reviews(user_id):
     if 'user_id' not in session or session['role'] != 'delivery_person':
         return redirect(url_for('login'))
 
+    return _render_reviews('re.html', user_id)
+
+
+
+
+@app.route('/view_reports', methods=['GET'])
+def view_reports():
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
+
     conn = get_db_connection()
-    cursor = conn.cursor()
 
-    reviews = cursor.execute('''
-        SELECT reviews.rating, reviews.comment, users.username, reviews.created_at
-        FROM reviews
-        JOIN users ON reviews.user_id = users.id
-        WHERE reviews.reviewed_user_id = ?
-    ''', (user_id,)).fetchall()
+    # 沒有指定期間時讀累計報告；有期間時由日、週、月彙總表加總，一次查詢取得三種報告
+    start, end = settlements.parse_range(request.args)
+    reports = settlements.totals(conn, start, end)
 
-    cursor.close()
-    conn.close()
+    return render_template('reports.html',
+                           merchant_reports=reports[settlements.MERCHANT],
+                           delivery_reports=reports[settlements.COURIER],
+                           customer_reports=reports[settlements.CUSTOMER],
+                           start=start, end=end)
 
-    return render_template('re.html', reviews=reviews)
 
+# 結算資料匯出：/export/ledger?format=jsonl&start=2024-01-01&end=2024-01-31
+@app.route('/export/<dataset>', methods=['GET'])
+def export_settlements(dataset):
+    if 'user_id' not in session or session['role'] != 'settle':
+        return redirect(url_for('login'))
 
+    fmt = request.args.get('format', 'csv')
+    if dataset not in exports.DATASETS or fmt not in exports.FORMATS:
+        return jsonify({'error': '不支援的匯出資料或格式'}), 404
 
+    start, end = settlements.parse_range(request.args)
+    # 產生器自行向連線池借連線，回應開始傳送後請求範圍的連線就已歸還
+    response = app.response_class(exports.stream(db.get_pool(), dataset, fmt, start, end),
+                                  content_type=exports.FORMATS[fmt])
+    response.headers['Content-Disposition'] = f'attachment; filename={dataset}.{fmt}'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
 
-@app.route('/view_reports', methods=['GET'])
-def view_reports():
+
+# 通知收件匣
+@app.route('/notifications', methods=['GET'])
+def notification_inbox():
     if 'user_id' not in session:
         return redirect(url_for('login'))
 
     conn = get_db_connection()
+    cursor, size = page_args()
+    page = fetch_page(conn, '''
+        SELECT notification_id, message, is_read, created_at
+        FROM notifications
+        WHERE user_id = ?
+    ''', (session['user_id'],), cursor, size, key='notification_id')
 
-    # 查詢商家報告
-    merchant_reports = conn.execute('''
-        SELECT users.username AS merchant_name, reports.total_received
-        FROM reports
-        JOIN users ON reports.user_id = users.id
-        WHERE reports.report_type = '商家'
-    ''').fetchall()
-
-    # 查詢外送員報告
-    delivery_reports = conn.execute('''
-        SELECT users.username AS delivery_name, reports.total_orders, reports.total_received
-        FROM reports
-        JOIN users ON reports.user_id = users.id
-        WHERE reports.report_type = '外送員'
-    ''').fetchall()
-
-    # 查詢客戶報告
-    customer_reports = conn.execute('''
-        SELECT users.username AS customer_name, reports.total_due
-        FROM reports
-        JOIN users ON reports.user_id = users.id
-        WHERE reports.report_type = '客戶'
-    ''').fetchall()
-
-    conn.close()
+    return render_template('notifications.html', notifications=page.items, page=page)
 
-    return render_template('reports.html',
-                           merchant_reports=merchant_reports,
-                           delivery_reports=delivery_reports,
-                           customer_reports=customer_reports)
+
+# 未讀數（徽章用，讀取維護好的計數，不做 COUNT(*)）
+@app.route('/notifications/unread_count', methods=['GET'])
+def notification_unread_count():
+    if 'user_id' not in session:
+        return jsonify({'error': 'login required'}), 401
+    return jsonify({'unread': notifications.unread_count(get_db_connection(), session['user_id'])})
+
+
+# 批次標為已讀：勾選的通知，或 all=1 全部
+@app.route('/notifications/mark_read', methods=['POST'])
+def notification_mark_read():
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
+
+    conn = get_db_connection()
+    if request.form.get('all') == '1':
+        notification_ids = None
+    else:
+        notification_ids = [int(i) for i in request.form.getlist('notification_ids') if i.isdigit()]
+
+    try:
+        notifications.mark_read(conn, session['user_id'], notification_ids)
+        conn.commit()
+        notifications.publish_unread(conn, session['user_id'])
+    except sqlite3.Error as e:
+        flash(f'發生錯誤：{e}', 'danger')
+        log.exception('標記通知已讀失敗')
+        conn.rollback()
+
+    return redirect(url_for('notification_inbox'))
+
+
+@app.context_processor
+def inject_unread_notifications():
+    # 只有模板真的呼叫時才查詢，未登入的頁面不會碰資料庫
+    def unread_notifications():
+        if 'user_id' not in session:
+            return 0
+        return notifications.unread_count(get_db_connection(), session['user_id'])
+    return {'unread_notifications': unread_notifications}
+
+
+@app.context_processor
+def inject_cart_count():
+    def cart_count():
+        if session.get('role') != 'customer':
+            return 0
+        return cart.count(get_db_connection(), session['user_id'])
+    return {'cart_count': cart_count}
+
+
+# 訂單即時事件（Server-Sent Events）：外送員看板、商家訂單、顧客訂單
+@app.route('/events', methods=['GET'])
+def order_events():
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
+
+    topics = events.topics_for(session['role'], session['user_id'])
+    last_event_id = request.headers.get('Last-Event-ID', type=int)
+    subscription = events.bus.subscribe(topics, last_event_id)
+
+    response = app.response_class(events.bus.stream(subscription), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+# 連線池統計
+@app.route('/db_stats', methods=['GET'])
+@internal_only
+def db_stats():
+    return jsonify(db.get_pool().stats())
+
+
+# 菜單快取統計
+@app.route('/cache_stats', methods=['GET'])
+@internal_only
+def cache_stats():
+    return jsonify({**catalog.stats(), 'conditional_get': metrics.registry.conditional_stats()})
+
+
+# 結算 outbox 積壓與背景工作統計
+@app.route('/settlement_stats', methods=['GET'])
+@internal_only
+def settlement_stats():
+    return jsonify({**settlements.outbox_status(get_db_connection()), **settlement_worker.stats()})
+
+
+# 派單佇列統計
+@app.route('/dispatch_stats', methods=['GET'])
+@internal_only
+def dispatch_stats():
+    return jsonify(dispatcher.stats())
+
+
+# 連線池、菜單快取、事件匯流排的即時數字，輸出 /metrics 時才讀取
+def _runtime_metrics():
+    pool = db.get_pool(app).stats()
+    cache = catalog.stats()
+    bus = events.bus.stats()
+    log_stats = logs.stats()
+    dispatch_stats = dispatcher.stats()
+    settlement = settlement_worker.stats()
+    with db.get_pool(app).connection() as conn:
+        outbox = settlements.outbox_status(conn)
+    return [
+        ('db_pool_connections_in_use', 'gauge', '借出中的連線數', pool['in_use']),
+        ('db_pool_connections_idle', 'gauge', '閒置的連線數', pool['idle']),
+        ('db_pool_acquired_total', 'counter', '借出連線次數', pool['acquired']),
+        ('db_pool_waits_total', 'counter', '連線池用盡需要等待的次數', pool['waits']),
+        ('db_busy_errors_total', 'counter', 'SQLITE_BUSY / SQLITE_LOCKED 錯誤數', pool['busy_errors']),
+        ('db_busy_retries_total', 'counter', '寫入交易因 SQLITE_BUSY 重試的次數', pool['busy_retries']),
+        ('catalog_cache_hits_total', 'counter', '菜單快取命中數', cache['hits']),
+        ('catalog_cache_misses_total', 'counter', '菜單快取未命中數', cache['misses']),
+        ('events_subscribers', 'gauge', '連線中的 SSE 訂閱者', bus['subscribers']),
+        ('events_published_total', 'counter', '已發布的事件數', bus['published']),
+        ('dispatch_queue_size', 'gauge', '等待派單的訂單數', dispatch_stats['queued']),
+        ('dispatch_available_couriers', 'gauge', '上線等待派單的外送員數', dispatch_stats['available_couriers']),
+        ('dispatch_assigned_total', 'counter', '自動派單成功的訂單數', dispatch_stats['assigned']),
+        ('dispatch_conflicts_total', 'counter', '派單時訂單已被接走的次數', dispatch_stats['conflicts']),
+        ('settlement_outbox_pending', 'gauge', '等待結算的完成訂單數', outbox['pending']),
+        ('settlement_outbox_lag_seconds', 'gauge', '最舊一筆待結算訂單已等待的秒數', outbox['lag_seconds']),
+        ('settlement_drained_total', 'counter', '背景結算已處理的訂單數', settlement['drained']),
+        ('settlement_batches_total', 'counter', '背景結算執行的批次數', settlement['batches']),
+        ('settlement_errors_total', 'counter', '背景結算失敗次數', settlement['errors']),
+        ('settlement_last_drain_lag_seconds', 'gauge', '上一批最舊訂單從完成到結算的秒數',
+         settlement['last_drain_lag_seconds']),
+        ('log_queue_size', 'gauge', '等待寫出的日誌筆數', log_stats['queued']),
+        ('log_dropped_total', 'counter', '日誌佇列已滿而丟棄的筆數', log_stats['dropped']),
+    ]
+
+
+metrics.registry.add_collector(_runtime_metrics)
+
+
+# Prometheus 指標
+@app.route('/metrics', methods=['GET'])
+@internal_only
+def prometheus_metrics():
+    return app.response_class(metrics.registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
 
 
 
@@ -0,0 +1,54 @@
+# 已完成訂單的冷熱分離
+# 完成超過 N 天的訂單分批從 orders 搬到 orders_archive（同一個資料庫，每批一個寫入交易，
+# 搬移與刪除同時成功或同時回滾），orders 與它的索引只留下進行中與近期的訂單。
+# 歷史頁面（顧客訂單、商家訂單、評論、匯出、API）讀 order_history view（orders UNION ALL orders_archive），
+# 不必知道訂單在哪一張表；頁面內容不變，條件式 GET 的版本也不必更新。
+# 還在結算 outbox 裡等待記帳的訂單先不搬。
+# 執行方式：flask archive-orders --days 30
+import db
+import order_state
+
+# orders 與 orders_archive 共有的欄位（order_history view 的欄位）
+COLUMNS = ('id, customer_id, merchant_id, delivery_person_id, item_id, item_name, price, '
+           'status, acceptance_status, delivery_status, state, state_changed_at')
+
+
+def eligible(conn, days, limit):
+    # state_changed_at 是 UTC，與 datetime('now') 同一個時區；走 idx_orders_state
+    return [row['id'] for row in conn.execute('''
+        SELECT id FROM orders
+        WHERE state = ? AND state_changed_at < datetime('now', ?)
+          AND NOT EXISTS (SELECT 1 FROM settlement_outbox WHERE settlement_outbox.order_id = orders.id)
+        ORDER BY id LIMIT ?
+    ''', (order_state.COMPLETED, f'-{int(days)} days', limit))]
+
+
+def _move(conn, order_ids):
+    placeholders = ','.join('?' * len(order_ids))
+    # 交易內再確認一次狀態，選出之後才變動的訂單不會被搬走
+    conn.execute(f'''
+        INSERT INTO orders_archive ({COLUMNS})
+        SELECT {COLUMNS} FROM orders WHERE id IN ({placeholders}) AND state = ?
+    ''', (*order_ids, order_state.COMPLETED))
+    return conn.execute(f'DELETE FROM orders WHERE id IN ({placeholders}) AND state = ?',
+                        (*order_ids, order_state.COMPLETED)).rowcount
+
+
+def archive_completed(conn, days, batch_size=500):
+    # 每批一個短交易，不會長時間握住寫鎖；回傳搬移的訂單數
+    moved = 0
+    while True:
+        order_ids = eligible(conn, days, batch_size)
+        if not order_ids:
+            return moved
+        moved += db.write_transaction(conn, lambda c: _move(c, order_ids))
+        if len(order_ids) < batch_size:
+            return moved
+
+
+def status(conn, days):
+    return {
+        'hot': conn.execute('SELECT COUNT(*) FROM orders').fetchone()[0],
+        'archived': conn.execute('SELECT COUNT(*) FROM orders_archive').fetchone()[0],
+        'eligible': len(eligible(conn, days, -1)),
+    }
@@ -0,0 +1,292 @@
+# ASGI 進入點
+#   uvicorn asgi:app --host 0.0.0.0 --port 5000        （或 hypercorn asgi:app）
+# 長連線的路由在 event loop 上原生處理，等待事件時不佔用執行緒：
+#   /events                    Server-Sent Events（與同步版相同格式，支援 Last-Event-ID）
+#   /events/poll               long-poll：?last_event_id=&timeout=，有事件或逾時才回傳 JSON
+#   /notifications/unread_count
+# 其餘路由交給原本的 Flask app，在有上限的執行緒池裡執行（WSGI 轉接），行為與同步版相同。
+# 資料存取經由 db.AsyncDatabase，同步的資料函式在執行緒池裡借連線執行。
+# 事件匯流排在行程內，請以單一行程（uvicorn 不加 --workers）執行，或改用外部的訊息佇列。
+#
+# 設定（環境變數）：
+#   DELIVERY_ASGI_THREADS     執行 Flask 路由的執行緒數，預設 32
+#   DELIVERY_ASGI_DB_THREADS  非同步資料存取的執行緒數，預設等於連線池大小
+import asyncio
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.cookies import SimpleCookie
+from io import BytesIO
+from urllib.parse import parse_qs
+
+from itsdangerous import BadSignature
+
+import db
+import events
+import logs
+import metrics
+import notifications
+from app import app as flask_app, ensure_initialized
+
+log = logs.get_logger('asgi')
+
+flask_app.config['ASGI_THREADS'] = int(os.environ.get('DELIVERY_ASGI_THREADS', 32))
+flask_app.config['ASGI_DB_THREADS'] = int(os.environ.get('DELIVERY_ASGI_DB_THREADS', 0)) or None
+
+adb = db.AsyncDatabase(flask_app, workers=flask_app.config['ASGI_DB_THREADS'])
+
+# long-poll 最長等待秒數
+MAX_POLL_SECONDS = 60
+
+
+def _headers(scope):
+    return {name.decode('latin-1').lower(): value.decode('latin-1') for name, value in scope['headers']}
+
+
+def load_session(scope):
+    # 解開 Flask 的 session cookie（與 Flask 使用相同的簽章與有效期限）
+    morsel = SimpleCookie(_headers(scope).get('cookie', '')).get(flask_app.config['SESSION_COOKIE_NAME'])
+    if morsel is None:
+        return {}
+    serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+    try:
+        return serializer.loads(morsel.value, max_age=int(flask_app.permanent_session_lifetime.total_seconds()))
+    except BadSignature:
+        return {}
+
+
+async def send_response(send, status, body, content_type='text/plain; charset=utf-8', headers=()):
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', content_type.encode('latin-1')),
+                            (b'content-length', str(len(body)).encode('latin-1')),
+                            *headers]})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def send_json(send, data, status=200):
+    await send_response(send, status, json.dumps(data, ensure_ascii=False), 'application/json')
+
+
+async def redirect_to_login(send):
+    await send_response(send, 302, b'', headers=[(b'location', b'/login')])
+
+
+async def _wait_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+async def send_stream(receive, send, chunks, headers):
+    # 持續送出 chunks；客戶端斷線時取消產生器，讓它的 finally 取消訂閱
+    await send({'type': 'http.response.start', 'status': 200, 'headers': headers})
+
+    async def pump():
+        async for chunk in chunks:
+            await send({'type': 'http.response.body', 'body': chunk.encode('utf-8'), 'more_body': True})
+
+    pump_task = asyncio.ensure_future(pump())
+    disconnect_task = asyncio.ensure_future(_wait_disconnect(receive))
+    done, pending = await asyncio.wait({pump_task, disconnect_task}, return_when=asyncio.FIRST_COMPLETED)
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+    await chunks.aclose()
+    if pump_task in done and pump_task.exception() is None:
+        await send({'type': 'http.response.body', 'body': b''})
+
+
+async def order_events(scope, receive, send):
+    session = load_session(scope)
+    if 'user_id' not in session:
+        return await redirect_to_login(send)
+
+    topics = events.topics_for(session['role'], session['user_id'])
+    last_event_id = _headers(scope).get('last-event-id')
+    subscription = events.bus.subscribe(topics, int(last_event_id) if last_event_id and last_event_id.isdigit() else None)
+    try:
+        await send_stream(receive, send, events.bus.astream(subscription), [
+            (b'content-type', b'text/event-stream; charset=utf-8'),
+            (b'cache-control', b'no-cache'),
+            (b'x-accel-buffering', b'no'),
+        ])
+    finally:
+        # 產生器還沒開始就斷線時不會執行它的 finally，這裡再取消一次（重複呼叫無妨）
+        events.bus.unsubscribe(subscription)
+
+
+async def poll_events(scope, receive, send):
+    session = load_session(scope)
+    if 'user_id' not in session:
+        return await redirect_to_login(send)
+
+    args = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+    last_event_id = args.get('last_event_id', [''])[0]
+    try:
+        timeout = min(float(args.get('timeout', [events.HEARTBEAT_SECONDS])[0]), MAX_POLL_SECONDS)
+    except ValueError:
+        timeout = events.HEARTBEAT_SECONDS
+
+    items = await events.bus.poll(events.topics_for(session['role'], session['user_id']),
+                                  int(last_event_id) if last_event_id.isdigit() else None, max(0.0, timeout))
+    await send_json(send, {
+        'events': [{'id': event_id, 'event': event, 'data': data} for event_id, event, data in items],
+        'last_event_id': items[-1][0] if items else (int(last_event_id) if last_event_id.isdigit() else None),
+    })
+
+
+async def unread_count(scope, receive, send):
+    session = load_session(scope)
+    if 'user_id' not in session:
+        return await send_json(send, {'error': 'login required'}, 401)
+    await send_json(send, {'unread': await adb.run(notifications.unread_count, session['user_id'])})
+
+
+ROUTES = {
+    ('GET', '/events'): ('order_events', order_events),
+    ('GET', '/events/poll'): ('poll_events', poll_events),
+    ('GET', '/notifications/unread_count'): ('notification_unread_count', unread_count),
+}
+
+
+class WsgiBridge:
+    # 在有上限的執行緒池裡執行 WSGI app；回應本文一段一段送回 event loop，不整個緩衝在記憶體
+    def __init__(self, wsgi_app, threads):
+        self.wsgi_app = wsgi_app
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='asgi-wsgi')
+
+    async def __call__(self, scope, receive, send):
+        body = BytesIO()
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body.write(message.get('body', b''))
+            if not message.get('more_body'):
+                break
+        body.seek(0)
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.executor, self._run, self.environ(scope, body), loop, send)
+
+    @staticmethod
+    def environ(scope, body):
+        server = scope.get('server') or ('localhost', 80)
+        client = scope.get('client') or ('', 0)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+            'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+            'REMOTE_ADDR': client[0],
+            'REMOTE_PORT': str(client[1]),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': body,
+            # 本文已經整個讀進來，chunked 上傳沒有 Content-Length 也能讀完
+            'wsgi.input_terminated': True,
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        for name, value in scope['headers']:
+            name = name.decode('latin-1').upper().replace('-', '_')
+            value = value.decode('latin-1')
+            if name in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                environ[name] = value
+                continue
+            key = f'HTTP_{name}'
+            environ[key] = f'{environ[key]},{value}' if key in environ else value
+        return environ
+
+    def _run(self, environ, loop, send):
+        start = {}
+
+        def start_response(status, headers, exc_info=None):
+            start['message'] = {'type': 'http.response.start', 'status': int(status.split(' ', 1)[0]),
+                                'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                                            for name, value in headers]}
+
+        def push(message):
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        result = self.wsgi_app(environ, start_response)
+        try:
+            started = False
+            for chunk in result:
+                if not chunk:
+                    continue
+                if not started:
+                    push(start['message'])
+                    started = True
+                push({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            if not started:
+                push(start['message'])
+            push({'type': 'http.response.body', 'body': b''})
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+
+
+wsgi = WsgiBridge(flask_app.wsgi_app, flask_app.config['ASGI_THREADS'])
+_initialized = False
+
+
+async def initialize():
+    # 與同步版第一個請求相同：需要時套用 migration 與測試帳號
+    global _initialized
+    if not _initialized:
+        await adb.call(ensure_initialized)
+        _initialized = True
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            try:
+                await initialize()
+            except Exception as e:
+                log.exception('ASGI 啟動失敗')
+                await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+                return
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            wsgi.executor.shutdown(wait=False)
+            adb.close()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] != 'http':
+        return
+
+    route = ROUTES.get((scope['method'], scope['path']))
+    if route is None:
+        return await wsgi(scope, receive, send)
+
+    # 原生路由不經過 Flask，請求指標在這裡記錄
+    endpoint, handler = route
+    started = time.perf_counter()
+    status = {'code': 500}
+
+    async def send_with_status(message):
+        if message['type'] == 'http.response.start':
+            status['code'] = message['status']
+        await send(message)
+
+    await initialize()
+    try:
+        await handler(scope, receive, send_with_status)
+    finally:
+        metrics.registry.record_request(endpoint, scope['method'], status['code'],
+                                        time.perf_counter() - started, None)
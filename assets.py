@@ -0,0 +1,147 @@
+# 靜態檔案建置：內容雜湊檔名、預先壓縮、長效快取
+#   flask build-assets    把 static/ 的檔案輸出到 build/assets/，檔名加上內容雜湊（style.3f2a9c1b0d4e.css），
+#                         同時產生 .gz（有安裝 brotli 時也產生 .br）與 manifest.json
+# 模板用 asset_url('style.css') 取得網址：有 manifest 時指向 /assets/<雜湊檔名>，回應帶
+# Cache-Control: immutable，重複瀏覽時瀏覽器直接用快取，不再發出靜態檔案請求；
+# 內容改變時雜湊跟著變，網址也就換了。沒有建置過，或 ASSETS_USE_MANIFEST 關閉時（開發中直接改
+# static/ 不想每次重新建置）退回原本的 static 路由；debug 模式不影響。
+# 舊版本的雜湊檔案不會刪除，還在使用舊 manifest 的行程與瀏覽器快取的頁面仍然拿得到。
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+
+from flask import abort, current_app, request, send_from_directory, url_for
+from werkzeug.exceptions import NotFound
+from werkzeug.security import safe_join
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+MANIFEST = 'manifest.json'
+ONE_YEAR = 365 * 24 * 3600
+IMMUTABLE = f'public, max-age={ONE_YEAR}, immutable'
+# 預先壓縮的副檔名；太小的檔案壓縮後省不了多少
+COMPRESSIBLE = ('.css', '.js', '.svg', '.json', '.txt', '.html')
+MIN_COMPRESS_BYTES = 256
+# 依偏好順序嘗試的編碼與副檔名
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+# hashed_name() 產生的檔名：<原檔名>.<12 位雜湊>[.<副檔名>]
+FINGERPRINTED = re.compile(r'[\w./-]+\.[0-9a-f]{12}(\.\w+)?')
+
+
+def hashed_name(path, content):
+    root, ext = os.path.splitext(path)
+    return f'{root}.{hashlib.sha256(content).hexdigest()[:12]}{ext}'
+
+
+def _write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(content)
+    os.replace(tmp, path)
+
+
+def _compress(content):
+    variants = {'gzip': gzip.compress(content, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        variants['br'] = brotli.compress(content, quality=11)
+    # 壓縮後沒有比較小就不留
+    return {encoding: data for encoding, data in variants.items() if len(data) < len(content)}
+
+
+def build(static_dir, out_dir):
+    # 回傳 manifest：files 為 {原始路徑: 雜湊路徑}，encodings 為 {雜湊路徑: [可用的編碼]}
+    manifest = {'files': {}, 'encodings': {}}
+    for dirpath, _, filenames in os.walk(static_dir):
+        for filename in sorted(filenames):
+            source = os.path.join(dirpath, filename)
+            logical = os.path.relpath(source, static_dir).replace(os.sep, '/')
+            with open(source, 'rb') as f:
+                content = f.read()
+
+            target = hashed_name(logical, content)
+            _write(os.path.join(out_dir, target), content)
+            if logical.endswith(COMPRESSIBLE) and len(content) >= MIN_COMPRESS_BYTES:
+                variants = _compress(content)
+                for encoding, suffix in ENCODINGS:
+                    if encoding in variants:
+                        _write(os.path.join(out_dir, target + suffix), variants[encoding])
+                if variants:
+                    manifest['encodings'][target] = sorted(variants)
+            manifest['files'][logical] = target
+
+    # manifest 最後才換上，建置途中的請求仍然使用舊的一份
+    _write(os.path.join(out_dir, MANIFEST), json.dumps(manifest, indent=2, sort_keys=True).encode('utf-8'))
+    return manifest
+
+
+def load_manifest(app):
+    path = os.path.join(app.config['ASSETS_DIR'], MANIFEST)
+    try:
+        with open(path, encoding='utf-8') as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        manifest = None
+    app.extensions['assets_manifest'] = manifest
+    return manifest
+
+
+def asset_url(filename):
+    manifest = current_app.extensions.get('assets_manifest')
+    if manifest is None or not current_app.config['ASSETS_USE_MANIFEST'] or filename not in manifest['files']:
+        return url_for('static', filename=filename)
+    return url_for('asset', filename=manifest['files'][filename])
+
+
+def _encodings(filename):
+    # 目前 manifest 裡的檔案直接查表；舊版本（或其他行程較新的建置）的檔案看磁碟上有哪些壓縮檔
+    manifest = current_app.extensions.get('assets_manifest')
+    if manifest is not None and filename in manifest['encodings']:
+        return manifest['encodings'][filename]
+    path = safe_join(current_app.config['ASSETS_DIR'], filename)
+    return [encoding for encoding, suffix in ENCODINGS if path is not None and os.path.isfile(path + suffix)]
+
+
+def serve_asset(filename):
+    # 任何建置過的雜湊檔案都提供，不限目前的 manifest：滾動部署時舊行程或瀏覽器快取的頁面
+    # 仍然引用上一版的網址。其他路徑一律 404，不存在的檔案由 send_from_directory 回 404
+    if not FINGERPRINTED.fullmatch(filename):
+        abort(404)
+
+    available = _encodings(filename)
+    chosen = next(((encoding, suffix) for encoding, suffix in ENCODINGS
+                   if encoding in available and request.accept_encodings[encoding]), None)
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    response = send_from_directory(current_app.config['ASSETS_DIR'], filename + (chosen[1] if chosen else ''),
+                                   mimetype=mimetype, max_age=ONE_YEAR)
+    if chosen:
+        response.headers['Content-Encoding'] = chosen[0]
+    if available:
+        response.vary.add('Accept-Encoding')
+    response.headers['Cache-Control'] = IMMUTABLE
+    return response
+
+
+def reachable(app, filename):
+    # 直接呼叫 serve_asset（不經過 before_request，建置時不會碰資料庫）
+    with app.test_request_context(f'/assets/{filename}'):
+        try:
+            response = serve_asset(filename)
+        except NotFound:
+            return False
+        response.close()
+        return response.status_code == 200
+
+
+def init_app(app):
+    app.config.setdefault('ASSETS_DIR', os.path.join(app.root_path, 'build', 'assets'))
+    app.config.setdefault('ASSETS_USE_MANIFEST', True)
+    app.add_url_rule('/assets/<path:filename>', 'asset', serve_asset)
+    app.add_template_global(asset_url)
+    load_manifest(app)
@@ -0,0 +1,45 @@
+# 測試腳本共用：在暫存目錄建立獨立資料庫並載入 app
+import os
+import sqlite3
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_app(app_dir=ROOT, workdir=None):
+    workdir = workdir or tempfile.mkdtemp()
+    db_path = os.path.join(workdir, 'new_delivery.db')
+    os.environ['DELIVERY_DB'] = db_path
+    # 舊版本把資料庫名稱寫死成相對路徑，切到暫存目錄才不會動到專案裡的資料庫
+    os.chdir(workdir)
+    sys.path.insert(0, app_dir)
+    import app as module
+
+    # 觸發第一個請求，讓 migration 與測試帳號就緒
+    module.app.test_client().get('/login')
+    return module, db_path
+
+
+def connect(db_path):
+    conn = sqlite3.connect(db_path, timeout=30)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def user_id(conn, username):
+    return conn.execute('SELECT id FROM users WHERE username = ?', (username,)).fetchone()[0]
+
+
+def login(client, username, password=None):
+    client.post('/logout')
+    resp = client.post('/login', data={'username': username, 'password': password or username + '123'})
+    assert resp.status_code == 302, f'{username} 登入失敗'
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(pct / 100 * len(values)) - 1))
+    return values[index]
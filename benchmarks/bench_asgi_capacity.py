@@ -0,0 +1,213 @@
+# 同步伺服器與 ASGI 模式的並行連線容量比較
+# 兩種伺服器各自在子行程啟動（各用一個新的暫存資料庫），逐步增加同時開著的 /events（SSE）連線，
+# 每一階段記錄：成功建立的連線數、一般請求（/notifications/unread_count）的延遲、
+# 一個訂單事件推送到所有連線所需的時間，以及伺服器行程的執行緒數與記憶體。
+#
+#   python benchmarks/bench_asgi_capacity.py --levels 100,500,1000
+#   python benchmarks/bench_asgi_capacity.py --only async --async-cmd "hypercorn asgi:app --bind 127.0.0.1:{port}"
+#
+# 同步：flask run --with-threads（與 run.bat 相同，每條連線一個執行緒）
+# 非同步：uvicorn asgi:app（需要 pip install uvicorn）
+import argparse
+import asyncio
+import importlib.util
+import json
+import os
+import resource
+import shlex
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+from _support import ROOT, percentile
+
+SYNC_CMD = '{python} -m flask --app app run --no-reload --no-debugger --with-threads --port {port}'
+ASYNC_CMD = '{python} -m uvicorn asgi:app --port {port} --log-level warning --no-access-log'
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def proc_status(pid):
+    fields = {}
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            fields[key] = value.strip()
+    return {'threads': int(fields['Threads']), 'rss_mb': round(int(fields['VmRSS'].split()[0]) / 1024, 1)}
+
+
+async def http(port, method, path, body=b'', headers=None, timeout=30):
+    reader, writer = await asyncio.wait_for(asyncio.open_connection('127.0.0.1', port), timeout)
+    try:
+        lines = [f'{method} {path} HTTP/1.1', f'Host: 127.0.0.1:{port}', 'Connection: close',
+                 f'Content-Length: {len(body)}']
+        lines += [f'{name}: {value}' for name, value in (headers or {}).items()]
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body)
+        await writer.drain()
+        raw = await asyncio.wait_for(reader.read(), timeout)
+    finally:
+        writer.close()
+    head, _, content = raw.partition(b'\r\n\r\n')
+    status_line, *header_lines = head.decode('latin-1').split('\r\n')
+    response_headers = {}
+    for line in header_lines:
+        name, _, value = line.partition(':')
+        response_headers.setdefault(name.strip().lower(), value.strip())
+    return int(status_line.split()[1]), response_headers, content
+
+
+async def wait_ready(port, proc, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError('伺服器啟動失敗')
+        try:
+            status, _, _ = await http(port, 'GET', '/login', timeout=5)
+            if status == 200:
+                return
+        except (OSError, asyncio.TimeoutError):
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError('伺服器啟動逾時')
+
+
+async def login(port, username, password):
+    form = f'username={username}&password={password}'.encode()
+    status, headers, _ = await http(port, 'POST', '/login', form,
+                                    {'Content-Type': 'application/x-www-form-urlencoded'})
+    assert status == 302, f'{username} 登入失敗'
+    return headers['set-cookie'].split(';', 1)[0]
+
+
+async def open_stream(port, cookie, timeout):
+    # 連上 /events，讀到 retry: 才算建立完成
+    reader, writer = await asyncio.wait_for(asyncio.open_connection('127.0.0.1', port), timeout)
+    writer.write(f'GET /events HTTP/1.1\r\nHost: 127.0.0.1:{port}\r\nCookie: {cookie}\r\n'
+                 'Accept: text/event-stream\r\n\r\n'.encode('latin-1'))
+    await writer.drain()
+    await asyncio.wait_for(reader.readuntil(b'retry:'), timeout)
+    return reader, writer
+
+
+async def publish_one(port, cookie, db_path, item_id):
+    # 下單並確認，觸發一個 customer:<id> 的訂單事件
+    await http(port, 'POST', f'/place_order/{item_id}', headers={'Cookie': cookie})
+    conn = sqlite3.connect(db_path)
+    order_id = conn.execute('SELECT MAX(id) FROM orders').fetchone()[0]
+    conn.close()
+    await http(port, 'POST', '/confirm_order', f'order_ids={order_id}'.encode(),
+               {'Cookie': cookie, 'Content-Type': 'application/x-www-form-urlencoded'})
+
+
+async def measure(name, cmd, app_dir, levels, probes, connect_timeout):
+    port = free_port()
+    workdir = tempfile.mkdtemp()
+    db_path = os.path.join(workdir, 'new_delivery.db')
+    env = dict(os.environ, DELIVERY_DB=db_path, DELIVERY_LOG_LEVEL='WARNING')
+    args = shlex.split(cmd.format(python=shlex.quote(sys.executable), port=port))
+    proc = subprocess.Popen(args, cwd=app_dir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    results = []
+    streams = []
+    try:
+        await wait_ready(port, proc)
+        cookie = await login(port, 'customer', 'customer123')
+        conn = sqlite3.connect(db_path)
+        merchant_id = conn.execute("SELECT id FROM users WHERE username = 'merchant'").fetchone()[0]
+        item_id = conn.execute("INSERT INTO menu (item_name, description, price, merchant_id) "
+                               "VALUES ('容量測試', '測試', 10, ?)", (merchant_id,)).lastrowid
+        conn.commit()
+        conn.close()
+
+        failed = 0
+        for level in levels:
+            # 補足到這一階段的連線數，已經開著的連線保留
+            started = time.perf_counter()
+            attempts = await asyncio.gather(*(open_stream(port, cookie, connect_timeout)
+                                              for _ in range(level - len(streams) - failed)),
+                                            return_exceptions=True)
+            connect_s = time.perf_counter() - started
+            streams += [s for s in attempts if not isinstance(s, BaseException)]
+            failed += sum(1 for s in attempts if isinstance(s, BaseException))
+
+            latencies = []
+            for _ in range(probes):
+                probe_start = time.perf_counter()
+                try:
+                    await http(port, 'GET', '/notifications/unread_count', headers={'Cookie': cookie},
+                               timeout=connect_timeout)
+                    latencies.append((time.perf_counter() - probe_start) * 1000)
+                except (OSError, asyncio.TimeoutError):
+                    pass
+
+            # 一個事件推送到所有連線的時間
+            waiters = [asyncio.ensure_future(asyncio.wait_for(reader.readuntil(b'event: order'), connect_timeout * 3))
+                       for reader, _ in streams]
+            fanout_start = time.perf_counter()
+            await publish_one(port, cookie, db_path, item_id)
+            received = await asyncio.gather(*waiters, return_exceptions=True)
+            fanout_ms = (time.perf_counter() - fanout_start) * 1000
+
+            results.append({
+                'target_connections': level,
+                'established': len(streams),
+                'failed': failed,
+                'connect_s': round(connect_s, 2),
+                'probe_ok': len(latencies),
+                'probe_p50_ms': round(percentile(latencies, 50), 2) if latencies else None,
+                'probe_p95_ms': round(percentile(latencies, 95), 2) if latencies else None,
+                'fanout_received': sum(1 for r in received if not isinstance(r, BaseException)),
+                'fanout_ms': round(fanout_ms, 1),
+                **proc_status(proc.pid),
+            })
+            print(f'{name:6} {json.dumps(results[-1], ensure_ascii=False)}', file=sys.stderr)
+    finally:
+        for _, writer in streams:
+            writer.close()
+        proc.terminate()
+        try:
+            proc.wait(10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--app-dir', default=ROOT)
+    parser.add_argument('--levels', default='50,200,500,1000', help='逐步增加到的同時連線數')
+    parser.add_argument('--probes', type=int, default=20, help='每階段量測幾次一般請求')
+    parser.add_argument('--connect-timeout', type=float, default=10.0)
+    parser.add_argument('--only', choices=('sync', 'async'))
+    parser.add_argument('--sync-cmd', default=SYNC_CMD)
+    parser.add_argument('--async-cmd', default=ASYNC_CMD)
+    args = parser.parse_args()
+
+    # 每條連線一個檔案描述子，把上限調到允許的最大值
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    levels = [int(level) for level in args.levels.split(',')]
+    servers = []
+    if args.only != 'async':
+        servers.append(('sync', args.sync_cmd))
+    if args.only != 'sync':
+        if args.async_cmd == ASYNC_CMD and importlib.util.find_spec('uvicorn') is None:
+            print('找不到 uvicorn，略過 ASGI 模式（pip install uvicorn，或用 --async-cmd 指定其他 ASGI 伺服器）',
+                  file=sys.stderr)
+        else:
+            servers.append(('async', args.async_cmd))
+
+    report = {name: asyncio.run(measure(name, cmd, args.app_dir, levels, args.probes, args.connect_timeout))
+              for name, cmd in servers}
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main()
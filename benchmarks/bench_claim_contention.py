@@ -0,0 +1,171 @@
+# 搶單競爭測試：多位外送員同時搶少量待配送訂單
+# 每張訂單應該剛好只有一位外送員收到「接單成功」，而且資料庫裡記錄的就是那一位。
+#
+#   python benchmarks/bench_claim_contention.py --couriers 32 --orders 5 --rounds 20
+#   DELIVERY_DB_BUSY_TIMEOUT=5 python benchmarks/bench_claim_contention.py   # 逼出 SQLITE_BUSY 重試
+#   python benchmarks/bench_claim_contention.py --app-dir /path/to/old/checkout
+import argparse
+import json
+import random
+import threading
+import time
+from collections import defaultdict
+
+from _support import ROOT, connect, load_app, percentile
+
+PASSWORD = 'courier123'
+
+
+def create_couriers(db_path, count):
+    from werkzeug.security import generate_password_hash
+    password_hash = generate_password_hash(PASSWORD)
+    conn = connect(db_path)
+    conn.executemany('INSERT OR IGNORE INTO users (username, password_hash, role) VALUES (?, ?, ?)',
+                     [(f'courier_{i}', password_hash, 'delivery_person') for i in range(count)])
+    conn.commit()
+    rows = conn.execute("SELECT id, username FROM users WHERE username LIKE 'courier\\_%' ESCAPE '\\'").fetchall()
+    conn.close()
+    return [(row['id'], row['username']) for row in rows]
+
+
+def prepare_orders(db_path, count):
+    # 直接建立待配送的訂單（同時寫入新舊欄位，舊版本也能跑）
+    conn = connect(db_path)
+    customer_id = conn.execute("SELECT id FROM users WHERE username = 'customer'").fetchone()[0]
+    merchant_id = conn.execute("SELECT id FROM users WHERE username = 'merchant'").fetchone()[0]
+    item_id = conn.execute('INSERT INTO menu (item_name, description, price, merchant_id) VALUES (?, ?, ?, ?)',
+                           ('搶單便當', '測試', 100, merchant_id)).lastrowid
+    columns = {row[1] for row in conn.execute('PRAGMA table_info(orders)')}
+    order_ids = []
+    for _ in range(count):
+        if 'state' in columns:
+            order_id = conn.execute('''
+                INSERT INTO orders (customer_id, merchant_id, item_id, item_name, price, status,
+                                    acceptance_status, delivery_status, state)
+                VALUES (?, ?, ?, '搶單便當', 100, '已確認', '已接單', '已通知', '待配送')
+            ''', (customer_id, merchant_id, item_id)).lastrowid
+        else:
+            order_id = conn.execute('''
+                INSERT INTO orders (customer_id, merchant_id, item_id, item_name, price, status,
+                                    acceptance_status, delivery_status)
+                VALUES (?, ?, ?, '搶單便當', 100, '已確認', '已接單', '已通知')
+            ''', (customer_id, merchant_id, item_id)).lastrowid
+            conn.execute('''
+                INSERT INTO delivery_orders (id, customer_id, merchant_id, merchant_order_id, item_id,
+                                             status, price, item_name)
+                VALUES (?, ?, ?, ?, ?, '待配送', 100, '搶單便當')
+            ''', (order_id, customer_id, merchant_id, order_id, item_id))
+        order_ids.append(order_id)
+    conn.commit()
+    conn.close()
+    return order_ids
+
+
+def claim(client, order_id):
+    start = time.perf_counter()
+    resp = client.post(f'/deliver_order/{order_id}')
+    elapsed = (time.perf_counter() - start) * 1000
+    with client.session_transaction() as sess:
+        flashes = sess.pop('_flashes', [])
+    succeeded = any(category == 'success' for category, _ in flashes)
+    return resp.status_code, succeeded, elapsed
+
+
+def run_round(clients, couriers, db_path, orders):
+    order_ids = prepare_orders(db_path, orders)
+    barrier = threading.Barrier(len(clients))
+    winners = defaultdict(list)
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def worker(client, courier_id):
+        # 每位外送員以隨機順序搶每一張訂單
+        targets = random.sample(order_ids, len(order_ids))
+        barrier.wait()
+        for order_id in targets:
+            status, succeeded, elapsed = claim(client, order_id)
+            with lock:
+                latencies.append(elapsed)
+                if status >= 500:
+                    errors.append(order_id)
+                if succeeded:
+                    winners[order_id].append(courier_id)
+
+    threads = [threading.Thread(target=worker, args=(client, courier_id))
+               for client, (courier_id, _) in zip(clients, couriers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    conn = connect(db_path)
+    stored = dict(conn.execute(
+        f"SELECT id, delivery_person_id FROM orders WHERE id IN ({','.join('?' * len(order_ids))})",
+        order_ids).fetchall())
+    conn.close()
+
+    double_claims = sum(1 for order_id in order_ids if len(winners[order_id]) > 1)
+    unclaimed = sum(1 for order_id in order_ids if not winners[order_id])
+    # 回報成功的外送員與資料庫記錄不一致（後寫入者覆蓋）
+    mismatched = sum(1 for order_id in order_ids
+                     if winners[order_id] and stored[order_id] != winners[order_id][0])
+    return latencies, errors, double_claims, unclaimed, mismatched
+
+
+def busy_counters(module):
+    db = getattr(module, 'db', None)
+    if db is None or not hasattr(db, 'get_pool'):
+        return None
+    stats = db.get_pool(module.app).stats()
+    return {'busy_errors': stats.get('busy_errors'), 'busy_retries': stats.get('busy_retries')}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--app-dir', default=ROOT)
+    parser.add_argument('--couriers', type=int, default=32)
+    parser.add_argument('--orders', type=int, default=5)
+    parser.add_argument('--rounds', type=int, default=10)
+    args = parser.parse_args()
+
+    module, db_path = load_app(args.app_dir)
+    couriers = create_couriers(db_path, args.couriers)
+    clients = []
+    for _, username in couriers:
+        client = module.app.test_client()
+        resp = client.post('/login', data={'username': username, 'password': PASSWORD})
+        assert resp.status_code == 302, f'{username} 登入失敗'
+        clients.append(client)
+
+    latencies, errors = [], 0
+    totals = {'double_claims': 0, 'unclaimed': 0, 'mismatched': 0}
+    start = time.perf_counter()
+    for _ in range(args.rounds):
+        round_latencies, round_errors, double_claims, unclaimed, mismatched = run_round(
+            clients, couriers, db_path, args.orders)
+        latencies += round_latencies
+        errors += len(round_errors)
+        totals['double_claims'] += double_claims
+        totals['unclaimed'] += unclaimed
+        totals['mismatched'] += mismatched
+    duration = time.perf_counter() - start
+
+    print(json.dumps({
+        'app_dir': args.app_dir,
+        'couriers': args.couriers,
+        'orders_per_round': args.orders,
+        'rounds': args.rounds,
+        'claims': len(latencies),
+        'claims_per_s': round(len(latencies) / duration, 1),
+        'p50_ms': round(percentile(latencies, 50), 2),
+        'p95_ms': round(percentile(latencies, 95), 2),
+        'p99_ms': round(percentile(latencies, 99), 2),
+        'server_errors': errors,
+        **totals,
+        'sqlite': busy_counters(module),
+    }, indent=2, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+# confirm_order 批次確認測試：一次確認 1、50、500 筆訂單
+#
+#   python benchmarks/bench_confirm_order.py
+#   python benchmarks/bench_confirm_order.py --app-dir /path/to/old/checkout
+import argparse
+import json
+import statistics
+import time
+
+from _support import ROOT, connect, load_app, login, user_id
+
+
+def prepare_orders(conn, customer_id, merchant_id, count):
+    item_id = conn.execute('INSERT INTO menu (item_name, description, price, merchant_id) VALUES (?, ?, ?, ?)',
+                           ('測試便當', '測試', 100, merchant_id)).lastrowid
+    cur = conn.executemany('''
+        INSERT INTO orders (customer_id, merchant_id, item_id, item_name, price, status)
+        VALUES (?, ?, ?, '測試便當', 100, '待处理')
+    ''', [(customer_id, merchant_id, item_id)] * count)
+    conn.commit()
+    first = conn.execute('SELECT MAX(id) FROM orders').fetchone()[0] - count + 1
+    return [str(i) for i in range(first, first + count)]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--app-dir', default=ROOT)
+    parser.add_argument('--sizes', default='1,50,500')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    module, db_path = load_app(args.app_dir)
+    client = module.app.test_client()
+    login(client, 'customer')
+
+    conn = connect(db_path)
+    customer_id = user_id(conn, 'customer')
+    merchant_id = user_id(conn, 'merchant')
+
+    results = {}
+    for size in (int(s) for s in args.sizes.split(',')):
+        timings = []
+        for _ in range(args.repeat):
+            order_ids = prepare_orders(conn, customer_id, merchant_id, size)
+            start = time.perf_counter()
+            resp = client.post('/confirm_order', data={'order_ids': order_ids})
+            timings.append((time.perf_counter() - start) * 1000)
+            assert resp.status_code == 302
+
+            confirmed = conn.execute(
+                f"SELECT COUNT(*) FROM orders WHERE id IN ({','.join('?' * size)}) AND status = '已確認'",
+                order_ids).fetchone()[0]
+            assert confirmed == size, f'只確認了 {confirmed}/{size} 筆'
+        results[size] = {'median_ms': round(statistics.median(timings), 2),
+                         'min_ms': round(min(timings), 2)}
+
+    print(json.dumps({'app_dir': args.app_dir, 'confirm_order': results}, indent=2, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main()
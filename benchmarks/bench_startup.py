@@ -0,0 +1,69 @@
+# 冷啟動測試：量測 import app 到第一個請求完成的時間
+#
+#   python benchmarks/bench_startup.py
+#   python benchmarks/bench_startup.py --app-dir /path/to/old/checkout   # 比較舊版本
+#
+# 每一輪都開新的 Python 行程，分別量「全新資料庫」（第一次部署）
+# 與「已初始化資料庫」（一般 worker 重啟）兩種情況。
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHILD = r'''
+import json, sys, time
+t0 = time.perf_counter()
+sys.path.insert(0, sys.argv[1])
+import app as m
+t1 = time.perf_counter()
+resp = m.app.test_client().get('/')
+t2 = time.perf_counter()
+print(json.dumps({'import': t1 - t0, 'first_request': t2 - t1, 'total': t2 - t0, 'status': resp.status_code}))
+'''
+
+
+def run_once(app_dir, workdir):
+    env = dict(os.environ, DELIVERY_DB=os.path.join(workdir, 'new_delivery.db'))
+    # 舊版本把資料庫名稱寫死成相對路徑，所以在暫存目錄裡執行
+    out = subprocess.run([sys.executable, '-c', CHILD, app_dir], cwd=workdir, env=env,
+                         capture_output=True, text=True, check=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def summarize(samples):
+    result = {}
+    for key in ('import', 'first_request', 'total'):
+        values = [s[key] * 1000 for s in samples]
+        result[key] = {'median_ms': round(statistics.median(values), 1),
+                       'min_ms': round(min(values), 1)}
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--app-dir', default=ROOT)
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    cold, warm = [], []
+    for _ in range(args.runs):
+        workdir = tempfile.mkdtemp()
+        try:
+            cold.append(run_once(args.app_dir, workdir))
+            warm.append(run_once(args.app_dir, workdir))
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print(json.dumps({'app_dir': args.app_dir,
+                      'fresh_database': summarize(cold),
+                      'initialized_database': summarize(warm)}, indent=2, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,269 @@
+# 訂單完整流程壓力測試
+# 每個 worker 用自己的顧客、商家、外送員帳號，反覆跑完一整張訂單：
+#   place_order -> confirm_order -> merchant_accept_order -> confirm_for_delivery
+#   -> deliver_order -> pickup_order -> complete_delivery -> confirm_receipt -> view_reports
+# 記錄各路由延遲（p50/p95/p99）、整體吞吐量與 SQLITE_BUSY 次數，結果存成 JSON 方便比較。
+#
+#   python benchmarks/loadtest.py --concurrency 8 --iterations 50
+#   python benchmarks/loadtest.py --mode http --concurrency 16 --output benchmarks/results/http-16.json
+#   python benchmarks/loadtest.py --compare benchmarks/results/before.json benchmarks/results/after.json
+#
+# --mode client 用 Flask test client（同一行程、多執行緒）；
+# --mode http 在本機啟動多執行緒 werkzeug 伺服器，經由真正的 HTTP 連線。
+import argparse
+import http.cookiejar
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import defaultdict
+from datetime import datetime
+
+from _support import ROOT, connect, load_app, percentile
+
+PASSWORD = 'loadtest123'
+ROLES = ('customer', 'merchant', 'delivery_person')
+
+
+def create_users(db_path, workers):
+    # 每個 worker 一組帳號；密碼雜湊很慢，只算一次共用
+    from werkzeug.security import generate_password_hash
+    password_hash = generate_password_hash(PASSWORD)
+    conn = connect(db_path)
+    accounts = []
+    for i in range(workers):
+        account = {}
+        for role in ROLES:
+            username = f'load_{role}_{i}'
+            conn.execute('INSERT OR IGNORE INTO users (username, password_hash, role) VALUES (?, ?, ?)',
+                         (username, password_hash, role))
+            account[role] = username
+        merchant_id = conn.execute('SELECT id FROM users WHERE username = ?', (account['merchant'],)).fetchone()[0]
+        account['item_id'] = conn.execute(
+            'INSERT INTO menu (item_name, description, price, merchant_id) VALUES (?, ?, ?, ?)',
+            (f'壓測便當 {i}', '壓力測試用', 100, merchant_id)).lastrowid
+        account['customer_id'] = conn.execute('SELECT id FROM users WHERE username = ?',
+                                              (account['customer'],)).fetchone()[0]
+        accounts.append(account)
+    conn.commit()
+    conn.close()
+    return accounts
+
+
+class ClientSession:
+    # Flask test client；不跟隨轉址，量到的是路由本身
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, data=None):
+        resp = self.client.open(path, method=method, data=data)
+        return resp.status_code
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class HttpSession:
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), _NoRedirect())
+
+    def request(self, method, path, data=None):
+        body = urllib.parse.urlencode(data or {}, doseq=True).encode() if method == 'POST' else None
+        req = urllib.request.Request(self.base_url + path, data=body, method=method)
+        try:
+            with self.opener.open(req, timeout=60) as resp:
+                resp.read()
+                return resp.status
+        except urllib.error.HTTPError as e:
+            e.read()
+            return e.code
+
+
+class Recorder:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def timed(self, session, route, method, path, data=None):
+        start = time.perf_counter()
+        try:
+            status = session.request(method, path, data)
+        except Exception:
+            status = None
+        elapsed = (time.perf_counter() - start) * 1000
+        with self._lock:
+            self.latencies[route].append(elapsed)
+            if status is None or status >= 500:
+                self.errors[route] += 1
+        return status
+
+
+def latest_order(db_path, customer_id):
+    conn = connect(db_path)
+    try:
+        return conn.execute('SELECT MAX(id) FROM orders WHERE customer_id = ?', (customer_id,)).fetchone()[0]
+    finally:
+        conn.close()
+
+
+def run_worker(make_session, db_path, account, iterations, recorder, failures, barrier):
+    sessions = {}
+    for role in ROLES:
+        sessions[role] = make_session()
+        recorder.timed(sessions[role], 'login', 'POST', '/login',
+                       {'username': account[role], 'password': PASSWORD})
+    settle = make_session()
+    recorder.timed(settle, 'login', 'POST', '/login', {'username': 'settle', 'password': 'settle123'})
+    # 登入（密碼雜湊很慢）不算進吞吐量，全部 worker 登入完才一起開始
+    barrier.wait()
+
+    customer, merchant, courier = sessions['customer'], sessions['merchant'], sessions['delivery_person']
+    for _ in range(iterations):
+        recorder.timed(customer, 'place_order', 'POST', f"/place_order/{account['item_id']}")
+        order_id = latest_order(db_path, account['customer_id'])
+        steps = [
+            (customer, 'confirm_order', '/confirm_order', {'order_ids': [str(order_id)]}),
+            (merchant, 'merchant_accept_order', f'/merchant_accept_order/{order_id}', None),
+            (merchant, 'confirm_for_delivery', f'/confirm_for_delivery/{order_id}', None),
+            (courier, 'deliver_order', f'/deliver_order/{order_id}', None),
+            (courier, 'pickup_order', f'/pickup_order/{order_id}', None),
+            (courier, 'complete_delivery', f'/complete_delivery/{order_id}', None),
+            (customer, 'confirm_receipt', f'/confirm_receipt/{order_id}', None),
+        ]
+        for session, route, path, data in steps:
+            recorder.timed(session, route, 'POST', path, data)
+        recorder.timed(settle, 'view_reports', 'GET', '/view_reports')
+
+        conn = connect(db_path)
+        state = conn.execute('SELECT status FROM orders WHERE id = ?', (order_id,)).fetchone()[0]
+        conn.close()
+        if state != '已完成':
+            failures.append((order_id, state))
+
+
+def start_http_server(app):
+    from werkzeug.serving import make_server
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_port}'
+
+
+def busy_errors(module):
+    # 舊版本沒有連線池統計時回傳 None
+    db = getattr(module, 'db', None)
+    if db is None or not hasattr(db, 'get_pool'):
+        return None
+    return db.get_pool(module.app).stats().get('busy_errors')
+
+
+def run(args):
+    module, db_path = load_app(args.app_dir)
+    accounts = create_users(db_path, args.concurrency)
+
+    server = None
+    if args.mode == 'http':
+        server, base_url = start_http_server(module.app)
+        make_session = lambda: HttpSession(base_url)
+    else:
+        make_session = lambda: ClientSession(module.app)
+
+    recorder = Recorder()
+    failures = []
+    barrier = threading.Barrier(len(accounts) + 1)
+    threads = [threading.Thread(target=run_worker,
+                                args=(make_session, db_path, account, args.iterations, recorder, failures, barrier))
+               for account in accounts]
+    for t in threads:
+        t.start()
+    barrier.wait()
+    busy_before = busy_errors(module)
+    start = time.perf_counter()
+    for t in threads:
+        t.join()
+    duration = time.perf_counter() - start
+    busy_after = busy_errors(module)
+    if server is not None:
+        server.shutdown()
+
+    routes = {}
+    for route, values in sorted(recorder.latencies.items()):
+        routes[route] = {
+            'count': len(values),
+            'errors': recorder.errors[route],
+            'mean_ms': round(statistics.mean(values), 2),
+            'p50_ms': round(percentile(values, 50), 2),
+            'p95_ms': round(percentile(values, 95), 2),
+            'p99_ms': round(percentile(values, 99), 2),
+        }
+    total_requests = sum(r['count'] for route, r in routes.items() if route != 'login')
+    orders = args.concurrency * args.iterations
+    return {
+        'label': args.label,
+        'app_dir': args.app_dir,
+        'mode': args.mode,
+        'concurrency': args.concurrency,
+        'iterations': args.iterations,
+        'started_at': datetime.now().isoformat(timespec='seconds'),
+        'duration_s': round(duration, 3),
+        'requests': total_requests,
+        'throughput_rps': round(total_requests / duration, 1),
+        'orders_per_s': round(orders / duration, 1),
+        'incomplete_orders': len(failures),
+        'sqlite_busy': None if busy_before is None else busy_after - busy_before,
+        'routes': routes,
+    }
+
+
+def compare(before_path, after_path):
+    with open(before_path, encoding='utf-8') as f:
+        before = json.load(f)
+    with open(after_path, encoding='utf-8') as f:
+        after = json.load(f)
+    print(f"{'':24}{'before':>12}{'after':>12}")
+    for key in ('throughput_rps', 'orders_per_s', 'sqlite_busy', 'incomplete_orders'):
+        print(f'{key:24}{str(before.get(key)):>12}{str(after.get(key)):>12}')
+    print(f"\n{'p95 (ms)':24}{'before':>12}{'after':>12}")
+    for route in sorted(set(before['routes']) | set(after['routes'])):
+        b = before['routes'].get(route, {}).get('p95_ms')
+        a = after['routes'].get(route, {}).get('p95_ms')
+        print(f'{route:24}{str(b):>12}{str(a):>12}')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--app-dir', default=ROOT)
+    parser.add_argument('--mode', choices=('client', 'http'), default='client')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--iterations', type=int, default=20, help='每個 worker 跑幾張訂單')
+    parser.add_argument('--label', default='')
+    parser.add_argument('--output', help='結果 JSON 檔路徑')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), help='比較兩次結果後結束')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    # load_app 會切換到暫存目錄，先把輸出路徑轉成絕對路徑
+    output = os.path.abspath(args.output) if args.output else None
+    result = run(args)
+    text = json.dumps(result, indent=2, ensure_ascii=False)
+    print(text)
+    if output:
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+        with open(output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,90 @@
+# 菜單快取
+# 菜單只有在商家新增、編輯、刪除菜品時才會改變，首頁的全表查詢改從記憶體回傳。
+# 寫入路徑呼叫 invalidate() 把版本號加一，舊版本的資料就不再使用。
+# 注意：快取在行程內，多個 worker 行程各自有一份，TTL 可限制跨行程的延遲。
+import threading
+import time
+from collections import OrderedDict
+
+
+class CatalogCache:
+    def __init__(self, max_merchants=256, ttl=None):
+        self.max_merchants = max_merchants
+        self.ttl = ttl
+        self.version = 0
+
+        self._lock = threading.Lock()
+        self._all = None
+        self._merchants = OrderedDict()
+        self._counters = {'hits': 0, 'misses': 0, 'invalidations': 0, 'evictions': 0}
+
+    def _fresh(self, entry):
+        version, loaded_at, _ = entry
+        if version != self.version:
+            return False
+        return self.ttl is None or time.monotonic() - loaded_at < self.ttl
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    def all_items(self, loader):
+        entry = self._all
+        if entry is not None and self._fresh(entry):
+            self._count('hits')
+            return entry[2]
+
+        self._count('misses')
+        version = self.version
+        rows = tuple(loader())
+        with self._lock:
+            # 載入期間有寫入的話，這份資料已經過期，不要放進快取
+            if version == self.version:
+                self._all = (version, time.monotonic(), rows)
+        return rows
+
+    def merchant_items(self, merchant_id, loader):
+        # 同一位商家的所有呼叫端共用快取項目，loader 都要依 id 遞增排序
+        with self._lock:
+            entry = self._merchants.get(merchant_id)
+            if entry is not None and self._fresh(entry):
+                self._merchants.move_to_end(merchant_id)
+                self._counters['hits'] += 1
+                return entry[2]
+            self._counters['misses'] += 1
+            version = self.version
+
+        rows = tuple(loader())
+        with self._lock:
+            if version == self.version:
+                self._merchants[merchant_id] = (version, time.monotonic(), rows)
+                self._merchants.move_to_end(merchant_id)
+                while len(self._merchants) > self.max_merchants:
+                    self._merchants.popitem(last=False)
+                    self._counters['evictions'] += 1
+        return rows
+
+    def invalidate(self):
+        with self._lock:
+            self.version += 1
+            self._all = None
+            self._merchants.clear()
+            self._counters['invalidations'] += 1
+
+    def token(self):
+        # 條件式 GET 的版本；有 TTL 時每個週期也換一次，其他行程的修改在 TTL 內反映到 ETag
+        if self.ttl is None:
+            return self.version
+        return self.version, int(time.monotonic() // self.ttl)
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self._counters)
+            cached_merchants = len(self._merchants)
+        lookups = counters['hits'] + counters['misses']
+        return {
+            'version': self.version,
+            'cached_merchants': cached_merchants,
+            'hit_ratio': round(counters['hits'] / lookups, 4) if lookups else None,
+            **counters,
+        }
@@ -0,0 +1,72 @@
+# 購物車
+# 每位顧客每個菜品一列（cart_items，主鍵 customer_id + item_id），加入同一菜品只增加數量。
+# 結帳在一個寫入交易裡：讀出購物車與目前菜單價格、executemany 一次寫入所有訂單列、清空購物車。
+# 訂單直接以「已確認」狀態建立，商家看到的 merchant_orders 是 orders 的 view，不需要另外寫入。
+# orders 每列是一份菜品，數量 3 會展開成 3 筆訂單。
+import order_state
+
+MAX_QUANTITY = 99
+
+
+def add(conn, customer_id, item_id, quantity=1):
+    # 菜品不存在時回傳 False；呼叫端負責 commit
+    cursor = conn.execute('''
+        INSERT INTO cart_items (customer_id, item_id, quantity)
+        SELECT ?, id, ? FROM menu WHERE id = ?
+        ON CONFLICT (customer_id, item_id) DO UPDATE SET quantity = MIN(quantity + excluded.quantity, ?)
+    ''', (customer_id, min(quantity, MAX_QUANTITY), item_id, MAX_QUANTITY))
+    return cursor.rowcount > 0
+
+
+def update(conn, customer_id, item_id, quantity):
+    # 數量 0 表示移除
+    if quantity <= 0:
+        return remove(conn, customer_id, item_id)
+    return conn.execute('UPDATE cart_items SET quantity = ? WHERE customer_id = ? AND item_id = ?',
+                        (min(quantity, MAX_QUANTITY), customer_id, item_id)).rowcount > 0
+
+
+def remove(conn, customer_id, item_id):
+    return conn.execute('DELETE FROM cart_items WHERE customer_id = ? AND item_id = ?',
+                        (customer_id, item_id)).rowcount > 0
+
+
+def items(conn, customer_id):
+    # 已被商家刪除的菜品不會出現（也不會被結帳）
+    return conn.execute('''
+        SELECT cart_items.item_id AS item_id, cart_items.quantity AS quantity,
+               menu.item_name AS item_name, menu.price AS price, menu.merchant_id AS merchant_id
+        FROM cart_items
+        JOIN menu ON cart_items.item_id = menu.id
+        WHERE cart_items.customer_id = ?
+        ORDER BY cart_items.added_at, cart_items.item_id
+    ''', (customer_id,)).fetchall()
+
+
+def count(conn, customer_id):
+    row = conn.execute('SELECT COALESCE(SUM(quantity), 0) AS total FROM cart_items WHERE customer_id = ?',
+                       (customer_id,)).fetchone()
+    return row['total']
+
+
+def checkout(conn, customer_id):
+    # 需在寫入交易內呼叫（db.write_transaction），回傳新建的訂單 id
+    lines = items(conn, customer_id)
+    if not lines:
+        return []
+
+    status, acceptance_status, delivery_status = order_state.PROJECTIONS[order_state.CONFIRMED]
+    rows = [(customer_id, line['merchant_id'], line['item_id'], line['item_name'], line['price'],
+             status, acceptance_status, delivery_status, order_state.CONFIRMED)
+            for line in lines for _ in range(line['quantity'])]
+
+    # 交易握有寫鎖，這段期間的新訂單 id 都大於 last_id
+    last_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM orders').fetchone()[0]
+    conn.executemany('''
+        INSERT INTO orders (customer_id, merchant_id, item_id, item_name, price,
+                            status, acceptance_status, delivery_status, state, state_changed_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, datetime('now'))
+    ''', rows)
+    conn.execute('DELETE FROM cart_items WHERE customer_id = ?', (customer_id,))
+    return [row[0] for row in conn.execute('SELECT id FROM orders WHERE id > ? AND customer_id = ? ORDER BY id',
+                                           (last_id, customer_id))]
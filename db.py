@@ -0,0 +1,389 @@
+# 資料庫連線池
+# 每個工作執行緒在請求期間借用一條長連線（存在 flask.g），請求結束時歸還，
+# 不再每個請求重新開檔、解析 schema、清空 statement cache。
+import asyncio
+import functools
+import logging
+import random
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from queue import Empty, LifoQueue
+
+from flask import current_app, g
+
+import metrics
+
+
+_pool_lock = threading.Lock()
+slow_query_log = logging.getLogger('delivery.sql')
+
+
+class PoolTimeout(sqlite3.OperationalError):
+    pass
+
+
+def is_busy(exc):
+    # busy_timeout 等完仍拿不到鎖時 SQLite 回 SQLITE_BUSY / SQLITE_LOCKED（Python 3.11 才有錯誤碼）
+    code = getattr(exc, 'sqlite_errorcode', None)
+    if code is not None:
+        return code & 0xff in (sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED)
+    return 'locked' in str(exc) or 'busy' in str(exc)
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    # 每個語句的時間含 execute 與之後的 fetch，讀出的列數在 fetch 時計算
+    _sql = None
+    _statement_time = 0.0
+    _slow_logged = False
+
+    def _run(self, method, sql, params):
+        start = time.perf_counter()
+        try:
+            return method(sql, params)
+        except sqlite3.OperationalError as e:
+            self.connection.record_error(e)
+            raise
+        finally:
+            self._sql = sql
+            self._statement_time = 0.0
+            self._slow_logged = False
+            self.connection.statement()
+            self._observe(time.perf_counter() - start, 0)
+
+    def _observe(self, elapsed, rows):
+        conn = self.connection
+        self._statement_time += elapsed
+        conn.observe(self._sql, elapsed, rows, self._statement_time)
+        if (not self._slow_logged and conn.slow_query_ms is not None
+                and self._statement_time * 1000 >= conn.slow_query_ms):
+            self._slow_logged = True
+            conn.on_slow(self._sql, self._statement_time)
+
+    def execute(self, sql, params=()):
+        return self._run(super().execute, sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self._run(super().executemany, sql, seq_of_params)
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = super().fetchone()
+        self._observe(time.perf_counter() - start, row is not None)
+        return row
+
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self._observe(time.perf_counter() - start, len(rows))
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = super().fetchall()
+        self._observe(time.perf_counter() - start, len(rows))
+        return rows
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self._observe(time.perf_counter() - start, 0)
+            raise
+        self._observe(time.perf_counter() - start, 1)
+        return row
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    # 記錄 SQL 次數、時間、列數（請求期間 trace 指向 metrics.QueryTrace），
+    # 統計鎖競爭失敗（SQLITE_BUSY），超過門檻的語句寫入慢查詢日誌
+    trace = None
+    on_busy = None
+    on_slow = None
+    slow_query_ms = None
+
+    def record_error(self, exc):
+        if self.on_busy is not None and is_busy(exc):
+            self.on_busy()
+
+    def statement(self):
+        if self.trace is not None:
+            self.trace.statement()
+
+    def observe(self, sql, elapsed, rows, statement_time):
+        if self.trace is not None:
+            self.trace.add(sql, elapsed, rows, statement_time)
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self.cursor().executemany(sql, seq_of_params)
+
+    def commit(self):
+        start = time.perf_counter()
+        try:
+            super().commit()
+        except sqlite3.OperationalError as e:
+            self.record_error(e)
+            raise
+        finally:
+            self.statement()
+            elapsed = time.perf_counter() - start
+            self.observe('COMMIT', elapsed, 0, elapsed)
+            if self.slow_query_ms is not None and elapsed * 1000 >= self.slow_query_ms:
+                self.on_slow('COMMIT', elapsed)
+
+
+class ConnectionPool:
+    def __init__(self, database, size=8, timeout=5.0, busy_timeout=5000,
+                 journal_mode='WAL', synchronous='NORMAL', cached_statements=256, slow_query_ms=None):
+        self.database = database
+        self.size = size
+        self.timeout = timeout
+        self.busy_timeout = busy_timeout
+        self.journal_mode = journal_mode
+        self.synchronous = synchronous
+        self.cached_statements = cached_statements
+        self.slow_query_ms = slow_query_ms
+
+        # LIFO：優先拿最近用過的連線，statement cache 比較熱
+        self._idle = LifoQueue()
+        self._lock = threading.Lock()
+        self._created = 0
+        self._counters = {'acquired': 0, 'released': 0, 'waits': 0, 'discarded': 0,
+                          'busy_errors': 0, 'busy_retries': 0}
+
+    def _connect(self):
+        conn = sqlite3.connect(self.database,
+                               timeout=self.busy_timeout / 1000,
+                               check_same_thread=False,
+                               cached_statements=self.cached_statements,
+                               factory=InstrumentedConnection)
+        conn.on_busy = self._count_busy
+        conn.on_slow = self._log_slow
+        conn.slow_query_ms = self.slow_query_ms
+        conn.row_factory = sqlite3.Row
+        # WAL 讓讀取不會擋住寫入；journal_mode 會寫進資料庫檔，重複設定無妨
+        conn.execute(f'PRAGMA journal_mode = {self.journal_mode}')
+        conn.execute(f'PRAGMA busy_timeout = {int(self.busy_timeout)}')
+        conn.execute(f'PRAGMA synchronous = {self.synchronous}')
+        return conn
+
+    def acquire(self):
+        try:
+            conn = self._idle.get_nowait()
+        except Empty:
+            conn = None
+            with self._lock:
+                if self._created < self.size:
+                    self._created += 1
+                    create = True
+                else:
+                    create = False
+                    self._counters['waits'] += 1
+            if create:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._lock:
+                        self._created -= 1
+                    raise
+            else:
+                try:
+                    conn = self._idle.get(timeout=self.timeout)
+                except Empty:
+                    raise PoolTimeout('連線池已滿，等待逾時') from None
+
+        with self._lock:
+            self._counters['acquired'] += 1
+        return conn
+
+    def release(self, conn):
+        try:
+            # 請求中途出錯沒有 commit 的交易一律回滾，避免把鎖帶回池裡
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            self._discard(conn)
+            return
+
+        with self._lock:
+            self._counters['released'] += 1
+        self._idle.put(conn)
+
+    def _count_busy(self):
+        with self._lock:
+            self._counters['busy_errors'] += 1
+
+    def count_retry(self):
+        with self._lock:
+            self._counters['busy_retries'] += 1
+
+    def _log_slow(self, sql, elapsed):
+        metrics.registry.record_slow_query()
+        slow_query_log.warning('慢查詢 %.1f ms: %s', elapsed * 1000, metrics.normalize_sql(sql))
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+        with self._lock:
+            self._created -= 1
+            self._counters['discarded'] += 1
+
+    @contextmanager
+    def connection(self):
+        # 給請求以外的地方（CLI、背景執行緒）使用
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close_all(self):
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._created -= 1
+
+    def stats(self):
+        with self._lock:
+            created = self._created
+            counters = dict(self._counters)
+        idle = self._idle.qsize()
+        return {
+            'database': self.database,
+            'size': self.size,
+            'journal_mode': self.journal_mode,
+            'synchronous': self.synchronous,
+            'busy_timeout': self.busy_timeout,
+            'created': created,
+            'idle': idle,
+            'in_use': created - idle,
+            **counters,
+        }
+
+
+def init_app(app):
+    app.config.setdefault('DB_POOL_SIZE', 8)
+    app.config.setdefault('DB_POOL_TIMEOUT', 5.0)
+    app.config.setdefault('DB_BUSY_TIMEOUT', 5000)
+    app.config.setdefault('DB_JOURNAL_MODE', 'WAL')
+    app.config.setdefault('DB_SYNCHRONOUS', 'NORMAL')
+    app.config.setdefault('SLOW_QUERY_MS', None)
+    app.config.setdefault('DB_BUSY_RETRIES', 3)
+    app.config.setdefault('DB_BUSY_BACKOFF_MS', 10)
+    app.teardown_appcontext(close_db)
+
+
+def get_pool(app=None):
+    app = app or current_app
+    pool = app.extensions.get('db_pool')
+    if pool is None:
+        # 第一次使用時才依設定建立，方便在 import 之後調整 app.config
+        with _pool_lock:
+            pool = app.extensions.get('db_pool')
+            if pool is None:
+                pool = ConnectionPool(app.config['DATABASE'],
+                                      size=app.config['DB_POOL_SIZE'],
+                                      timeout=app.config['DB_POOL_TIMEOUT'],
+                                      busy_timeout=app.config['DB_BUSY_TIMEOUT'],
+                                      journal_mode=app.config['DB_JOURNAL_MODE'],
+                                      synchronous=app.config['DB_SYNCHRONOUS'],
+                                      slow_query_ms=app.config['SLOW_QUERY_MS'])
+                app.extensions['db_pool'] = pool
+    return pool
+
+
+def get_db():
+    if 'db' not in g:
+        g.db = get_pool().acquire()
+        g.db.trace = metrics.QueryTrace()
+    return g.db
+
+
+def close_db(exc=None):
+    conn = g.pop('db', None)
+    if conn is not None:
+        conn.trace = None
+        get_pool().release(conn)
+
+
+def write_transaction(conn, work, retries=None, backoff_ms=None):
+    # 以 BEGIN IMMEDIATE 開始寫入交易並執行 work(conn)，成功就 commit 並回傳結果。
+    # 開頭就拿寫鎖，交易中途不會因為升級鎖失敗而回滾；busy_timeout 等完仍遇到
+    # SQLITE_BUSY 時整個交易重試，最多 retries 次，間隔以指數退避加隨機抖動。
+    if retries is None:
+        retries = current_app.config['DB_BUSY_RETRIES']
+    if backoff_ms is None:
+        backoff_ms = current_app.config['DB_BUSY_BACKOFF_MS']
+
+    for attempt in range(retries + 1):
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            result = work(conn)
+            conn.commit()
+            return result
+        except sqlite3.OperationalError as e:
+            if conn.in_transaction:
+                conn.rollback()
+            if not is_busy(e) or attempt == retries:
+                raise
+            get_pool().count_retry()
+            time.sleep(backoff_ms / 1000 * 2 ** attempt * random.uniform(0.5, 1.5))
+        except Exception:
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+
+
+class AsyncDatabase:
+    # ASGI 模式的資料存取：同步的資料函式丟到有上限的執行緒池執行，每次呼叫向連線池借一條連線，
+    # event loop 不會被 SQLite I/O 擋住。執行緒數預設等於連線池大小，多出來的呼叫在執行緒池外排隊，
+    # 不會在連線池裡等到逾時。
+    def __init__(self, app, workers=None):
+        self.app = app
+        self.executor = ThreadPoolExecutor(max_workers=workers or app.config['DB_POOL_SIZE'],
+                                           thread_name_prefix='async-db')
+
+    async def call(self, fn, *args, **kwargs):
+        # 在執行緒池裡以 app context 執行 fn，裡面可以用 current_app
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(self._in_app, fn, *args, **kwargs))
+
+    def _in_app(self, fn, *args, **kwargs):
+        with self.app.app_context():
+            return fn(*args, **kwargs)
+
+    async def run(self, fn, *args, **kwargs):
+        # fn(conn, *args)：直接重用既有的資料函式，例如 notifications.unread_count
+        return await self.call(self._with_connection, fn, *args, **kwargs)
+
+    def _with_connection(self, fn, *args, **kwargs):
+        with get_pool(self.app).connection() as conn:
+            return fn(conn, *args, **kwargs)
+
+    async def fetchone(self, sql, params=()):
+        return await self.run(lambda conn: conn.execute(sql, params).fetchone())
+
+    async def fetchall(self, sql, params=()):
+        return await self.run(lambda conn: conn.execute(sql, params).fetchall())
+
+    async def write(self, work, **kwargs):
+        # work(conn) 在 write_transaction 裡執行（BEGIN IMMEDIATE、SQLITE_BUSY 重試）
+        return await self.run(write_transaction, work, **kwargs)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,206 @@
+# 自動派單
+# 待配送的訂單放在行程內的優先佇列（heapq，依進入待配送的時間排序，越早越先派）；
+# 外送員在「我的配送」頁面上線後進入可派單名單。每當有新訂單或外送員空出手時，
+# 從佇列取出一批訂單，依派單策略挑選外送員，整批在同一個寫入交易裡完成指派。
+# 指派沿用 order_state.transition('claim') 的 compare-and-set，已被手動接走的訂單直接略過，
+# 所以多個 worker 行程各自派單也不會重複指派。
+# 注意：佇列與上線名單都在記憶體裡，行程重啟後佇列從資料庫重建，外送員需重新上線。
+#
+# 派單策略：
+#   round_robin   依外送員編號輪流分配
+#   least_loaded  交給進行中配送最少的外送員（同樣多時交給等最久的）
+#   oldest_first  最早的訂單交給上線等待最久的外送員
+import heapq
+import threading
+import time
+
+import db
+import events
+import order_state
+
+# 算進外送員負載的狀態（已送達之後外送員就空出手了）
+ACTIVE_STATES = (order_state.CLAIMED, order_state.PICKING_UP)
+
+
+def round_robin(dispatcher, candidates, loads):
+    ordered = sorted(candidates)
+    last = dispatcher.last_assigned
+    return next((courier_id for courier_id in ordered if last is None or courier_id > last), ordered[0])
+
+
+def least_loaded(dispatcher, candidates, loads):
+    return min(candidates, key=lambda courier_id: (loads[courier_id], dispatcher.available[courier_id]))
+
+
+def oldest_first(dispatcher, candidates, loads):
+    return min(candidates, key=lambda courier_id: dispatcher.available[courier_id])
+
+
+POLICIES = {
+    'round_robin': round_robin,
+    'least_loaded': least_loaded,
+    'oldest_first': oldest_first,
+}
+
+
+def _utcnow():
+    # 與 SQLite datetime('now') 相同格式，才能和資料庫讀出的 state_changed_at 一起排序
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())
+
+
+class Dispatcher:
+    def __init__(self, policy='least_loaded', batch_size=50, max_active=2):
+        if policy not in POLICIES:
+            raise ValueError(f'未知的派單策略：{policy}（可用：{", ".join(POLICIES)}）')
+        self.policy = policy
+        self.batch_size = batch_size
+        self.max_active = max_active
+        self.available = {}         # courier_id -> 開始等待的時間
+        self.last_assigned = None
+
+        self._lock = threading.Lock()
+        self._run_lock = threading.Lock()
+        self._pending = False
+        self._loaded = False
+        self._queue = []            # (ready_at, order_id)
+        self._queued = set()        # 仍有效的佇列項目；被移除的項目在 pop 時略過
+        self._counters = {'enqueued': 0, 'assigned': 0, 'conflicts': 0, 'batches': 0}
+
+    def enqueue(self, order_ids, ready_at=None):
+        if isinstance(order_ids, int):
+            order_ids = [order_ids]
+        ready_at = ready_at or _utcnow()
+        with self._lock:
+            for order_id in order_ids:
+                if order_id not in self._queued:
+                    self._queued.add(order_id)
+                    heapq.heappush(self._queue, (ready_at, order_id))
+                    self._counters['enqueued'] += 1
+
+    def discard(self, order_id):
+        # 訂單已被手動接走；堆積裡的項目留著，取出時再略過
+        with self._lock:
+            self._queued.discard(order_id)
+
+    def set_available(self, courier_id, available):
+        with self._lock:
+            if not available:
+                self.available.pop(courier_id, None)
+            elif courier_id not in self.available:
+                self.available[courier_id] = time.monotonic()
+
+    def is_available(self, courier_id):
+        return courier_id in self.available
+
+    def _load_queue(self, conn):
+        rows = conn.execute('SELECT id, state_changed_at FROM orders WHERE state = ? ORDER BY id',
+                            (order_state.READY,)).fetchall()
+        with self._lock:
+            if self._loaded:
+                return
+            for row in rows:
+                if row['id'] not in self._queued:
+                    self._queued.add(row['id'])
+                    self._queue.append((row['state_changed_at'] or '', row['id']))
+            heapq.heapify(self._queue)
+            self._loaded = True
+
+    def _loads(self, conn, couriers):
+        # 走 idx_orders_delivery_person (delivery_person_id, state)
+        loads = dict.fromkeys(couriers, 0)
+        rows = conn.execute(f'''
+            SELECT delivery_person_id, COUNT(*) AS active FROM orders
+            WHERE delivery_person_id IN ({','.join('?' * len(couriers))})
+              AND state IN ({','.join('?' * len(ACTIVE_STATES))})
+            GROUP BY delivery_person_id
+        ''', (*couriers, *ACTIVE_STATES)).fetchall()
+        for row in rows:
+            loads[row['delivery_person_id']] = row['active']
+        return loads
+
+    def _plan(self, loads):
+        # 在 self._lock 內呼叫：從佇列取出訂單並決定外送員
+        choose = POLICIES[self.policy]
+        candidates = [courier_id for courier_id in loads
+                      if courier_id in self.available and loads[courier_id] < self.max_active]
+        plan = []
+        while self._queue and candidates and len(plan) < self.batch_size:
+            _, order_id = heapq.heappop(self._queue)
+            if order_id not in self._queued:
+                continue
+            self._queued.discard(order_id)
+            courier_id = choose(self, candidates, loads)
+            plan.append((order_id, courier_id))
+            loads[courier_id] += 1
+            self.available[courier_id] = time.monotonic()
+            self.last_assigned = courier_id
+            if loads[courier_id] >= self.max_active:
+                candidates.remove(courier_id)
+        return plan
+
+    def _write(self, conn, plan):
+        return [(order_id, courier_id) for order_id, courier_id in plan
+                if order_state.transition(conn, 'claim', order_id, assign={'delivery_person_id': courier_id})]
+
+    def _run_batches(self, conn):
+        assigned = []
+        while True:
+            if not self._loaded:
+                self._load_queue(conn)
+            couriers = list(self.available)
+            if not self._queued or not couriers:
+                return assigned
+            loads = self._loads(conn, couriers)
+            with self._lock:
+                plan = self._plan(loads)
+            if not plan:
+                return assigned
+
+            try:
+                claimed = db.write_transaction(conn, lambda c: self._write(c, plan))
+            except Exception:
+                # 交易失敗時把訂單放回佇列，下次再派
+                self.enqueue([order_id for order_id, _ in plan])
+                raise
+            events.publish_orders(conn, [order_id for order_id, _ in claimed])
+            with self._lock:
+                self._counters['batches'] += 1
+                self._counters['assigned'] += len(claimed)
+                self._counters['conflicts'] += len(plan) - len(claimed)
+            assigned += claimed
+
+    def dispatch(self, conn):
+        # 同一時間只有一個執行緒在派單；其他執行緒只留下記號，由正在派單的那個再跑一輪
+        self._pending = True
+        assigned = []
+        while self._pending:
+            if not self._run_lock.acquire(blocking=False):
+                return assigned
+            try:
+                self._pending = False
+                assigned += self._run_batches(conn)
+            finally:
+                self._run_lock.release()
+        return assigned
+
+    def stats(self):
+        with self._lock:
+            return {'policy': self.policy,
+                    'queued': len(self._queued),
+                    'available_couriers': len(self.available),
+                    **self._counters}
+
+
+def active_deliveries(conn, courier_id):
+    # 外送員自己的配送，走 idx_orders_delivery_person，不必掃整張外送看板
+    states = (*ACTIVE_STATES, order_state.DELIVERED)
+    return conn.execute(f'''
+        SELECT orders.id AS id, orders.customer_id AS customer_id, users.username AS customer_name,
+               orders.merchant_id AS merchant_id, merchants.username AS merchant_name,
+               orders.item_name AS item_name, orders.price AS price, orders.state AS status
+        FROM orders
+        JOIN users ON orders.customer_id = users.id
+        JOIN users AS merchants ON orders.merchant_id = merchants.id
+        WHERE orders.delivery_person_id = ? AND orders.state IN ({','.join('?' * len(states))})
+        ORDER BY orders.id
+    ''', (courier_id, *states)).fetchall()
@@ -0,0 +1,217 @@
+# 行程內的訂單事件匯流排，給 /events 的 Server-Sent Events 使用
+# 寫入路徑 commit 之後呼叫 publish_orders()，只把有變動的訂單推給訂閱的角色：
+#   couriers          外送員看板（待配送及之後的狀態）
+#   merchant:<id>     商家自己的訂單
+#   customer:<id>     顧客自己的訂單
+# 最近的事件保留在環狀緩衝區，斷線重連時依 Last-Event-ID 補送。
+# ASGI 模式（asgi.py）用 astream() / poll() 在 event loop 上等待，不佔用執行緒。
+import asyncio
+import json
+import threading
+from collections import deque
+from queue import Empty, Full, Queue
+
+import order_state
+import versions
+
+HEARTBEAT_SECONDS = 15
+
+
+class Subscription:
+    def __init__(self, topics, maxsize):
+        self.topics = frozenset(topics)
+        self.queue = Queue(maxsize=maxsize)
+        self.closed = False
+        # ASGI 模式：放入項目後叫醒等待中的 event loop（見 EventBus._attach_loop）
+        self.waker = None
+
+    def wake(self):
+        if self.waker is not None:
+            try:
+                self.waker()
+            except RuntimeError:
+                # event loop 已經關閉（伺服器停止中）
+                pass
+
+
+def format_event(item):
+    event_id, _, event, data = item
+    return f'id: {event_id}\nevent: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n'
+
+
+class EventBus:
+    def __init__(self, history=1000, queue_size=1000):
+        self.queue_size = queue_size
+        self._lock = threading.Lock()
+        self._history = deque(maxlen=history)
+        self._subscribers = set()
+        self._next_id = 1
+        self._counters = {'published': 0, 'delivered': 0, 'dropped_subscribers': 0}
+
+    def publish(self, topics, event, data):
+        topics = frozenset(topics)
+        with self._lock:
+            item = (self._next_id, topics, event, data)
+            self._next_id += 1
+            self._history.append(item)
+            self._counters['published'] += 1
+            subscribers = [s for s in self._subscribers if s.topics & topics]
+
+        delivered = dropped = 0
+        for sub in subscribers:
+            try:
+                sub.queue.put_nowait(item)
+                sub.wake()
+                delivered += 1
+            except Full:
+                # 客戶端跟不上就斷開，重連時從歷史補送
+                self.unsubscribe(sub)
+                dropped += 1
+        with self._lock:
+            self._counters['delivered'] += delivered
+            self._counters['dropped_subscribers'] += dropped
+        return item[0]
+
+    def subscribe(self, topics, last_event_id=None):
+        sub = Subscription(topics, self.queue_size)
+        with self._lock:
+            if last_event_id is not None:
+                for item in self._history:
+                    if item[0] > last_event_id and item[1] & sub.topics:
+                        sub.queue.put_nowait(item)
+            self._subscribers.add(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            self._subscribers.discard(sub)
+        if not sub.closed:
+            sub.closed = True
+            try:
+                sub.queue.put_nowait(None)
+            except Full:
+                pass
+            sub.wake()
+
+    def stream(self, sub, heartbeat=HEARTBEAT_SECONDS):
+        # SSE 格式的產生器；閒置時送註解行當心跳，順便偵測斷線
+        try:
+            yield 'retry: 3000\n\n'
+            while True:
+                try:
+                    item = sub.queue.get(timeout=heartbeat)
+                except Empty:
+                    yield ': ping\n\n'
+                    continue
+                if item is None:
+                    break
+                yield format_event(item)
+        finally:
+            self.unsubscribe(sub)
+
+    def _attach_loop(self, sub):
+        # publish 可能在任何執行緒呼叫，只能透過 call_soon_threadsafe 通知 event loop
+        loop = asyncio.get_running_loop()
+        ready = asyncio.Event()
+        sub.waker = lambda: loop.call_soon_threadsafe(ready.set)
+        return ready
+
+    async def _aget(self, sub, ready, timeout):
+        # 逾時丟出 Empty；先清掉旗標再檢查一次佇列，避免漏掉清旗標前剛放進來的項目
+        while True:
+            try:
+                return sub.queue.get_nowait()
+            except Empty:
+                pass
+            ready.clear()
+            if not sub.queue.empty():
+                continue
+            try:
+                await asyncio.wait_for(ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                raise Empty from None
+
+    async def astream(self, sub, heartbeat=HEARTBEAT_SECONDS):
+        # stream() 的非同步版本，等待時不佔用執行緒
+        ready = self._attach_loop(sub)
+        try:
+            yield 'retry: 3000\n\n'
+            while True:
+                try:
+                    item = await self._aget(sub, ready, heartbeat)
+                except Empty:
+                    yield ': ping\n\n'
+                    continue
+                if item is None:
+                    break
+                yield format_event(item)
+        finally:
+            self.unsubscribe(sub)
+
+    async def poll(self, topics, last_event_id=None, timeout=HEARTBEAT_SECONDS):
+        # long-poll：等到至少一個事件或逾時，回傳 [(id, event, data), ...]
+        sub = self.subscribe(topics, last_event_id)
+        ready = self._attach_loop(sub)
+        items = []
+        try:
+            try:
+                items.append(await self._aget(sub, ready, timeout))
+            except Empty:
+                return []
+            while True:
+                try:
+                    items.append(sub.queue.get_nowait())
+                except Empty:
+                    break
+        finally:
+            self.unsubscribe(sub)
+        return [(event_id, event, data) for event_id, _, event, data in filter(None, items)]
+
+    def stats(self):
+        with self._lock:
+            return {'subscribers': len(self._subscribers),
+                    'last_event_id': self._next_id - 1,
+                    **self._counters}
+
+
+bus = EventBus()
+
+
+def topics_for(role, user_id):
+    if role == 'delivery_person':
+        return {'couriers'}
+    if role == 'merchant':
+        return {f'merchant:{user_id}'}
+    if role == 'customer':
+        return {f'customer:{user_id}'}
+    return set()
+
+
+def publish_orders(conn, order_ids):
+    # 讀出已提交的最新狀態再推送，避免推出被回滾的變更
+    if isinstance(order_ids, int):
+        order_ids = [order_ids]
+    if not order_ids:
+        return
+
+    order_ids = list(order_ids)
+    rows = []
+    for start in range(0, len(order_ids), 500):
+        chunk = order_ids[start:start + 500]
+        rows += conn.execute(f'''
+            SELECT id, customer_id, merchant_id, delivery_person_id, state, status,
+                   acceptance_status, delivery_status, item_name, price
+            FROM orders WHERE id IN ({','.join('?' * len(chunk))})
+        ''', chunk).fetchall()
+
+    for row in rows:
+        # 條件式 GET 的版本號：相關使用者的訂單頁、外送員看板（剛進入或離開待配送）
+        versions.registry.bump('orders', row['customer_id'], row['merchant_id'], row['delivery_person_id'])
+        if row['state'] in (order_state.READY, order_state.CLAIMED):
+            versions.registry.bump('delivery_board')
+        topics = {f"customer:{row['customer_id']}"}
+        if row['state'] != order_state.PLACED:
+            topics.add(f"merchant:{row['merchant_id']}")
+        if row['state'] in order_state.DELIVERY_STATES:
+            topics.add('couriers')
+        bus.publish(topics, 'order', dict(row))
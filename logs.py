@@ -0,0 +1,140 @@
+# 結構化日誌
+# 請求執行緒只把 LogRecord 放進佇列（滿了就丟棄並計數，不會等待），
+# 由背景的 QueueListener 格式化成 JSON 一行一筆寫到 stderr 或檔案。
+# 每筆記錄自動帶上請求資訊（endpoint、method、path、user_id），
+# 呼叫端用 extra={...} 附加欄位；DEBUG / INFO 可依 endpoint 抽樣，WARNING 以上一律保留。
+#
+# 設定（環境變數）：
+#   DELIVERY_LOG_LEVEL      預設 INFO
+#   DELIVERY_LOG_FILE       預設寫到 stderr
+#   DELIVERY_LOG_SAMPLING   例如 "orders=0.01,deliver_order=0.1"
+import atexit
+import json
+import logging
+import logging.handlers
+import random
+import sys
+import threading
+from datetime import datetime, timezone
+from queue import Full, Queue
+
+from flask import has_request_context, request, session
+
+ROOT_LOGGER = 'delivery'
+QUEUE_SIZE = 10000
+
+# LogRecord 本身的屬性，其餘的都是呼叫端用 extra 傳進來的欄位
+_RESERVED = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+def get_logger(name):
+    return logging.getLogger(f'{ROOT_LOGGER}.{name}')
+
+
+def parse_sampling(text):
+    rates = {}
+    for part in (text or '').split(','):
+        endpoint, sep, rate = part.partition('=')
+        if sep:
+            try:
+                rates[endpoint.strip()] = max(0.0, min(1.0, float(rate)))
+            except ValueError:
+                pass
+    return rates
+
+
+class RequestContextFilter(logging.Filter):
+    # 在請求執行緒裡執行，趁還拿得到 request / session 時記下來
+    def filter(self, record):
+        if has_request_context():
+            record.endpoint = request.endpoint
+            record.method = request.method
+            record.path = request.path
+            record.user_id = session.get('user_id')
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or not self.rates:
+            return True
+        rate = self.rates.get(getattr(record, 'endpoint', None))
+        return rate is None or random.random() < rate
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RESERVED and value is not None:
+                entry[key] = value
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    # 佇列滿時直接丟棄，請求執行緒永遠不等待 I/O
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+        self._lock = threading.Lock()
+
+    def prepare(self, record):
+        # 例外堆疊要在原執行緒格式化；訊息參數先合併，避免背景執行緒格式化時物件已改變
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            with self._lock:
+                self.dropped += 1
+
+
+_listener = None
+_handler = None
+
+
+def init_app(app):
+    global _listener, _handler
+    level = app.config.get('LOG_LEVEL', 'INFO')
+    logger = logging.getLogger(ROOT_LOGGER)
+    logger.setLevel(level)
+    logger.propagate = False
+
+    if _listener is None:
+        if app.config.get('LOG_FILE'):
+            output = logging.FileHandler(app.config['LOG_FILE'], encoding='utf-8')
+        else:
+            output = logging.StreamHandler(sys.stderr)
+        output.setFormatter(JsonFormatter())
+
+        _handler = DroppingQueueHandler(Queue(maxsize=app.config.get('LOG_QUEUE_SIZE', QUEUE_SIZE)))
+        _handler.addFilter(RequestContextFilter())
+        _handler.addFilter(SamplingFilter(parse_sampling(app.config.get('LOG_SAMPLING'))))
+        logger.addHandler(_handler)
+
+        _listener = logging.handlers.QueueListener(_handler.queue, output, respect_handler_level=True)
+        _listener.start()
+        atexit.register(_listener.stop)
+
+
+def stats():
+    if _handler is None:
+        return {'queued': 0, 'dropped': 0}
+    return {'queued': _handler.queue.qsize(), 'dropped': _handler.dropped}
@@ -0,0 +1,197 @@
+# 請求與 SQL 指標，/metrics 以 Prometheus 文字格式輸出
+# 每個請求借到的連線帶一個 QueryTrace（見 db.py），記錄查詢次數、SQL 時間、讀出的列數與最慢的語句；
+# 請求結束時依 endpoint 累加到這裡的計數器與直方圖。
+import re
+import threading
+import time
+
+from flask import g, request
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200)
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r'\b\d+(?:\.\d+)?\b')
+_IN_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+_SPACES = re.compile(r'\s+')
+
+
+def normalize_sql(sql):
+    # 把常數換成 ?、IN 清單縮成一個，方便把同一種查詢歸在一起
+    sql = _STRING.sub('?', sql)
+    sql = _NUMBER.sub('?', sql)
+    sql = _IN_LIST.sub('(?, ...)', sql)
+    return _SPACES.sub(' ', sql).strip()
+
+
+class QueryTrace:
+    def __init__(self):
+        self.queries = 0
+        self.sql_time = 0.0
+        self.rows = 0
+        self.slowest_sql = None
+        self.slowest_time = 0.0
+
+    def statement(self):
+        self.queries += 1
+
+    def add(self, sql, elapsed, rows, statement_time):
+        self.sql_time += elapsed
+        self.rows += rows
+        if statement_time > self.slowest_time:
+            self.slowest_sql = sql
+            self.slowest_time = statement_time
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.series = {}
+
+    def observe(self, labels, value):
+        counts, total = self.series.get(labels, ([0] * len(self.buckets), [0, 0.0]))
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+        total[0] += 1
+        total[1] += value
+        self.series[labels] = (counts, total)
+
+
+def _labels(names, values, extra=None):
+    pairs = list(zip(names, values)) + list(extra or [])
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', ' ') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.request_latency = Histogram(LATENCY_BUCKETS)
+        self.request_queries = Histogram(QUERY_COUNT_BUCKETS)
+        self.requests = {}
+        self.db = {}
+        self.slowest = {}
+        self.slow_queries = 0
+        # 條件式 GET：(endpoint, 'not_modified' | 'full') -> 次數
+        self.conditional = {}
+        self._collectors = []
+
+    def add_collector(self, collector):
+        # collector() 回傳 [(名稱, 型別, 說明, 值), ...]，輸出 /metrics 時才呼叫
+        self._collectors.append(collector)
+
+    def record_request(self, endpoint, method, status, elapsed, trace):
+        with self._lock:
+            self.request_latency.observe((endpoint, method), elapsed)
+            key = (endpoint, method, str(status))
+            self.requests[key] = self.requests.get(key, 0) + 1
+            if trace is None:
+                return
+            self.request_queries.observe((endpoint,), trace.queries)
+            queries, sql_time, rows = self.db.get(endpoint, (0, 0.0, 0))
+            self.db[endpoint] = (queries + trace.queries, sql_time + trace.sql_time, rows + trace.rows)
+            if trace.slowest_sql is not None and trace.slowest_time > self.slowest.get(endpoint, (None, 0.0))[1]:
+                self.slowest[endpoint] = (normalize_sql(trace.slowest_sql), trace.slowest_time)
+
+    def record_slow_query(self):
+        with self._lock:
+            self.slow_queries += 1
+
+    def record_conditional(self, endpoint, not_modified):
+        key = (endpoint, 'not_modified' if not_modified else 'full')
+        with self._lock:
+            self.conditional[key] = self.conditional.get(key, 0) + 1
+
+    def conditional_stats(self):
+        # 各頁面回 304 的比例
+        with self._lock:
+            counts = dict(self.conditional)
+        stats = {}
+        for endpoint in sorted({endpoint for endpoint, _ in counts}):
+            not_modified = counts.get((endpoint, 'not_modified'), 0)
+            total = not_modified + counts.get((endpoint, 'full'), 0)
+            stats[endpoint] = {'requests': total, 'not_modified': not_modified,
+                               'hit_ratio': round(not_modified / total, 4)}
+        return stats
+
+    def render(self):
+        lines = []
+
+        def header(name, kind, help_text):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+
+        def histogram(name, help_text, hist, label_names):
+            header(name, 'histogram', help_text)
+            for labels, (counts, (count, total)) in sorted(hist.series.items()):
+                for bound, bucket_count in zip(hist.buckets, counts):
+                    lines.append(f'{name}_bucket{_labels(label_names, labels, [("le", bound)])} {bucket_count}')
+                lines.append(f'{name}_bucket{_labels(label_names, labels, [("le", "+Inf")])} {count}')
+                lines.append(f'{name}_sum{_labels(label_names, labels)} {total}')
+                lines.append(f'{name}_count{_labels(label_names, labels)} {count}')
+
+        with self._lock:
+            histogram('http_request_duration_seconds', '每個 endpoint 的回應時間',
+                      self.request_latency, ('endpoint', 'method'))
+            header('http_requests_total', 'counter', '請求數')
+            for labels, value in sorted(self.requests.items()):
+                lines.append(f"http_requests_total{_labels(('endpoint', 'method', 'status'), labels)} {value}")
+
+            histogram('db_queries_per_request', '每個請求執行的 SQL 數', self.request_queries, ('endpoint',))
+            header('db_queries_total', 'counter', '各 endpoint 執行的 SQL 數')
+            for endpoint, (queries, _, _) in sorted(self.db.items()):
+                lines.append(f"db_queries_total{_labels(('endpoint',), (endpoint,))} {queries}")
+            header('db_query_seconds_total', 'counter', '各 endpoint 花在 SQL 的時間')
+            for endpoint, (_, sql_time, _) in sorted(self.db.items()):
+                lines.append(f"db_query_seconds_total{_labels(('endpoint',), (endpoint,))} {sql_time}")
+            header('db_rows_total', 'counter', '各 endpoint 讀出的資料列數')
+            for endpoint, (_, _, rows) in sorted(self.db.items()):
+                lines.append(f"db_rows_total{_labels(('endpoint',), (endpoint,))} {rows}")
+            header('db_slowest_query_seconds', 'gauge', '各 endpoint 目前為止最慢的語句')
+            for endpoint, (sql, seconds) in sorted(self.slowest.items()):
+                lines.append(f"db_slowest_query_seconds{_labels(('endpoint', 'sql'), (endpoint, sql))} {seconds}")
+            header('db_slow_queries_total', 'counter', '超過慢查詢門檻的語句數')
+            lines.append(f'db_slow_queries_total {self.slow_queries}')
+            header('http_conditional_get_total', 'counter', '可條件式 GET 的頁面：回 304 或完整渲染的次數')
+            for labels, value in sorted(self.conditional.items()):
+                lines.append(f"http_conditional_get_total{_labels(('endpoint', 'result'), labels)} {value}")
+            collectors = list(self._collectors)
+
+        for collector in collectors:
+            for name, kind, help_text, value in collector():
+                header(name, kind, help_text)
+                lines.append(f'{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+def init_app(app):
+    @app.before_request
+    def _start_timer():
+        g.request_started = time.perf_counter()
+
+    @app.teardown_request
+    def _record_request(exc=None):
+        started = g.pop('request_started', None)
+        if started is None:
+            return
+        conn = g.get('db')
+        trace = getattr(conn, 'trace', None)
+        status = g.pop('response_status', 500 if exc else 200)
+        registry.record_request(request.endpoint or 'unknown', request.method, status,
+                                time.perf_counter() - started, trace)
+
+    @app.after_request
+    def _server_timing(response):
+        g.response_status = response.status_code
+        trace = getattr(g.get('db'), 'trace', None)
+        if trace is not None and trace.queries:
+            # 瀏覽器開發者工具可直接看到每個請求的 SQL 成本
+            response.headers['Server-Timing'] = (f'db;dur={trace.sql_time * 1000:.2f};'
+                                                 f'desc="{trace.queries} queries, {trace.rows} rows"')
+        return response
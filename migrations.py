@@ -0,0 +1,544 @@
+# 資料庫結構版本管理
+# 每個 migration 依版本號依序套用一次，已套用的版本記錄在 schema_version 表。
+# 步驟可以是 SQL 字串，也可以是接收連線的函式（需要判斷現況時使用）。
+# 執行方式：flask migrate
+import sqlite3
+from datetime import datetime, timezone
+
+import archive
+import order_state
+import settlements
+
+
+def _backfill_order_state(conn):
+    # 依舊有欄位推出每筆訂單目前的狀態，再依狀態把舊欄位統一改寫
+    conn.execute('''
+        UPDATE orders SET state = CASE
+            WHEN status = '已完成' THEN :completed
+            WHEN delivery_status = '已送達' THEN :delivered
+            WHEN delivery_status = '取貨中' THEN :picking_up
+            WHEN delivery_status = '已接單' THEN :claimed
+            WHEN acceptance_status = '已拒絕'
+                 OR EXISTS (SELECT 1 FROM merchant_orders mo
+                            WHERE mo.order_id = orders.id AND mo.acceptance_status = '已拒絕') THEN :rejected
+            WHEN EXISTS (SELECT 1 FROM merchant_orders mo
+                         WHERE mo.order_id = orders.id AND mo.delivery_status = '已通知') THEN :ready
+            WHEN acceptance_status = '已接單'
+                 OR EXISTS (SELECT 1 FROM merchant_orders mo
+                            WHERE mo.order_id = orders.id AND mo.acceptance_status = '已接單') THEN :accepted
+            WHEN status = '已確認' THEN :confirmed
+            ELSE :placed
+        END,
+        state_changed_at = datetime('now')
+    ''', {'completed': order_state.COMPLETED, 'delivered': order_state.DELIVERED,
+          'picking_up': order_state.PICKING_UP, 'claimed': order_state.CLAIMED,
+          'rejected': order_state.REJECTED, 'ready': order_state.READY,
+          'accepted': order_state.ACCEPTED, 'confirmed': order_state.CONFIRMED,
+          'placed': order_state.PLACED})
+
+    for state, (status, acceptance_status, delivery_status) in order_state.PROJECTIONS.items():
+        conn.execute('UPDATE orders SET status = ?, acceptance_status = ?, delivery_status = ? WHERE state = ?',
+                     (status, acceptance_status, delivery_status, state))
+
+
+def _adopt_orphan_merchant_orders(conn):
+    # 顧客刪掉 orders 列後，商家表的那一列仍然留著；先以原本的 order_id 補回 orders，
+    # 之後的狀態回填與 view 才看得到這些歷史訂單
+    conn.execute('''
+        INSERT INTO orders (id, customer_id, merchant_id, delivery_person_id, delivery_status, item_id,
+                            status, price, item_name, acceptance_status)
+        SELECT order_id, customer_id, merchant_id, delivery_person_id, delivery_status, item_id,
+               status, price, item_name, acceptance_status
+        FROM merchant_orders mo
+        WHERE NOT EXISTS (SELECT 1 FROM orders WHERE orders.id = mo.order_id)
+        ORDER BY id
+    ''')
+
+
+# 舊的外送員表沒有寫入 merchant_order_id，只能依顧客、商家、菜品、價格依序配對到 orders；
+# 配對不到的列是 orders 裡已經沒有的訂單
+UNMATCHED_DELIVERY_ORDERS = f'''
+    WITH legacy AS (
+        SELECT *, ROW_NUMBER() OVER (PARTITION BY customer_id, merchant_id, item_id, price ORDER BY id) AS n
+        FROM legacy_delivery_orders),
+    current AS (
+        SELECT customer_id, merchant_id, item_id, price,
+               ROW_NUMBER() OVER (PARTITION BY customer_id, merchant_id, item_id, price ORDER BY id) AS n
+        FROM orders
+        WHERE state IN ({', '.join(f"'{s}'" for s in order_state.DELIVERY_STATES)}))
+    SELECT * FROM legacy
+    WHERE NOT EXISTS (SELECT 1 FROM current
+                      WHERE current.customer_id IS legacy.customer_id AND current.merchant_id IS legacy.merchant_id
+                        AND current.item_id IS legacy.item_id AND current.price IS legacy.price
+                        AND current.n = legacy.n)
+    ORDER BY id
+'''
+
+
+def _adopt_orphan_delivery_orders(conn):
+    # 配對不到的外送員訂單以新的 id 補進 orders，狀態沿用舊表（舊表的狀態值與 order_state 相同）
+    adopted = 0
+    for row in conn.execute(UNMATCHED_DELIVERY_ORDERS).fetchall():
+        state = row['status'] if row['status'] in order_state.DELIVERY_STATES else order_state.READY
+        status, acceptance_status, delivery_status = order_state.PROJECTIONS[state]
+        conn.execute('''
+            INSERT INTO orders (customer_id, merchant_id, delivery_person_id, item_id, item_name, price,
+                                status, acceptance_status, delivery_status, state, state_changed_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, datetime('now'))
+        ''', (row['customer_id'], row['merchant_id'], row['delivery_person_id'], row['item_id'],
+              row['item_name'], row['price'], status, acceptance_status, delivery_status, state))
+        adopted += 1
+
+    # view 取代舊表之前確認沒有訂單消失，不符就讓整個版本回滾
+    counts = {name: conn.execute(f'SELECT COUNT(*) FROM {name}').fetchone()[0]
+              for name in ('merchant_orders', 'legacy_merchant_orders', 'delivery_orders', 'legacy_delivery_orders')}
+    if (counts['merchant_orders'] != counts['legacy_merchant_orders'] + adopted
+            or counts['delivery_orders'] != counts['legacy_delivery_orders']):
+        raise sqlite3.IntegrityError(f'訂單 view 與舊表筆數不符：{counts}')
+
+
+def _backfill_settlements(conn):
+    # 已完成的訂單補記帳本分錄，時間用狀態變更時間（轉成本地時間，與即時記帳一致）
+    orders = conn.execute('''
+        SELECT id, customer_id, merchant_id, delivery_person_id, price,
+               COALESCE(datetime(state_changed_at, 'localtime'), datetime('now', 'localtime')) AS completed_at
+        FROM orders WHERE state = ?
+    ''', (order_state.COMPLETED,)).fetchall()
+    for order in orders:
+        conn.executemany('''
+            INSERT OR IGNORE INTO settlement_ledger (order_id, user_id, report_type, amount, created_at)
+            VALUES (?, ?, ?, ?, ?)
+        ''', [(order['id'], user_id, report_type, amount, order['completed_at'])
+              for user_id, report_type, amount in settlements.entries(order)])
+    settlements.rebuild_rollups(conn)
+
+
+def _create_menu_fts(conn):
+    # SQLite 3.34 以上才有 trigram 分詞；不支援時不建立索引，搜尋退回 LIKE（見 search.py）
+    try:
+        conn.execute('''CREATE VIRTUAL TABLE menu_fts USING fts5(
+                            item_name, description,
+                            content='menu', content_rowid='id', tokenize='trigram')''')
+    except sqlite3.OperationalError:
+        return
+
+    conn.execute('''CREATE TRIGGER menu_fts_insert AFTER INSERT ON menu
+                    BEGIN
+                        INSERT INTO menu_fts (rowid, item_name, description)
+                        VALUES (NEW.id, NEW.item_name, NEW.description);
+                    END''')
+    conn.execute('''CREATE TRIGGER menu_fts_delete AFTER DELETE ON menu
+                    BEGIN
+                        INSERT INTO menu_fts (menu_fts, rowid, item_name, description)
+                        VALUES ('delete', OLD.id, OLD.item_name, OLD.description);
+                    END''')
+    conn.execute('''CREATE TRIGGER menu_fts_update AFTER UPDATE OF item_name, description ON menu
+                    BEGIN
+                        INSERT INTO menu_fts (menu_fts, rowid, item_name, description)
+                        VALUES ('delete', OLD.id, OLD.item_name, OLD.description);
+                        INSERT INTO menu_fts (rowid, item_name, description)
+                        VALUES (NEW.id, NEW.item_name, NEW.description);
+                    END''')
+    conn.execute("INSERT INTO menu_fts (menu_fts) VALUES ('rebuild')")
+
+
+MIGRATIONS = [
+    (1, '建立基本資料表', [
+        '''CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            password_hash TEXT NOT NULL,
+            role TEXT NOT NULL)''',
+
+        '''CREATE TABLE IF NOT EXISTS menu (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            item_name TEXT NOT NULL,
+            description TEXT NOT NULL,
+            price REAL NOT NULL,
+            merchant_id INTEGER NOT NULL,
+            FOREIGN KEY (merchant_id) REFERENCES users (id))''',
+
+        '''CREATE TABLE IF NOT EXISTS orders (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            customer_id INTEGER NOT NULL,
+            merchant_id INTEGER NOT NULL,
+            delivery_person_id INTEGER,
+            delivery_status TEXT  DEFAULT '待確認',
+            item_id INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            price REAL NOT NULL,
+            item_name TEXT NOT NULL,
+            acceptance_status TEXT DEFAULT '待確認',
+            FOREIGN KEY (customer_id) REFERENCES users (id),
+            FOREIGN KEY (merchant_id) REFERENCES users (id),
+            FOREIGN KEY (delivery_person_id) REFERENCES users (id),
+            FOREIGN KEY (item_id) REFERENCES menu (id))''',
+
+        '''CREATE TABLE IF NOT EXISTS merchant_orders (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            order_id INTEGER,
+            customer_id INTEGER NOT NULL,
+            merchant_id INTEGER NOT NULL,
+            item_id INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            delivery_person_id INTEGER,
+            delivery_status TEXT DEFAULT '未接單',
+            acceptance_status TEXT DEFAULT '未處理',
+            price REAL NOT NULL,
+            item_name TEXT NOT NULL,
+            FOREIGN KEY (customer_id) REFERENCES users (id),
+            FOREIGN KEY (merchant_id) REFERENCES users (id),
+            FOREIGN KEY (item_id) REFERENCES menu (id),
+            FOREIGN KEY (order_id) REFERENCES orders (id))''',
+
+        '''CREATE TABLE IF NOT EXISTS delivery_orders (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            customer_id INTEGER NOT NULL,
+            merchant_id INTEGER NOT NULL,
+            merchant_order_id INTEGER,
+            delivery_person_id INTEGER,
+            item_id INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            price REAL NOT NULL,
+            item_name TEXT NOT NULL,
+            FOREIGN KEY (customer_id) REFERENCES users (id),
+            FOREIGN KEY (merchant_id) REFERENCES users (id),
+            FOREIGN KEY (delivery_person_id) REFERENCES users (id),
+            FOREIGN KEY (item_id) REFERENCES menu (id))''',
+
+        '''CREATE TABLE IF NOT EXISTS notifications(
+            notification_id INTEGER PRIMARY  KEY AUTOINCREMENT,
+            user_id INTEGRT,
+            message TEXT,
+            is_read BOOLEAN DEFAULT 0)''',
+
+        '''CREATE TABLE IF NOT EXISTS transactions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            amount REAL NOT NULL,
+            transaction_type TEXT NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users (id))''',
+
+        '''CREATE TABLE IF NOT EXISTS reports (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            report_type TEXT NOT NULL,
+            total_received REAL DEFAULT 0,
+            total_orders INTEGER DEFAULT 0,
+            total_due REAL DEFAULT 0,
+            UNIQUE(user_id, report_type),
+            FOREIGN KEY (user_id) REFERENCES users(id))''',
+
+        '''CREATE TABLE IF NOT EXISTS reviews (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            reviewed_user_id INTEGER NOT NULL,
+            order_id INTEGER NOT NULL,
+            rating INTEGER NOT NULL,
+            comment TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id),
+            FOREIGN KEY (reviewed_user_id) REFERENCES users (id),
+            FOREIGN KEY (order_id) REFERENCES orders (id))''',
+    ]),
+
+    # 依各路由的 WHERE / JOIN / ORDER BY 建立索引，盡量讓查詢只讀索引就能回答
+    (2, '熱門查詢索引', [
+        # index()、orders()、delete_order 的「第一筆訂單」：WHERE customer_id = ? ORDER BY id
+        'CREATE INDEX IF NOT EXISTS idx_orders_customer ON orders (customer_id, id)',
+        # menu()：商家自己的菜品
+        'CREATE INDEX IF NOT EXISTS idx_menu_merchant ON menu (merchant_id, id)',
+        # menu()：商家訂單列表
+        'CREATE INDEX IF NOT EXISTS idx_merchant_orders_merchant ON merchant_orders (merchant_id, id)',
+        # orders() 的 LEFT JOIN 只取 acceptance_status，做成覆蓋索引；confirm_receipt 也用 order_id 更新
+        'CREATE INDEX IF NOT EXISTS idx_merchant_orders_order ON merchant_orders (order_id, acceptance_status)',
+        # menu() 的 LEFT JOIN 只取 status
+        'CREATE INDEX IF NOT EXISTS idx_delivery_orders_merchant_order ON delivery_orders (merchant_order_id, status)',
+        # delivery_orders()：依狀態篩選
+        'CREATE INDEX IF NOT EXISTS idx_delivery_orders_status ON delivery_orders (status, id)',
+        # view_reviews / view_delivery_reviews
+        'CREATE INDEX IF NOT EXISTS idx_reviews_reviewed_user ON reviews (reviewed_user_id, created_at)',
+        # 通知依使用者與已讀狀態查詢
+        'CREATE INDEX IF NOT EXISTS idx_notifications_user ON notifications (user_id, is_read)',
+        # view_reports：依 report_type 查詢，金額欄位一起放進索引避免回表
+        '''CREATE INDEX IF NOT EXISTS idx_reports_type
+           ON reports (report_type, user_id, total_received, total_orders, total_due)''',
+        'ANALYZE',
+    ]),
+
+    # 部署層級的旗標，例如測試帳號是否已建立，避免每個 worker 啟動都重做
+    (3, '部署資訊表', [
+        '''CREATE TABLE IF NOT EXISTS app_meta (
+            key TEXT PRIMARY KEY,
+            value TEXT)''',
+    ]),
+
+    # 訂單狀態只存在 orders 一列；商家與外送員的訂單表改成 orders 的 view，
+    # 舊表保留為 legacy_* 以便對帳。orders 裡已刪除的舊訂單先補回 orders，view 的筆數須與舊表相同
+    (4, '訂單單一狀態來源', [
+        f"ALTER TABLE orders ADD COLUMN state TEXT NOT NULL DEFAULT '{order_state.PLACED}'",
+        'ALTER TABLE orders ADD COLUMN state_changed_at TEXT',
+        _adopt_orphan_merchant_orders,
+        _backfill_order_state,
+        'ALTER TABLE merchant_orders RENAME TO legacy_merchant_orders',
+        'ALTER TABLE delivery_orders RENAME TO legacy_delivery_orders',
+        f'''CREATE VIEW merchant_orders AS
+            SELECT id, id AS order_id, customer_id, merchant_id, item_id, status,
+                   delivery_person_id, delivery_status, acceptance_status, price, item_name, state
+            FROM orders
+            WHERE state <> '{order_state.PLACED}'
+        ''',
+        f'''CREATE VIEW delivery_orders AS
+            SELECT id, id AS merchant_order_id, customer_id, merchant_id, delivery_person_id,
+                   item_id, state AS status, price, item_name
+            FROM orders
+            WHERE state IN ({', '.join(f"'{s}'" for s in order_state.DELIVERY_STATES)})
+        ''',
+        _adopt_orphan_delivery_orders,
+        # 商家訂單列表、外送員看板、外送員自己的訂單
+        'CREATE INDEX IF NOT EXISTS idx_orders_merchant ON orders (merchant_id, id)',
+        'CREATE INDEX IF NOT EXISTS idx_orders_state ON orders (state, id)',
+        'CREATE INDEX IF NOT EXISTS idx_orders_delivery_person ON orders (delivery_person_id, state)',
+    ]),
+
+    # 通知表重建：修正 user_id 型別、加上建立時間；未讀數改由觸發器維護在計數表
+    (5, '通知收件匣與未讀計數', [
+        '''CREATE TABLE notifications_new (
+            notification_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            message TEXT,
+            is_read BOOLEAN NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id))''',
+        '''INSERT INTO notifications_new (notification_id, user_id, message, is_read)
+           SELECT notification_id, user_id, message, COALESCE(is_read, 0)
+           FROM notifications WHERE user_id IS NOT NULL''',
+        'DROP TABLE notifications',
+        'ALTER TABLE notifications_new RENAME TO notifications',
+        'CREATE INDEX idx_notifications_user ON notifications (user_id, is_read, notification_id)',
+        'CREATE INDEX idx_notifications_created ON notifications (created_at)',
+
+        '''CREATE TABLE notification_counters (
+            user_id INTEGER PRIMARY KEY,
+            unread INTEGER NOT NULL DEFAULT 0)''',
+        '''INSERT INTO notification_counters (user_id, unread)
+           SELECT user_id, COUNT(*) FROM notifications WHERE is_read = 0 GROUP BY user_id''',
+        '''CREATE TRIGGER notifications_unread_insert AFTER INSERT ON notifications
+           WHEN NEW.is_read = 0
+           BEGIN
+               INSERT OR IGNORE INTO notification_counters (user_id, unread) VALUES (NEW.user_id, 0);
+               UPDATE notification_counters SET unread = unread + 1 WHERE user_id = NEW.user_id;
+           END''',
+        '''CREATE TRIGGER notifications_unread_read AFTER UPDATE OF is_read ON notifications
+           WHEN OLD.is_read = 0 AND NEW.is_read <> 0
+           BEGIN
+               UPDATE notification_counters SET unread = unread - 1 WHERE user_id = OLD.user_id;
+           END''',
+        '''CREATE TRIGGER notifications_unread_unread AFTER UPDATE OF is_read ON notifications
+           WHEN OLD.is_read <> 0 AND NEW.is_read = 0
+           BEGIN
+               INSERT OR IGNORE INTO notification_counters (user_id, unread) VALUES (NEW.user_id, 0);
+               UPDATE notification_counters SET unread = unread + 1 WHERE user_id = NEW.user_id;
+           END''',
+        '''CREATE TRIGGER notifications_unread_delete AFTER DELETE ON notifications
+           WHEN OLD.is_read = 0
+           BEGIN
+               UPDATE notification_counters SET unread = unread - 1 WHERE user_id = OLD.user_id;
+           END''',
+    ]),
+
+    # 帶時間戳的結算帳本，以及依日、週、月累加的彙總表（見 settlements.py）
+    (6, '結算帳本與時間分桶彙總', [
+        '''CREATE TABLE settlement_ledger (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            order_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            report_type TEXT NOT NULL,
+            amount REAL NOT NULL,
+            created_at TEXT NOT NULL,
+            UNIQUE (order_id, report_type),
+            FOREIGN KEY (order_id) REFERENCES orders (id),
+            FOREIGN KEY (user_id) REFERENCES users (id))''',
+        'CREATE INDEX idx_settlement_ledger_created ON settlement_ledger (created_at)',
+        '''CREATE TABLE settlement_rollups (
+            period TEXT NOT NULL,
+            bucket TEXT NOT NULL,
+            report_type TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            total_orders INTEGER NOT NULL DEFAULT 0,
+            total_amount REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (period, bucket, report_type, user_id)) WITHOUT ROWID''',
+        _backfill_settlements,
+    ]),
+
+    # 每位被評論者一列的評分彙總，由 reviews 上的觸發器累加，徽章與評論頁不必即時聚合
+    (7, '評分彙總', [
+        '''CREATE TABLE rating_aggregates (
+            user_id INTEGER PRIMARY KEY,
+            review_count INTEGER NOT NULL DEFAULT 0,
+            rating_sum INTEGER NOT NULL DEFAULT 0,
+            stars_1 INTEGER NOT NULL DEFAULT 0,
+            stars_2 INTEGER NOT NULL DEFAULT 0,
+            stars_3 INTEGER NOT NULL DEFAULT 0,
+            stars_4 INTEGER NOT NULL DEFAULT 0,
+            stars_5 INTEGER NOT NULL DEFAULT 0,
+            latest_review_at TEXT,
+            FOREIGN KEY (user_id) REFERENCES users (id))''',
+        '''INSERT INTO rating_aggregates (user_id, review_count, rating_sum,
+                                          stars_1, stars_2, stars_3, stars_4, stars_5, latest_review_at)
+           SELECT reviewed_user_id, COUNT(*), SUM(rating),
+                  SUM(rating = 1), SUM(rating = 2), SUM(rating = 3), SUM(rating = 4), SUM(rating = 5),
+                  MAX(created_at)
+           FROM reviews GROUP BY reviewed_user_id''',
+        '''CREATE TRIGGER reviews_rating_insert AFTER INSERT ON reviews
+           BEGIN
+               INSERT OR IGNORE INTO rating_aggregates (user_id) VALUES (NEW.reviewed_user_id);
+               UPDATE rating_aggregates SET
+                   review_count = review_count + 1,
+                   rating_sum = rating_sum + NEW.rating,
+                   stars_1 = stars_1 + (NEW.rating = 1),
+                   stars_2 = stars_2 + (NEW.rating = 2),
+                   stars_3 = stars_3 + (NEW.rating = 3),
+                   stars_4 = stars_4 + (NEW.rating = 4),
+                   stars_5 = stars_5 + (NEW.rating = 5),
+                   latest_review_at = MAX(COALESCE(latest_review_at, ''), COALESCE(NEW.created_at, ''))
+               WHERE user_id = NEW.reviewed_user_id;
+           END''',
+        '''CREATE TRIGGER reviews_rating_delete AFTER DELETE ON reviews
+           BEGIN
+               UPDATE rating_aggregates SET
+                   review_count = review_count - 1,
+                   rating_sum = rating_sum - OLD.rating,
+                   stars_1 = stars_1 - (OLD.rating = 1),
+                   stars_2 = stars_2 - (OLD.rating = 2),
+                   stars_3 = stars_3 - (OLD.rating = 3),
+                   stars_4 = stars_4 - (OLD.rating = 4),
+                   stars_5 = stars_5 - (OLD.rating = 5)
+               WHERE user_id = OLD.reviewed_user_id;
+           END''',
+        # 評論列表以 id 做 keyset 分頁
+        'CREATE INDEX IF NOT EXISTS idx_reviews_reviewed_user_id ON reviews (reviewed_user_id, id)',
+    ]),
+
+    # 菜單全文搜尋索引，由 menu 上的觸發器同步新增、編輯、刪除
+    (8, '菜單全文搜尋', [
+        _create_menu_fts,
+        # 搜尋結果的價格篩選與短關鍵字退回 LIKE 時使用
+        'CREATE INDEX IF NOT EXISTS idx_menu_price ON menu (price, id)',
+    ]),
+
+    # 顧客購物車：加入、移除菜品不寫 orders，結帳時一次交易建立所有訂單（見 cart.py）
+    (9, '購物車', [
+        '''CREATE TABLE cart_items (
+            customer_id INTEGER NOT NULL,
+            item_id INTEGER NOT NULL,
+            quantity INTEGER NOT NULL CHECK (quantity > 0),
+            added_at TEXT NOT NULL DEFAULT (datetime('now')),
+            PRIMARY KEY (customer_id, item_id),
+            FOREIGN KEY (customer_id) REFERENCES users (id),
+            FOREIGN KEY (item_id) REFERENCES menu (id)) WITHOUT ROWID''',
+    ]),
+
+    # 確認收貨只寫一列待結算記錄，帳本、交易與報告由背景工作批次累加（見 settlements.py）
+    (10, '結算 outbox', [
+        '''CREATE TABLE settlement_outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            order_id INTEGER NOT NULL UNIQUE,
+            customer_id INTEGER NOT NULL,
+            merchant_id INTEGER NOT NULL,
+            delivery_person_id INTEGER,
+            price REAL NOT NULL,
+            completed_at TEXT NOT NULL,
+            FOREIGN KEY (order_id) REFERENCES orders (id))''',
+    ]),
+
+    # 完成超過一段時間的訂單搬到 orders_archive（見 archive.py），歷史頁面讀 order_history view
+    (11, '已完成訂單封存', [
+        '''CREATE TABLE orders_archive (
+            id INTEGER PRIMARY KEY,
+            customer_id INTEGER NOT NULL,
+            merchant_id INTEGER NOT NULL,
+            delivery_person_id INTEGER,
+            item_id INTEGER NOT NULL,
+            item_name TEXT NOT NULL,
+            price REAL NOT NULL,
+            status TEXT NOT NULL,
+            acceptance_status TEXT,
+            delivery_status TEXT,
+            state TEXT NOT NULL,
+            state_changed_at TEXT,
+            archived_at TEXT NOT NULL DEFAULT (datetime('now')))''',
+        'CREATE INDEX idx_orders_archive_customer ON orders_archive (customer_id, id)',
+        'CREATE INDEX idx_orders_archive_merchant ON orders_archive (merchant_id, id)',
+        'CREATE INDEX idx_orders_archive_delivery_person ON orders_archive (delivery_person_id, id)',
+        f'''CREATE VIEW order_history AS
+            SELECT {archive.COLUMNS} FROM orders
+            UNION ALL
+            SELECT {archive.COLUMNS} FROM orders_archive''',
+        # 商家訂單列表包含已封存的訂單
+        'DROP VIEW merchant_orders',
+        f'''CREATE VIEW merchant_orders AS
+            SELECT id, id AS order_id, customer_id, merchant_id, item_id, status,
+                   delivery_person_id, delivery_status, acceptance_status, price, item_name, state
+            FROM order_history
+            WHERE state <> '{order_state.PLACED}'
+        ''',
+    ]),
+]
+
+
+def _has_version_table(conn):
+    row = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'schema_version'"
+    ).fetchone()
+    return row is not None
+
+
+def current_version(conn):
+    if not _has_version_table(conn):
+        return 0
+    row = conn.execute('SELECT MAX(version) FROM schema_version').fetchone()
+    return row[0] or 0
+
+
+def latest_version():
+    return MIGRATIONS[-1][0] if MIGRATIONS else 0
+
+
+def pending(conn):
+    version = current_version(conn)
+    return [m for m in MIGRATIONS if m[0] > version]
+
+
+def migrate(conn, target=None):
+    conn.execute('''CREATE TABLE IF NOT EXISTS schema_version (
+                    version INTEGER PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    applied_at TEXT NOT NULL)''')
+    conn.commit()
+
+    applied = []
+    for version, name, steps in pending(conn):
+        if target is not None and version > target:
+            break
+
+        # 每個版本一個交易，失敗就整個版本回滾，不會留下做一半的結構
+        conn.execute('BEGIN IMMEDIATE')
+        # 拿到寫鎖後再確認一次，其他行程可能已經套用過
+        if current_version(conn) >= version:
+            conn.rollback()
+            continue
+        try:
+            for step in steps:
+                if callable(step):
+                    step(conn)
+                else:
+                    conn.execute(step)
+            conn.execute('INSERT INTO schema_version (version, name, applied_at) VALUES (?, ?, ?)',
+                         (version, name, datetime.now(timezone.utc).isoformat(timespec='seconds')))
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+        applied.append((version, name))
+    return applied
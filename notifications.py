@@ -0,0 +1,71 @@
+# 通知收件匣
+# 未讀數存在 notification_counters，由 notifications 上的觸發器維護（migration 5），
+# 讀取只是一次主鍵查詢，不需要 COUNT(*)。
+import events
+import versions
+
+MARK_READ_CHUNK_SIZE = 500
+
+# 外送進度通知顧客的訊息，HTML 路由與 /api/v1 共用
+ORDER_MESSAGES = {
+    'pickup': '您的訂單正在取貨中，即將送達。訂單編號：{order_id}',
+    'deliver': '您的訂單已送達，請確認收貨並進行評價。訂單編號：{order_id}',
+}
+
+
+def unread_count(conn, user_id):
+    row = conn.execute('SELECT unread FROM notification_counters WHERE user_id = ?', (user_id,)).fetchone()
+    return row['unread'] if row else 0
+
+
+def mark_read(conn, user_id, notification_ids=None):
+    # notification_ids 為 None 時全部標為已讀；呼叫端負責 commit
+    if notification_ids is None:
+        return conn.execute('UPDATE notifications SET is_read = 1 WHERE user_id = ? AND is_read = 0',
+                            (user_id,)).rowcount
+
+    updated = 0
+    for start in range(0, len(notification_ids), MARK_READ_CHUNK_SIZE):
+        chunk = notification_ids[start:start + MARK_READ_CHUNK_SIZE]
+        updated += conn.execute(f'''
+            UPDATE notifications SET is_read = 1
+            WHERE user_id = ? AND is_read = 0 AND notification_id IN ({','.join('?' * len(chunk))})
+        ''', (user_id, *chunk)).rowcount
+    return updated
+
+
+def prune(conn, days, batch_size=1000, include_unread=False):
+    # 分批刪除，避免長時間握住寫鎖
+    condition = '' if include_unread else 'AND is_read <> 0'
+    deleted = 0
+    while True:
+        count = conn.execute(f'''
+            DELETE FROM notifications WHERE notification_id IN (
+                SELECT notification_id FROM notifications
+                WHERE created_at < datetime('now', ?) {condition}
+                LIMIT ?)
+        ''', (f'-{int(days)} days', batch_size)).rowcount
+        conn.commit()
+        deleted += count
+        if count < batch_size:
+            return deleted
+
+
+def publish_unread(conn, user_id):
+    # 推送最新未讀數給訂閱 /events 的顧客，頁面上的徽章不必輪詢
+    versions.registry.bump('notifications', user_id)
+    events.bus.publish({f'customer:{user_id}'}, 'notification', {'unread': unread_count(conn, user_id)})
+
+
+def notify_customer(conn, action, order_id):
+    # 與狀態變更同一個交易寫入；commit 之後呼叫 publish_customer_unread
+    conn.execute('''
+        INSERT INTO notifications (user_id, message)
+        SELECT customer_id, ? FROM orders WHERE id = ?
+    ''', (ORDER_MESSAGES[action].format(order_id=order_id), order_id))
+
+
+def publish_customer_unread(conn, order_id):
+    customer = conn.execute('SELECT customer_id FROM orders WHERE id = ?', (order_id,)).fetchone()
+    if customer:
+        publish_unread(conn, customer['customer_id'])
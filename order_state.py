@@ -0,0 +1,80 @@
+# 訂單狀態機
+# orders 表每筆訂單只有一列，state 欄位是唯一權威狀態；商家與外送員看到的
+# merchant_orders / delivery_orders 是 orders 的 view（見 migration 4），
+# 所以每次狀態變更只需要一個 UPDATE。
+# orders 上舊有的 status / acceptance_status / delivery_status 欄位跟著 state
+# 在同一個 UPDATE 裡一起寫入，讓既有頁面不用改就能顯示。
+
+PLACED = '待处理'        # 顧客已下單，尚未確認
+CONFIRMED = '已確認'     # 顧客確認下單，等待商家處理
+ACCEPTED = '商家已接單'
+REJECTED = '已拒絕'
+READY = '待配送'         # 商家已通知外送員
+CLAIMED = '已接單'       # 外送員已接單
+PICKING_UP = '取貨中'
+DELIVERED = '已送達'
+COMPLETED = '已完成'
+
+# 動作 -> (允許的來源狀態, 目標狀態)
+TRANSITIONS = {
+    'confirm': ({PLACED}, CONFIRMED),
+    'accept': ({CONFIRMED}, ACCEPTED),
+    'reject': ({CONFIRMED}, REJECTED),
+    'notify_courier': ({ACCEPTED}, READY),
+    'claim': ({READY}, CLAIMED),
+    'pickup': ({CLAIMED}, PICKING_UP),
+    'deliver': ({PICKING_UP}, DELIVERED),
+    'complete': ({DELIVERED}, COMPLETED),
+}
+
+# 狀態 -> orders 的 (status, acceptance_status, delivery_status)
+PROJECTIONS = {
+    PLACED: ('待处理', '待確認', '待確認'),
+    CONFIRMED: ('已確認', '待處理', '待確認'),
+    ACCEPTED: ('已確認', '已接單', '待確認'),
+    REJECTED: ('已確認', '已拒絕', '待確認'),
+    READY: ('已確認', '已接單', '已通知'),
+    CLAIMED: ('已確認', '已接單', '已接單'),
+    PICKING_UP: ('已確認', '已接單', '取貨中'),
+    DELIVERED: ('已確認', '已接單', '已送達'),
+    COMPLETED: ('已完成', '已接單', '已送達'),
+}
+
+# 出現在外送員看板上的狀態
+DELIVERY_STATES = (READY, CLAIMED, PICKING_UP, DELIVERED, COMPLETED)
+
+
+class InvalidTransition(ValueError):
+    pass
+
+
+def transition(conn, action, order_ids, assign=None, where=None):
+    # 以比對目前狀態的條件式 UPDATE 完成轉換，回傳實際轉換的筆數；
+    # 不在允許來源狀態的訂單不會被更動。呼叫端負責 commit。
+    if action not in TRANSITIONS:
+        raise InvalidTransition(action)
+    if isinstance(order_ids, int):
+        order_ids = [order_ids]
+    if not order_ids:
+        return 0
+
+    sources, target = TRANSITIONS[action]
+    status, acceptance_status, delivery_status = PROJECTIONS[target]
+
+    columns = ['state = ?', 'status = ?', 'acceptance_status = ?', 'delivery_status = ?',
+               "state_changed_at = datetime('now')"]
+    params = [target, status, acceptance_status, delivery_status]
+    for column, value in (assign or {}).items():
+        columns.append(f'{column} = ?')
+        params.append(value)
+
+    conditions = [f"id IN ({','.join('?' * len(order_ids))})",
+                  f"state IN ({','.join('?' * len(sources))})"]
+    params += [*order_ids, *sources]
+    for column, value in (where or {}).items():
+        conditions.append(f'{column} = ?')
+        params.append(value)
+
+    cursor = conn.execute(f"UPDATE orders SET {', '.join(columns)} WHERE {' AND '.join(conditions)}", params)
+    return cursor.rowcount
+
@@ -0,0 +1,39 @@
+# 以 id 為鍵的 keyset 分頁
+# 不用 OFFSET：下一頁直接從上一頁最後一筆的 id 接著查，走索引範圍掃描，
+# 第幾頁的查詢成本都一樣。
+from bisect import bisect_right
+from collections import namedtuple
+
+from flask import current_app, request
+
+Page = namedtuple('Page', ['items', 'cursor', 'next_cursor', 'size'])
+
+
+def page_args():
+    size = request.args.get('limit', type=int) or current_app.config['PAGE_SIZE']
+    size = max(1, min(size, current_app.config['MAX_PAGE_SIZE']))
+    cursor = request.args.get('cursor', type=int)
+    return cursor, size
+
+
+def fetch_page(conn, sql, params, cursor, size, key='id', column=None, descending=True):
+    # sql 需以 WHERE 條件結尾；column 是排序欄位（可帶表名），key 是結果列裡對應的欄位名
+    column = column or key
+    if cursor is not None:
+        sql += f' AND {column} {"<" if descending else ">"} ?'
+        params = (*params, cursor)
+    sql += f' ORDER BY {column} {"DESC" if descending else "ASC"} LIMIT ?'
+
+    # 多取一筆，用來判斷還有沒有下一頁
+    rows = conn.execute(sql, (*params, size + 1)).fetchall()
+    has_more = len(rows) > size
+    rows = rows[:size]
+    return Page(rows, cursor, rows[-1][key] if has_more else None, size)
+
+
+def slice_page(rows, cursor, size, key='id'):
+    # rows 需依 key 遞增排序（例如快取中的菜單）
+    start = 0 if cursor is None else bisect_right(rows, cursor, key=lambda row: row[key])
+    items = rows[start:start + size]
+    has_more = start + size < len(rows)
+    return Page(items, cursor, items[-1][key] if has_more else None, size)
@@ -0,0 +1,39 @@
+# 評分彙總
+# rating_aggregates 每位被評論者一列（筆數、總分、1～5 星分布、最新評論時間），
+# 由 reviews 上的觸發器在新增評論時累加（migration 7），讀取都是主鍵查詢。
+STARS = (5, 4, 3, 2, 1)
+
+_COLUMNS = '''user_id, review_count, rating_sum, stars_1, stars_2, stars_3, stars_4, stars_5,
+              latest_review_at, ROUND(CAST(rating_sum AS REAL) / review_count, 1) AS average'''
+
+
+def valid_rating(value):
+    try:
+        rating = int(value)
+    except (TypeError, ValueError):
+        return None
+    return rating if 1 <= rating <= 5 else None
+
+
+def summary(conn, user_id):
+    return conn.execute(f'SELECT {_COLUMNS} FROM rating_aggregates WHERE user_id = ? AND review_count > 0',
+                        (user_id,)).fetchone()
+
+
+def for_users(conn, user_ids):
+    # 一次取多位使用者的彙總，給列表頁的徽章用；回傳 {user_id: row}
+    user_ids = list({u for u in user_ids if u is not None})
+    if not user_ids:
+        return {}
+    rows = conn.execute(f'''
+        SELECT {_COLUMNS} FROM rating_aggregates
+        WHERE review_count > 0 AND user_id IN ({','.join('?' * len(user_ids))})
+    ''', user_ids).fetchall()
+    return {row['user_id']: row for row in rows}
+
+
+def histogram(row):
+    # [(星數, 筆數, 百分比), ...]，由 5 星排到 1 星
+    total = row['review_count'] if row else 0
+    return [(stars, row[f'stars_{stars}'] if row else 0,
+             round(row[f'stars_{stars}'] * 100 / total) if total else 0) for stars in STARS]
@@ -0,0 +1,99 @@
+# 菜單全文搜尋
+# menu_fts 是 menu 的 FTS5 外部內容索引（item_name、description），由 menu 上的觸發器同步（migration 8）。
+# trigram 分詞以三個字元為單位切詞，中文不需要斷詞也能做子字串比對；
+# 三個字元以下的關鍵字 trigram 無法比對，改用 LIKE 掃描 menu。
+# 結果依 BM25 排序（菜名權重較高），以 (score, id) 做 keyset 分頁。
+from collections import namedtuple
+
+from pagination import Page
+
+# 菜名比描述重要
+BM25_WEIGHTS = (10.0, 1.0)
+MIN_FTS_LENGTH = 3
+
+Query = namedtuple('Query', ['text', 'min_price', 'max_price'])
+
+
+def escape_like(term):
+    # 使用者輸入的 % 與 _ 當成一般字元比對
+    return term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def available(conn):
+    # 編譯時沒有 FTS5 的 SQLite 不會建立 menu_fts（見 migration 8），一律走 LIKE
+    row = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'menu_fts'").fetchone()
+    return row is not None
+
+
+def parse_args(args):
+    def price(name):
+        try:
+            return float(args[name]) if args.get(name) else None
+        except ValueError:
+            return None
+    return Query(args.get('q', '').strip(), price('min_price'), price('max_price'))
+
+
+def _match_expression(text):
+    # 每個詞都當成片語，避免使用者輸入的引號、運算子被 FTS5 解讀
+    terms = text.split()
+    return ' AND '.join('"' + term.replace('"', '""') + '"' for term in terms)
+
+
+def _price_filter(query):
+    conditions, params = [], []
+    if query.min_price is not None:
+        conditions.append('menu.price >= ?')
+        params.append(query.min_price)
+    if query.max_price is not None:
+        conditions.append('menu.price <= ?')
+        params.append(query.max_price)
+    return ''.join(f' AND {c}' for c in conditions), params
+
+
+def encode_cursor(row):
+    return f"{row['score']!r}_{row['id']}"
+
+
+def decode_cursor(cursor):
+    try:
+        score, item_id = cursor.rsplit('_', 1)
+        return float(score), int(item_id)
+    except (AttributeError, ValueError):
+        return None
+
+
+def search(conn, query, cursor, size):
+    price_sql, price_params = _price_filter(query)
+    terms = query.text.split()
+
+    if terms and available(conn) and all(len(term) >= MIN_FTS_LENGTH for term in terms):
+        sql = f'''
+            SELECT * FROM (
+                SELECT menu.*, bm25(menu_fts, {BM25_WEIGHTS[0]}, {BM25_WEIGHTS[1]}) AS score
+                FROM menu_fts
+                JOIN menu ON menu.id = menu_fts.rowid
+                WHERE menu_fts MATCH ?{price_sql})
+            WHERE 1 = 1'''
+        params = [_match_expression(query.text), *price_params]
+    else:
+        # 短關鍵字或沒有 FTS5：子字串比對，沒有相關度可排，score 一律為 0
+        sql = f'SELECT menu.*, 0.0 AS score FROM menu WHERE 1 = 1{price_sql}'
+        params = list(price_params)
+        for term in terms:
+            sql += " AND (menu.item_name LIKE ? ESCAPE '\\' OR menu.description LIKE ? ESCAPE '\\')"
+            pattern = f'%{escape_like(term)}%'
+            params += [pattern, pattern]
+        sql = f'SELECT * FROM ({sql}) WHERE 1 = 1'
+
+    # BM25 分數越小越相關；同分依 id
+    position = decode_cursor(cursor)
+    if position is not None:
+        sql += ' AND (score > ? OR (score = ? AND id > ?))'
+        params += [position[0], position[0], position[1]]
+    sql += ' ORDER BY score, id LIMIT ?'
+
+    rows = conn.execute(sql, (*params, size + 1)).fetchall()
+    has_more = len(rows) > size
+    rows = rows[:size]
+    return Page(rows, cursor, encode_cursor(rows[-1]) if has_more else None, size)
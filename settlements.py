@@ -0,0 +1,302 @@
+# 結算帳本與時間分桶彙總
+# 每筆完成的訂單在 settlement_ledger 為商家、外送員、客戶各記一筆帶時間戳的分錄，
+# 同時累加到 settlement_rollups 的日、週（週一起算）、月三種分桶。
+# 查詢任意日期區間時，先把區間拆成最少的整月、整週、單日分桶，
+# 每位使用者只需加總少量分桶列，不必掃描帳本。
+#
+# 確認收貨的請求只在 settlement_outbox 寫一列（enqueue），不碰帳本與報告；
+# 背景的 SettlementWorker 定期（或被 wake() 叫醒時）整批取出，同一位使用者的多筆完成訂單
+# 合併成一次 upsert，在同一個寫入交易裡寫入交易紀錄、帳本、分桶與 reports，並刪除已處理的列。
+# outbox 在資料庫裡，行程重啟後未處理的列會繼續處理。
+import threading
+import time
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+
+import db
+import logs
+
+log = logs.get_logger('settlements')
+
+MERCHANT = '商家'
+COURIER = '外送員'
+CUSTOMER = '客戶'
+
+MERCHANT_SHARE = 0.8
+COURIER_SHARE = 0.2
+
+PERIODS = ('day', 'week', 'month')
+
+
+def buckets_for(day):
+    # 某一天所屬的 (period, bucket) 三個分桶
+    return [('day', day.isoformat()),
+            ('week', (day - timedelta(days=day.weekday())).isoformat()),
+            ('month', day.replace(day=1).isoformat())]
+
+
+def _next_month(day):
+    return (day.replace(day=1) + timedelta(days=32)).replace(day=1)
+
+
+def cover(start, end):
+    # 把 [start, end) 拆成不重疊的分桶：能用整月就用整月，其次整週，剩下單日
+    result = []
+    day = start
+    while day < end:
+        month_end = _next_month(day)
+        if day.day == 1 and month_end <= end:
+            result.append(('month', day.isoformat()))
+            day = month_end
+            continue
+        # 整週不跨過下一個可以整月計算的月份
+        limit = month_end if _next_month(month_end) <= end else end
+        if day.weekday() == 0 and day + timedelta(days=7) <= limit:
+            result.append(('week', day.isoformat()))
+            day += timedelta(days=7)
+            continue
+        result.append(('day', day.isoformat()))
+        day += timedelta(days=1)
+    return result
+
+
+def entries(order):
+    price = order['price']
+    # 一筆訂單的 (user_id, report_type, amount) 分錄
+    result = [(order['merchant_id'], MERCHANT, price * MERCHANT_SHARE),
+              (order['customer_id'], CUSTOMER, price)]
+    if order['delivery_person_id']:
+        result.append((order['delivery_person_id'], COURIER, price * COURIER_SHARE))
+    return result
+
+
+def enqueue(conn, order_id, at=None):
+    # 與訂單狀態變更在同一個交易，呼叫端負責 commit；同一筆訂單只會排入一次
+    at = at or datetime.now()
+    return conn.execute('''
+        INSERT OR IGNORE INTO settlement_outbox
+            (order_id, customer_id, merchant_id, delivery_person_id, price, completed_at)
+        SELECT id, customer_id, merchant_id, delivery_person_id, price, ?
+        FROM orders WHERE id = ?
+    ''', (at.isoformat(sep=' ', timespec='seconds'), order_id)).rowcount
+
+
+def apply(conn, completions):
+    # completions：outbox 的列（或有相同欄位的 dict）。已記過帳的訂單略過，其餘依使用者合併後寫入；
+    # 呼叫端負責交易
+    if not completions:
+        return 0
+    order_ids = [c['order_id'] for c in completions]
+    settled = set()
+    for start in range(0, len(order_ids), 500):
+        chunk = order_ids[start:start + 500]
+        settled.update(row[0] for row in conn.execute(
+            f"SELECT DISTINCT order_id FROM settlement_ledger WHERE order_id IN ({','.join('?' * len(chunk))})",
+            chunk))
+    completions = [c for c in completions if c['order_id'] not in settled]
+    if not completions:
+        return 0
+
+    ledger = []
+    reports = defaultdict(lambda: [0, 0.0, 0.0])    # (user_id, report_type) -> [orders, received, due]
+    rollups = defaultdict(lambda: [0, 0.0])         # (period, bucket, report_type, user_id) -> [orders, amount]
+    for c in completions:
+        order = {'id': c['order_id'], 'customer_id': c['customer_id'], 'merchant_id': c['merchant_id'],
+                 'delivery_person_id': c['delivery_person_id'], 'price': c['price']}
+        day = datetime.fromisoformat(c['completed_at']).date()
+        for user_id, report_type, amount in entries(order):
+            ledger.append((c['order_id'], user_id, report_type, amount, c['completed_at']))
+            totals_row = reports[(user_id, report_type)]
+            if report_type == CUSTOMER:
+                totals_row[2] += amount
+            else:
+                totals_row[1] += amount
+            # 沿用原本的報告口徑：只有外送員的 total_orders 會累加
+            if report_type == COURIER:
+                totals_row[0] += 1
+            for period, bucket in buckets_for(day):
+                rollup = rollups[(period, bucket, report_type, user_id)]
+                rollup[0] += 1
+                rollup[1] += amount
+
+    conn.executemany("INSERT INTO transactions (user_id, amount, transaction_type) VALUES (?, ?, 'order_completed')",
+                     [(c['customer_id'], c['price']) for c in completions])
+    conn.executemany('''
+        INSERT OR IGNORE INTO settlement_ledger (order_id, user_id, report_type, amount, created_at)
+        VALUES (?, ?, ?, ?, ?)
+    ''', ledger)
+    conn.executemany('''
+        INSERT INTO settlement_rollups (period, bucket, report_type, user_id, total_orders, total_amount)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT(period, bucket, report_type, user_id) DO UPDATE SET
+        total_orders = total_orders + excluded.total_orders,
+        total_amount = total_amount + excluded.total_amount
+    ''', [(*key, orders, amount) for key, (orders, amount) in rollups.items()])
+    conn.executemany('''
+        INSERT INTO reports (user_id, report_type, total_orders, total_received, total_due)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(user_id, report_type) DO UPDATE SET
+        total_orders = total_orders + excluded.total_orders,
+        total_received = total_received + excluded.total_received,
+        total_due = total_due + excluded.total_due
+    ''', [(*key, orders, received, due) for key, (orders, received, due) in reports.items()])
+    return len(completions)
+
+
+def drain(conn, batch_size=500):
+    # 處理一批 outbox；需在寫入交易內呼叫（db.write_transaction）。回傳 (處理筆數, 最舊一筆的完成時間)
+    rows = conn.execute('''
+        SELECT id, order_id, customer_id, merchant_id, delivery_person_id, price, completed_at
+        FROM settlement_outbox ORDER BY id LIMIT ?
+    ''', (batch_size,)).fetchall()
+    if not rows:
+        return 0, None
+    apply(conn, rows)
+    conn.execute('DELETE FROM settlement_outbox WHERE id <= ?', (rows[-1]['id'],))
+    return len(rows), rows[0]['completed_at']
+
+
+def outbox_status(conn):
+    row = conn.execute('SELECT COUNT(*) AS pending, MIN(completed_at) AS oldest FROM settlement_outbox').fetchone()
+    lag = (datetime.now() - datetime.fromisoformat(row['oldest'])).total_seconds() if row['oldest'] else 0.0
+    return {'pending': row['pending'], 'lag_seconds': max(0.0, lag)}
+
+
+class SettlementWorker:
+    # 背景執行緒：每 interval 秒或被 wake() 叫醒時把 outbox 清空
+    def __init__(self, app, interval=1.0, batch_size=500):
+        self.app = app
+        self.interval = interval
+        self.batch_size = batch_size
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._counters = {'drained': 0, 'batches': 0, 'errors': 0, 'last_batch_size': 0,
+                          'last_drain_lag_seconds': 0.0}
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='settlement-worker', daemon=True)
+                self._thread.start()
+
+    def stop(self, timeout=5):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def wake(self):
+        self._wake.set()
+
+    def drain_once(self):
+        # 清空 outbox，回傳處理筆數；CLI 與背景執行緒共用
+        total = 0
+        with self.app.app_context(), db.get_pool(self.app).connection() as conn:
+            while True:
+                count, oldest = db.write_transaction(conn, lambda c: drain(c, self.batch_size))
+                if not count:
+                    return total
+                total += count
+                with self._lock:
+                    self._counters['drained'] += count
+                    self._counters['batches'] += 1
+                    self._counters['last_batch_size'] = count
+                    self._counters['last_drain_lag_seconds'] = max(
+                        0.0, (datetime.now() - datetime.fromisoformat(oldest)).total_seconds())
+                if count < self.batch_size:
+                    return total
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                self.drain_once()
+            except Exception:
+                with self._lock:
+                    self._counters['errors'] += 1
+                log.exception('結算 outbox 處理失敗')
+                # 避免資料庫出錯時連續重試
+                time.sleep(self.interval)
+
+    def stats(self):
+        with self._lock:
+            return {'running': self._thread is not None and self._thread.is_alive(), **self._counters}
+
+
+def rebuild_rollups(conn):
+    # 由帳本重算所有分桶（migration 回填或對帳時使用）
+    conn.execute('DELETE FROM settlement_rollups')
+    conn.execute('''
+        INSERT INTO settlement_rollups (period, bucket, report_type, user_id, total_orders, total_amount)
+        SELECT 'day', date(created_at), report_type, user_id, COUNT(*), SUM(amount)
+        FROM settlement_ledger GROUP BY date(created_at), report_type, user_id
+    ''')
+    conn.execute('''
+        INSERT INTO settlement_rollups (period, bucket, report_type, user_id, total_orders, total_amount)
+        SELECT 'week', date(bucket, '-' || ((CAST(strftime('%w', bucket) AS INTEGER) + 6) % 7) || ' days'),
+               report_type, user_id, SUM(total_orders), SUM(total_amount)
+        FROM settlement_rollups WHERE period = 'day'
+        GROUP BY 2, report_type, user_id
+    ''')
+    conn.execute('''
+        INSERT INTO settlement_rollups (period, bucket, report_type, user_id, total_orders, total_amount)
+        SELECT 'month', date(bucket, 'start of month'), report_type, user_id, SUM(total_orders), SUM(total_amount)
+        FROM settlement_rollups WHERE period = 'day'
+        GROUP BY 2, report_type, user_id
+    ''')
+
+
+def totals(conn, start=None, end=None):
+    # 回傳 {report_type: [row, ...]}；沒有日期區間時直接讀 reports 的累計值
+    # end 為包含當天的結束日
+    if start is None or end is None:
+        rows = conn.execute('''
+            SELECT reports.report_type, users.username, reports.total_orders,
+                   reports.total_received, reports.total_due
+            FROM reports
+            JOIN users ON reports.user_id = users.id
+            WHERE reports.report_type IN (?, ?, ?)
+            ORDER BY reports.report_type, users.username
+        ''', (MERCHANT, COURIER, CUSTOMER)).fetchall()
+    else:
+        ranges = cover(start, end + timedelta(days=1))
+        if not ranges:
+            return {MERCHANT: [], COURIER: [], CUSTOMER: []}
+        rows = conn.execute(f'''
+            SELECT r.report_type, users.username, SUM(r.total_orders) AS total_orders,
+                   SUM(CASE WHEN r.report_type = '{CUSTOMER}' THEN 0 ELSE r.total_amount END) AS total_received,
+                   SUM(CASE WHEN r.report_type = '{CUSTOMER}' THEN r.total_amount ELSE 0 END) AS total_due
+            FROM settlement_rollups r
+            JOIN users ON r.user_id = users.id
+            WHERE (r.period, r.bucket) IN (VALUES {', '.join(['(?, ?)'] * len(ranges))})
+            GROUP BY r.report_type, r.user_id
+            ORDER BY r.report_type, users.username
+        ''', [value for pair in ranges for value in pair]).fetchall()
+
+    result = {MERCHANT: [], COURIER: [], CUSTOMER: []}
+    for row in rows:
+        result[row['report_type']].append(row)
+    return result
+
+
+def parse_range(args, today=None):
+    # 解析 ?range=today|week|month 或 ?start=&end=（YYYY-MM-DD），格式不對時視為全部期間
+    today = today or date.today()
+    preset = args.get('range')
+    if preset == 'today':
+        return today, today
+    if preset == 'week':
+        return today - timedelta(days=today.weekday()), today
+    if preset == 'month':
+        return today.replace(day=1), today
+    try:
+        start = date.fromisoformat(args.get('start', ''))
+        end = date.fromisoformat(args.get('end', ''))
+    except ValueError:
+        return None, None
+    if start > end:
+        start, end = end, start
+    return start, end
@@ -0,0 +1,30 @@
+// 加入購物車不重新載入頁面：以 fetch 送出表單，只更新購物車數量
+(function () {
+    var badge = document.getElementById('cart-count');
+    if (!badge || !window.fetch) {
+        return;
+    }
+
+    document.querySelectorAll('form.cart-add').forEach(function (form) {
+        form.addEventListener('submit', function (event) {
+            event.preventDefault();
+            fetch(form.action, {
+                method: 'POST',
+                body: new FormData(form),
+                headers: {'Accept': 'application/json'},
+                credentials: 'same-origin'
+            }).then(function (response) {
+                return response.json();
+            }).then(function (data) {
+                if (data.count !== undefined) {
+                    badge.textContent = data.count;
+                } else if (data.error) {
+                    alert(data.error);
+                }
+            }).catch(function () {
+                // 網路錯誤時退回一般的表單送出
+                form.submit();
+            });
+        });
+    });
+})();
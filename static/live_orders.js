@@ -0,0 +1,34 @@
+// 訂閱 /events，只依有變動的訂單更新畫面，不必整頁重新整理
+(function () {
+    var list = document.querySelector('[data-live-orders]');
+    if (!list || !window.EventSource) {
+        return;
+    }
+
+    var notice = document.getElementById('live-notice');
+    var newOrders = 0;
+    var source = new EventSource(list.dataset.liveOrders);
+
+    source.addEventListener('order', function (event) {
+        var order = JSON.parse(event.data);
+        var item = list.querySelector('[data-order-id="' + order.id + '"]');
+
+        if (item) {
+            var status = item.querySelector('.live-status');
+            if (status) {
+                status.textContent = '最新狀態：' + order.state;
+            }
+            // 狀態已經往前推進，舊的操作按鈕不再有效
+            if (item.dataset.state !== order.state) {
+                item.querySelectorAll('form.live-action').forEach(function (form) {
+                    form.remove();
+                });
+                item.dataset.state = order.state;
+            }
+        } else if (notice) {
+            newOrders += 1;
+            notice.textContent = '有 ' + newOrders + ' 筆新的訂單更新，點此重新整理';
+            notice.style.display = 'block';
+        }
+    });
+})();
@@ -0,0 +1,12 @@
+// 訂閱 /events 的 notification 事件，即時更新未讀徽章
+(function () {
+    var badge = document.getElementById('unread-badge');
+    if (!badge || !window.EventSource) {
+        return;
+    }
+
+    var source = new EventSource(badge.dataset.events);
+    source.addEventListener('notification', function (event) {
+        badge.textContent = JSON.parse(event.data).unread;
+    });
+})();
@@ -0,0 +1,44 @@
+# 資源版本號，給條件式 GET（ETag / If-None-Match）使用
+# 寫入路徑在 commit 之後 bump() 對應的鍵：全域的（catalog、ratings、delivery_board）
+# 或每位使用者一份的（orders、cart、notifications）。頁面以相關鍵的版本號、目前使用者與查詢參數
+# 組成 ETag，版本沒變就直接回 304，不查資料庫也不渲染模板。
+# 版本號在行程內：寫入落在另一個 worker 行程時，這個行程的版本不會變，會對過期的頁面回 304。
+# 因此只能以單一行程執行（與事件匯流排相同）；多個 worker 行程時設 DELIVERY_CONDITIONAL_GET=0。
+# ETag 帶有行程啟動時的隨機值，只保證重新啟動後舊的 ETag 不再相符。
+import hashlib
+import os
+import threading
+
+# 每位使用者一份的資源；其他名稱都是全域的
+PER_USER = frozenset({'orders', 'cart', 'notifications'})
+
+
+class VersionRegistry:
+    def __init__(self):
+        self.epoch = os.urandom(4).hex()
+        self._lock = threading.Lock()
+        self._versions = {}
+        self._sources = {}
+
+    def source(self, name, getter):
+        # 已經有自己版本號的資源（例如菜單快取的 version），直接讀它的值
+        self._sources[name] = getter
+
+    def get(self, name, user_id=None):
+        if name in self._sources:
+            return self._sources[name]()
+        return self._versions.get((name, user_id if name in PER_USER else None), 0)
+
+    def bump(self, name, *user_ids):
+        # 不帶 user_ids 時是全域鍵；None 的 user_id 會被略過（例如還沒有外送員的訂單）
+        keys = [(name, user_id) for user_id in user_ids if user_id is not None] if user_ids else [(name, None)]
+        with self._lock:
+            for key in keys:
+                self._versions[key] = self._versions.get(key, 0) + 1
+
+    def etag(self, *parts):
+        digest = hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()[:16]
+        return f'{self.epoch}-{digest}'
+
+
+registry = VersionRegistry()